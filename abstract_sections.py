@@ -0,0 +1,112 @@
+import os
+import re
+
+from response_cache import ResponseCache
+
+
+# headings like "BACKGROUND: " or "METHODS AND FINDINGS: "
+structured_heading_start_pattern = re.compile(ur"^[A-Z' ,&]{4,}: ")
+structured_section_pattern = re.compile(ur"([A-Z' ,&]{4,}): (.*?) (?=$|[A-Z' ,&]{4,}: )")
+
+not_summary_heading_words = frozenset(["TRIAL", "DATA", "REGISTRATION", "FUNDING"])
+
+
+def structured_sections(abstract_text):
+    """
+    Sections of an abstract written with uppercase headings, with the offsets
+    (1-based, inclusive) of each section's text in the abstract.  Empty if the
+    abstract doesn't start with a heading.
+    """
+    all_sections = []
+    if not abstract_text:
+        return all_sections
+
+    # if &amp; in heading, need to replace with uppercase it won't match as heading
+    working_text = abstract_text.replace("&amp;", " AND ")  # exactly the same length, so won't affect offsets
+    if not structured_heading_start_pattern.match(working_text):
+        return all_sections
+
+    cursor = 1
+    for match in structured_section_pattern.finditer(working_text):
+        (heading, text) = match.groups()
+        cursor += len(heading) + 2
+        # don't include heading in what can be annotated
+        original_start = cursor
+        cursor += len(text)
+        all_sections.append({
+            "heading": heading,
+            "text": text,
+            "original_start": original_start,
+            "original_end": cursor,
+            "section_split_source": "structured",
+            "summary": False
+        })
+        cursor += 1
+
+    if all_sections:
+        all_sections[-1]["summary"] = True
+
+        # check it doesn't talk about funding or data.  if so, use previous heading instead.
+        for heading_word in all_sections[-1]["heading"].split(" "):
+            if heading_word in not_summary_heading_words:
+                all_sections[-1]["summary"] = False
+                all_sections[-2]["summary"] = True
+    return all_sections
+
+
+def automated_sections(abstract_text):
+    """
+    Splits an abstract without headings into BACKGROUND and SUMMARY, at the
+    last CONCLUSION(S): if there is one, otherwise before the last three sentences.
+    """
+    if not abstract_text:
+        return []
+
+    background_text = ""
+    summary_text = ""
+    if "CONCLUSION:" in abstract_text:
+        (background_text, summary_text) = abstract_text.rsplit("CONCLUSION:", 1)
+    elif "CONCLUSIONS:" in abstract_text:
+        (background_text, summary_text) = abstract_text.rsplit("CONCLUSIONS:", 1)
+    else:
+        try:
+            sentences = abstract_text.rsplit(". ", 3)
+            background_text += ". ".join(sentences[0:1]) + "."
+            summary_text += ". ".join(sentences[1:])
+        except IndexError:
+            background_text += abstract_text[-500:-1]
+            summary_text += abstract_text[-500:-1]
+
+    background_text = background_text.strip()
+    summary_text = summary_text.strip()
+
+    return [
+        {"text": background_text, "heading": "BACKGROUND", "section_split_source": "automated", "summary": False, "original_start":1, "original_end":len(background_text)},
+        {"text": summary_text, "heading": "SUMMARY", "section_split_source": "automated", "summary": True, "original_start":len(background_text)+2, "original_end":len(abstract_text)}
+    ]
+
+
+def split_abstract(abstract_text):
+    return structured_sections(abstract_text) or automated_sections(abstract_text)
+
+
+# the same abstracts come up in search after search, so keep the splits around.
+# keyed by the text itself, so an edited abstract is just a new entry.
+abstract_sections_cache = ResponseCache(
+    max_entries=int(os.getenv("ABSTRACT_SECTIONS_CACHE_SIZE", 5000)),
+    ttl_seconds=int(os.getenv("ABSTRACT_SECTIONS_CACHE_TTL", 24*60*60))
+)
+
+
+def get_abstract_sections(abstract_text):
+    """
+    Cached split_abstract.  The sections returned are shared, so copy them
+    before changing them.
+    """
+    if not abstract_text:
+        return []
+    sections = abstract_sections_cache.get(abstract_text)
+    if sections is None:
+        sections = split_abstract(abstract_text)
+        abstract_sections_cache.set(abstract_text, sections)
+    return sections
@@ -33,18 +33,18 @@ annotation_blacklist = [
     "Facial_%28sex_act%29", # gets mixed up with facial 10.1016/j.jad.2007.01.031
     "Polish_People%27s_Republic", # nazi flag
 ]
-annotation_blacklist = [a.lower() for a in annotation_blacklist]
+annotation_blacklist = frozenset([a.lower() for a in annotation_blacklist])
 
 # the annotations are fine we just don't want them to be our main image
 # should be in uri format
 image_blacklist = [
     ]
-image_blacklist = [a.lower() for a in image_blacklist]
+image_blacklist = frozenset([a.lower() for a in image_blacklist])
 
 spot_requires_exact_match = [
     "cultivars"  # otherwise matches "Common Fig" and probably other common foods
 ]
-spot_requires_exact_match = [a.lower() for a in spot_requires_exact_match]
+spot_requires_exact_match = frozenset([a.lower() for a in spot_requires_exact_match])
 
 annotation_requires_exact_match = [
     "Chemotherapy",  #sometimes matches therapy or treatment
@@ -79,7 +79,7 @@ annotation_requires_exact_match = [
     "Sexual_dysfunction",
     "Trafficking_of_children"
     ]
-annotation_requires_exact_match = [a.lower() for a in annotation_requires_exact_match]
+annotation_requires_exact_match = frozenset([a.lower() for a in annotation_requires_exact_match])
 
 evidence_level_descriptions = {
     "case study": "An up-close, in-depth, and detailed explanation of one particular patient and their situation.  Because it only describes a single case, extreme caution should be used in applying its conclusions to any other patients or situations.",
@@ -104,54 +104,87 @@ def build_evidence_level_annotations():
 
 
 
+# (type, adjustment, titles it doesn't apply to) for topic_score
+topic_score_type_adjustments = [
+    ("http://dbpedia.org/ontology/Location", 2, frozenset(["Ancient Egypt"])),
+    ("http://dbpedia.org/ontology/Species", 2, frozenset(["Rat", "Mouse"])),
+    ("http://dbpedia.org/ontology/AnatomicalStructure", 1, frozenset()),
+    ("http://dbpedia.org/ontology/Biomolecule", 0.8, frozenset()),
+    ("http://dbpedia.org/ontology/ChemicalSubstance", 0.6, frozenset()),
+    ("http://dbpedia.org/ontology/Food", 0.8, frozenset()),
+    ("http://dbpedia.org/ontology/SportsTeam", -1, frozenset()),
+    ("http://dbpedia.org/ontology/TelevisionEpisode", -10, frozenset()),
+    ("http://dbpedia.org/ontology/TelevisionShow", -10, frozenset()),
+]
+
+# (spot, title) pairs that are almost always wrong, all lowercase
+topic_score_bad_spot_titles = frozenset([
+    ("activity", "physical exercise"),
+    ("origins", "fibonacci number"),
+    ("ages", "ageing"),
+])
+
+
 class Annotation(object):
+    """
+    One dandelion annotation.
+
+    All the blacklist and scoring rules are run once, when the annotation is made,
+    and the answers kept in slots, because a response reads them over and over.
+    topic_score and picture_score depend on top_entity_score and
+    annotation_distribution, so they're recalculated when those are set.
+    """
+
+    __slots__ = [
+        "dandelion_raw",
+        "is_top_entity",
+        "uri",
+        "start",
+        "end",
+        "spot",
+        "types",
+        "confidence",
+        "title",
+        "in_image_blacklist",
+        "suppress",
+        "image_url",
+        "topic_score",
+        "picture_score",
+        "_top_entity_score",
+        "_annotation_distribution",
+        "_topic_score_adjustments",
+        "_annotation_file_entry",
+        "_dict_simple",
+    ]
 
     def __init__(self, dandelion_raw):
         self.dandelion_raw = dandelion_raw
         self.is_top_entity = False
-        self.top_entity_score = 0
-        self.annotation_distribution = None
-
-    @property
-    def uri(self):
-        return self.dandelion_raw["uri"]
 
-    @property
-    def start(self):
-        return self.dandelion_raw["start"]
-
-    @property
-    def end(self):
-        return self.dandelion_raw["end"]
-
-    @property
-    def spot(self):
-        return self.dandelion_raw["spot"]
-
-    @property
-    def types(self):
-        return self.dandelion_raw["types"]
+        self.uri = dandelion_raw["uri"]
+        self.start = dandelion_raw["start"]
+        self.end = dandelion_raw["end"]
+        self.spot = dandelion_raw["spot"]
+        self.types = dandelion_raw["types"]
+        self.confidence = dandelion_raw["confidence"]
+        self.title = dandelion_raw["title"]
+        self._annotation_file_entry = annotation_file_contents.get(self.uri, None)
 
-    @property
-    def confidence(self):
-        return self.dandelion_raw["confidence"]
-
-    @property
-    def title(self):
-        return self.dandelion_raw["title"]
-
-    @property
-    def in_image_blacklist(self):
-        uri_name_for_matching = self.uri.lower().rsplit("/", 1)[1]
-        if uri_name_for_matching in image_blacklist:
-            return True
-        return False
-
-    @property
-    def suppress(self):
         uri_name_for_matching = self.uri.lower().rsplit("/", 1)[1]
         spot_for_matching = self.spot.lower()
+        title_for_matching = self.title.lower()
+        types_for_matching = frozenset(self.types)
+
+        self.in_image_blacklist = uri_name_for_matching in image_blacklist
+        self.suppress = self._get_suppress(uri_name_for_matching, spot_for_matching, types_for_matching)
+        self.image_url = self._get_image_url()
+        self._topic_score_adjustments = self._get_topic_score_adjustments(spot_for_matching, title_for_matching, types_for_matching)
+
+        self._annotation_distribution = None
+        self._dict_simple = None
+        self.top_entity_score = 0
 
+    def _get_suppress(self, uri_name_for_matching, spot_for_matching, types_for_matching):
         if uri_name_for_matching in annotation_blacklist:
             return True
 
@@ -164,13 +197,12 @@ class Annotation(object):
                 return True
 
         # too many incorrect hits on people, and they are too costly (remove this and search for "et al" to see)
-        if "http://dbpedia.org/ontology/Person" in self.types:
+        if "http://dbpedia.org/ontology/Person" in types_for_matching:
             return True
 
         return False
 
-    @property
-    def image_url(self):
+    def _get_image_url(self):
         # maybe supressed or not valid for some reason
         if self.suppress:
             return False
@@ -178,99 +210,95 @@ class Annotation(object):
         if self.in_image_blacklist:
             return False
 
-        if annotation_file_contents.get(self.uri, None):
-            if annotation_file_contents[self.uri]["alt_img"]:
-                return annotation_file_contents[self.uri]["alt_img"]
+        if self._annotation_file_entry:
+            if self._annotation_file_entry["alt_img"]:
+                return self._annotation_file_entry["alt_img"]
 
         if "image" in self.dandelion_raw and self.dandelion_raw["image"]:
             return self.dandelion_raw["image"]["full"]
         else:
             return None
 
-
-    @property
-    def topic_score(self):
-        score = self.top_entity_score
-
+    def _get_topic_score_adjustments(self, spot_for_matching, title_for_matching, types_for_matching):
+        # the changes topic_score makes to top_entity_score, in order.  None means -1000.
         if self.suppress:
-            return -1000
+            return None
 
         if self.in_image_blacklist:
-            return -1000
-
-        # gotta avoid https://gettheresearch.org/search/pmdd?zoom=https%3A%2F%2Fdoi.org%2F10.1016%2Fj.jad.2007.01.031
-
-        if "sex" in self.title.lower():
-            score -= 2
-
-        if "urinart" in self.title.lower() or "urolog" in self.title.lower() or\
-                "genital" in self.spot.lower() or "genital" in self.title.lower():
-            score -= 2
-
-        if "http://dbpedia.org/ontology/Location" in self.types and self.title not in ["Ancient Egypt"]:
-            score += 2
-
-        if "http://dbpedia.org/ontology/Species" in self.types and self.title not in ["Rat", "Mouse"]:
-            score += 2
+            return None
 
-        if "http://dbpedia.org/ontology/AnatomicalStructure" in self.types:
-            score += 1
+        adjustments = []
 
-        if "http://dbpedia.org/ontology/Biomolecule" in self.types:
-            score += 0.8
+        # gotta avoid https://gettheresearch.org/search/pmdd?zoom=https%3A%2F%2Fdoi.org%2F10.1016%2Fj.jad.2007.01.031
 
-        if "http://dbpedia.org/ontology/ChemicalSubstance" in self.types:
-            score += 0.6
+        if "sex" in title_for_matching:
+            adjustments.append(-2)
 
-        if "http://dbpedia.org/ontology/Food" in self.types:
-            score += 0.8
+        if "urinart" in title_for_matching or "urolog" in title_for_matching or\
+                "genital" in spot_for_matching or "genital" in title_for_matching:
+            adjustments.append(-2)
 
-        if "http://dbpedia.org/ontology/SportsTeam" in self.types:
-            score -= 1
+        for (dbpedia_type, adjustment, excluded_titles) in topic_score_type_adjustments:
+            if dbpedia_type in types_for_matching and self.title not in excluded_titles:
+                adjustments.append(adjustment)
 
-        if "http://dbpedia.org/ontology/TelevisionEpisode" in self.types:
-            score -= 10
+        if (spot_for_matching, title_for_matching) in topic_score_bad_spot_titles:
+            adjustments.append(-10)
 
-        if "http://dbpedia.org/ontology/TelevisionShow" in self.types:
-            score -= 10
+        if self.confidence <= 0.65:
+            adjustments.append(-10)
 
-        if self.spot.lower() == "activity" and self.title.lower() == "physical exercise":
-            score -= 10
+        if self.confidence < 0.7 and spot_for_matching != title_for_matching:
+            adjustments.append(-2)
 
-        if self.spot.lower() == "origins" and self.title.lower() == "fibonacci number":
-            score -= 10
+        adjustments.append(0.2 * self.confidence)
 
-        if self.spot.lower() == "ages" and self.title.lower() == "ageing":
-            score -= 10
+        return tuple(adjustments)
 
-        if self.confidence <= 0.65:
-            score -= 10
+    @property
+    def top_entity_score(self):
+        return self._top_entity_score
 
-        if self.confidence < 0.7 and self.spot.lower() != self.title.lower():
-            score -= 2
+    @top_entity_score.setter
+    def top_entity_score(self, top_entity_score):
+        self._top_entity_score = top_entity_score
+        self._set_scores()
 
-        score += 0.2 * self.confidence
+    @property
+    def annotation_distribution(self):
+        return self._annotation_distribution
 
+    @annotation_distribution.setter
+    def annotation_distribution(self, annotation_distribution):
+        self._annotation_distribution = annotation_distribution
+        self._set_scores()
 
+    def _set_scores(self):
+        if self._topic_score_adjustments is None:
+            self.topic_score = -1000
+        else:
+            score = self._top_entity_score
+            for adjustment in self._topic_score_adjustments:
+                score += adjustment
+            self.topic_score = score
 
-        return score
+        self.picture_score = self._get_picture_score()
 
-    @property
-    def picture_score(self):
+    def _get_picture_score(self):
         score = self.topic_score
 
-        if annotation_file_contents.get(self.uri, None):
-            if annotation_file_contents[self.uri]["bad_image_reason"]:
+        if self._annotation_file_entry:
+            if self._annotation_file_entry["bad_image_reason"]:
                 return -1000
 
         if not self.image_url:
             return -1000
 
-        if annotation_file_contents.get(self.uri, None) and annotation_file_contents[self.uri]["weight"]:
-            score *= float(annotation_file_contents[self.uri]["weight"])
+        if self._annotation_file_entry and self._annotation_file_entry["weight"]:
+            score *= float(self._annotation_file_entry["weight"])
 
-        if hasattr(self, "annotation_distribution") and self.annotation_distribution:
-            score += 0.3 * (1 - self.annotation_distribution[self.image_url])
+        if self._annotation_distribution:
+            score += 0.3 * (1 - self._annotation_distribution[self.image_url])
 
         return score
 
@@ -300,24 +328,28 @@ class Annotation(object):
         if not self.dandelion_raw:
             return []
 
-        raw_annotation = self.dandelion_raw
-        response = {}
-        keep_keys = [
-            "start",
-            "end",
-            "confidence",
-            "title",
-            "spot",
-        ]
-        for key in raw_annotation.keys():
-            if key in keep_keys:
-                response[key] = raw_annotation[key]
-
-        response["image_url"] = self.image_url
-        # response["picture_score"] = self.picture_score
-        # response["raw_top_entity_score"] = self.top_entity_score
-
-        return response
+        # nothing in here changes after __init__, so build it once.  callers
+        # rebase the offsets in what they get back, so hand out copies.
+        if self._dict_simple is None:
+            raw_annotation = self.dandelion_raw
+            response = {}
+            keep_keys = [
+                "start",
+                "end",
+                "confidence",
+                "title",
+                "spot",
+            ]
+            for key in raw_annotation.keys():
+                if key in keep_keys:
+                    response[key] = raw_annotation[key]
+
+            response["image_url"] = self.image_url
+            # response["picture_score"] = self.picture_score
+            # response["raw_top_entity_score"] = self.top_entity_score
+            self._dict_simple = response
+
+        return dict(self._dict_simple)
 
     def get_picture_from_wikipedia(self):
         pass
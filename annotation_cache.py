@@ -0,0 +1,82 @@
+import json
+import zlib
+import hashlib
+import datetime
+import threading
+from sqlalchemy import sql
+
+from app import db
+
+
+# annotations for a given text don't change unless the request options do,
+# so they're cached by a hash of the text and options.  the api key isn't part
+# of the key, so rotating keys doesn't throw the cache away.
+# shared by the web dynos and the save_annotations worker, through postgres.
+
+class DandelionAnnotationCache(db.Model):
+    __tablename__ = "dandelion_annotation_cache"
+    content_hash = db.Column(db.Text, primary_key=True)
+    created = db.Column(db.DateTime)
+    annotations_compressed = db.Column(db.LargeBinary)
+
+
+_stats_lock = threading.Lock()
+annotation_cache_stats = {"hits": 0, "misses": 0}
+
+def _count(stat_name):
+    with _stats_lock:
+        annotation_cache_stats[stat_name] += 1
+
+
+def annotation_cache_key(text, language, include, top_entities):
+    key_parts = [text, language, sorted(include.split(",")), top_entities]
+    return hashlib.sha1(json.dumps(key_parts).encode("utf-8")).hexdigest()
+
+
+def get_cached_annotations(content_hash):
+    query_string = u"""
+        select annotations_compressed
+        from dandelion_annotation_cache
+        where content_hash=:content_hash
+        """
+    row = db.engine.execute(sql.text(query_string), content_hash=content_hash).first()
+    if not row:
+        _count("misses")
+        return None
+    _count("hits")
+    return json.loads(zlib.decompress(row[0]))
+
+
+def get_cached_annotations_many(content_hashes):
+    """
+    Like get_cached_annotations for several texts in one query.  Returns a
+    dict of content_hash to results, for the ones that are cached.
+    """
+    if not content_hashes:
+        return {}
+    query_string = u"""
+        select content_hash, annotations_compressed
+        from dandelion_annotation_cache
+        where content_hash = any(:content_hashes)
+        """
+    rows = db.engine.execute(sql.text(query_string), content_hashes=list(content_hashes)).fetchall()
+    cached = dict((row[0], json.loads(zlib.decompress(row[1]))) for row in rows)
+    for content_hash in set(content_hashes):
+        _count("hits" if content_hash in cached else "misses")
+    return cached
+
+
+def save_cached_annotations(content_hash, dandelion_results):
+    # don't cache errors or rate-limit responses
+    if not dandelion_results or "annotations" not in dandelion_results:
+        return
+    compressed = zlib.compress(json.dumps(dandelion_results, separators=(",", ":")))
+    query_string = u"""
+        insert into dandelion_annotation_cache (content_hash, created, annotations_compressed)
+        values (:content_hash, :created, :annotations_compressed)
+        on conflict (content_hash) do nothing
+        """
+    db.engine.execute(sql.text(query_string),
+                      content_hash=content_hash,
+                      created=datetime.datetime.utcnow(),
+                      annotations_compressed=compressed)
@@ -1,22 +1,93 @@
+import json
+import threading
+from array import array
+
 from annotation import Annotation
 
+
+# per-thread counts of annotation json parses and AnnotationList builds, so
+# views can report them for each request and regressions show up in _timing
+_parse_counts = threading.local()
+
+def reset_annotation_parse_counts():
+    _parse_counts.json_parses = 0
+    _parse_counts.lists_built = 0
+
+def get_annotation_parse_counts():
+    return {
+        "json_parses": getattr(_parse_counts, "json_parses", 0),
+        "lists_built": getattr(_parse_counts, "lists_built", 0)
+    }
+
+def parse_annotation_json(json_string):
+    _parse_counts.json_parses = getattr(_parse_counts, "json_parses", 0) + 1
+    return json.loads(json_string)
+
+
 class AnnotationList(object):
+    """
+    The non-suppressed annotations from one dandelion response.
+
+    Besides the list itself, keeps the start, end and confidence of each
+    annotation in parallel arrays sorted by start, so callers can pull out the
+    annotations inside several offset ranges in one forward sweep.
+    """
 
     def __init__(self, dandelion_raw_list):
+        _parse_counts.lists_built = getattr(_parse_counts, "lists_built", 0) + 1
         self.dandelion_raw_list = dandelion_raw_list
         self.good_annotations = []
 
         if self.dandelion_raw_list:
+            # later topEntities win, same as matching each one in turn
+            top_entity_scores = {}
+            for top_entity in self.dandelion_raw_list.get("topEntities", []):
+                top_entity_scores[top_entity["uri"]] = top_entity["score"]
+
             for annotation_dict in self.dandelion_raw_list.get("annotations", []):
                 my_annotation = Annotation(annotation_dict)
 
                 if not my_annotation.suppress:
-                    for top_entity in self.dandelion_raw_list.get("topEntities", []):
-                        if my_annotation.uri == top_entity["uri"]:
-                            my_annotation.is_top_entity = True
-                            my_annotation.top_entity_score = top_entity["score"]
+                    if my_annotation.uri in top_entity_scores:
+                        my_annotation.is_top_entity = True
+                        my_annotation.top_entity_score = top_entity_scores[my_annotation.uri]
                     self.good_annotations.append(my_annotation)
 
+        self._build_offset_index()
+
+    def _build_offset_index(self):
+        order = sorted(range(len(self.good_annotations)), key=lambda i: self.good_annotations[i].start)
+        self._order = array("l", order)
+        self.starts = array("l", [self.good_annotations[i].start for i in order])
+        self.ends = array("l", [self.good_annotations[i].end for i in order])
+        self.confidences = array("d", [self.good_annotations[i].confidence for i in order])
+
+    def in_ranges(self, ranges, min_confidence=0.0):
+        """
+        For each (start, end) range, the annotations with start <= their start
+        and their end <= end and at least min_confidence, in their original
+        order.  One sweep: ranges are visited in start order and the cursor into
+        the sorted annotations only moves forward.  Returns one list per range.
+        """
+        results = [[] for my_range in ranges]
+        range_order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+        num_annotations = len(self.starts)
+        cursor = 0
+        for range_index in range_order:
+            (range_start, range_end) = ranges[range_index]
+            while cursor < num_annotations and self.starts[cursor] < range_start:
+                cursor += 1
+            indexes = []
+            i = cursor
+            # an annotation can't end before it starts, so nothing starting after range_end fits
+            while i < num_annotations and self.starts[i] <= range_end:
+                if self.ends[i] <= range_end and self.confidences[i] >= min_confidence:
+                    indexes.append(self._order[i])
+                i += 1
+            indexes.sort()
+            results[range_index] = [self.good_annotations[j] for j in indexes]
+        return results
+
     @property
     def raw_annotations(self):
         return self.dandelion_raw_list["annotations"]
@@ -24,10 +95,13 @@ class AnnotationList(object):
     def list(self):
         return self.good_annotations
 
+    def confident(self, min_confidence=0.65):
+        return [a for a in self.good_annotations if a.confidence >= min_confidence]
+
     def to_dict_simple(self):
-        response = [a.to_dict_simple() for a in self.good_annotations if a.confidence >= 0.65]
+        response = [a.to_dict_simple() for a in self.confident(0.65)]
         return response
 
     def picture_candidates(self):
         response = [a.to_dict_simple() for a in self.good_annotations]
-        return response
\ No newline at end of file
+        return response
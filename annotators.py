@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from pub import call_dandelion_batch
+from pub import pack_dandelion_batches
+
+
+# an annotator turns texts into dandelion-shaped results, ie
+#   {"annotations": [{"start", "end", "spot", "uri", "title", "confidence", "types", ...}],
+#    "topEntities": [{"uri", "score"}]}
+# which is what AnnotationList takes.  annotate_texts returns one result per
+# text, None for empty texts or ones that couldn't be annotated.
+
+
+class DandelionAnnotator(object):
+    """
+    The dandelion api, through the annotation cache.  Short texts are packed
+    into shared requests.  Raises TooManyRequestsException when we're out of units.
+    """
+    name = "dandelion"
+    is_local = False
+
+    def annotate_texts(self, texts, api_key=None, label_top_entities=True, deadline=None):
+        results = [None] * len(texts)
+        for batch in pack_dandelion_batches(texts):
+            batch_results = call_dandelion_batch([texts[i] for i in batch], api_key, label_top_entities, deadline)
+            for (i, dandelion_results) in zip(batch, batch_results):
+                results[i] = dandelion_results
+        return results
+
+    def annotate(self, text, api_key=None, label_top_entities=True, deadline=None):
+        return self.annotate_texts([text], api_key, label_top_entities, deadline)[0]
+
+
+word_start_pattern = re.compile(ur"(?<!\w)\w", re.UNICODE)
+word_char_pattern = re.compile(ur"\w", re.UNICODE)
+
+
+class GazetteerAnnotator(object):
+    """
+    Annotates without the network, by matching the spots dandelion has linked
+    before (see build_gazetteer.py) wherever they appear as whole words.
+    Overlapping matches go to the leftmost, then the longest.
+
+    Matching walks a character trie of the spots from each word start, so a
+    text costs about one dict lookup per character it shares with some spot.
+    The gazetteer is loaded on first use.
+    """
+    name = "gazetteer"
+    is_local = True
+
+    def __init__(self, path, top_entities=8):
+        self.path = path
+        self.top_entities = top_entities
+        self._entities = None
+        self._trie = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._entities is not None:
+                return
+            try:
+                with open(self.path) as gazetteer_file:
+                    gazetteer = json.load(gazetteer_file)
+            except (IOError, ValueError):
+                # annotate nothing rather than break searches
+                logging.exception(u"error loading gazetteer from {}".format(self.path))
+                gazetteer = {"spots": [], "entities": {}}
+
+            # a character trie of the spots.  a node's "" key holds
+            # (length, uri, confidence) for the spot that ends there.
+            trie = {}
+            for (spot, uri, confidence) in gazetteer["spots"]:
+                node = trie
+                for c in spot:
+                    node = node.setdefault(c, {})
+                node[""] = (len(spot), uri, confidence)
+
+            self._trie = trie
+            self._entities = gazetteer["entities"]
+            print u"loaded gazetteer of {} spots for {} entities from {}".format(
+                len(gazetteer["spots"]), len(self._entities), self.path)
+
+    def _matches(self, text_lower):
+        matches = []
+        text_length = len(text_lower)
+        for word_start in word_start_pattern.finditer(text_lower):
+            start = word_start.start()
+            node = self._trie
+            position = start
+            while position < text_length:
+                node = node.get(text_lower[position], None)
+                if node is None:
+                    break
+                position += 1
+                if "" in node and (position == text_length or not word_char_pattern.match(text_lower[position])):
+                    matches.append((start, node[""]))
+        return matches
+
+    def annotate(self, text, api_key=None, label_top_entities=True, deadline=None):
+        if not text:
+            return None
+        if self._entities is None:
+            self._load()
+
+        matches = self._matches(text.lower())
+
+        # leftmost, then longest, without overlaps
+        matches.sort(key=lambda (start, (spot_length, uri, confidence)): (start, -spot_length))
+        annotations = []
+        covered_until = 0
+        for (start, (spot_length, uri, confidence)) in matches:
+            if start < covered_until:
+                continue
+            covered_until = start + spot_length
+            annotation = dict(self._entities[uri])
+            annotation.update({
+                "start": start,
+                "end": start + spot_length,
+                "spot": text[start:start + spot_length],
+                "uri": uri,
+                "confidence": confidence
+            })
+            annotations.append(annotation)
+
+        results = {"annotations": annotations, "annotator": self.name, "lang": "en"}
+        if label_top_entities:
+            results["topEntities"] = self._top_entities(annotations)
+        return results
+
+    def _top_entities(self, annotations):
+        # like dandelion's, entities mentioned more, and more confidently, score higher
+        scores = defaultdict(float)
+        for annotation in annotations:
+            scores[annotation["uri"]] += annotation["confidence"]
+        if not scores:
+            return []
+        max_score = max(scores.values())
+        ranked = sorted(scores.items(), key=lambda (uri, score): (-score, uri))[0:self.top_entities]
+        return [{"uri": uri, "score": round(score / max_score, 4)} for (uri, score) in ranked]
+
+    def annotate_texts(self, texts, api_key=None, label_top_entities=True, deadline=None):
+        return [self.annotate(text, api_key, label_top_entities, deadline) for text in texts]
+
+
+def get_annotator(name):
+    if name == "gazetteer":
+        return GazetteerAnnotator(os.getenv("GAZETTEER_PATH", "gazetteer.json"))
+    if name != "dandelion":
+        logging.error(u"unknown annotator {}, using dandelion".format(name))
+    return DandelionAnnotator()
+
+
+# ANNOTATOR=gazetteer annotates cold pubs locally instead of calling dandelion
+annotator = get_annotator(os.getenv("ANNOTATOR", "dandelion"))
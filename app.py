@@ -6,14 +6,17 @@ from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy import exc
 from sqlalchemy import event
 from sqlalchemy import func
+from sqlalchemy.engine import Engine
 from sqlalchemy.pool import NullPool
 from sqlalchemy.pool import Pool
+from sqlalchemy.pool import QueuePool
 
 import logging
 import sys
 import os
+import threading
 import requests
-import requests_cache
+from time import time
 from util import safe_commit
 
 HEROKU_APP_NAME = "gtr-api"
@@ -35,7 +38,8 @@ libraries_to_mum = [
     "boto",
     "newrelic",
     "RateLimiter",
-    "urllib3"
+    "urllib3",
+    "app.InstrumentedQueuePool"  # sqlalchemy logs every checkout to a logger named for the pool class
 ]
 
 for a_library in libraries_to_mum:
@@ -55,16 +59,129 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
 app.config['SQLALCHEMY_ECHO'] = (os.getenv("SQLALCHEMY_ECHO", False) == "True")
 # app.config['SQLALCHEMY_ECHO'] = True
 
-# use cache, especially during development when calling dandelion a lot
-requests_cache.install_cache('main_cache', backend='sqlite', expire_after=60*60*24*7)
 
-# from http://stackoverflow.com/a/12417346/596939
-class NullPoolSQLAlchemy(SQLAlchemy):
+# each gunicorn worker has its own pool.  it needs a connection for each
+# request thread, plus one for the threads that run alongside requests (the
+# query log flusher, annotation cache lookups on the dandelion pool); bursts
+# beyond that get overflow connections, which are closed when they're returned.
+# with DATABASE_MAX_CONNECTIONS set, the workers on a dyno share that between them.
+def pool_sizing():
+    num_workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    num_threads = int(os.getenv("GUNICORN_THREADS", 1))
+    pool_size = int(os.getenv("DATABASE_POOL_SIZE", num_threads + 1))
+    max_overflow = int(os.getenv("DATABASE_MAX_OVERFLOW", 10))
+    if os.getenv("DATABASE_MAX_CONNECTIONS", None):
+        connections_per_worker = max(int(os.getenv("DATABASE_MAX_CONNECTIONS")) / num_workers, 1)
+        pool_size = min(pool_size, connections_per_worker)
+        max_overflow = min(max_overflow, connections_per_worker - pool_size)
+    return (pool_size, max_overflow)
+
+(app.config["SQLALCHEMY_POOL_SIZE"], app.config["SQLALCHEMY_MAX_OVERFLOW"]) = pool_sizing()
+app.config["SQLALCHEMY_POOL_TIMEOUT"] = int(os.getenv("DATABASE_POOL_TIMEOUT", 10))
+# replace connections before the server or anything in between drops them for being idle
+app.config["SQLALCHEMY_POOL_RECYCLE"] = int(os.getenv("DATABASE_POOL_RECYCLE", 30*60))
+
+
+# what each thread got from the pool, so a request can report it in _timing
+pool_stats = threading.local()
+
+def add_pool_stat(stat_name, value):
+    setattr(pool_stats, stat_name, getattr(pool_stats, stat_name, 0) + value)
+
+def reset_pool_stats():
+    for stat_name in ["checkouts", "wait_seconds", "overflow_checkouts", "connects", "connect_seconds"]:
+        setattr(pool_stats, stat_name, 0)
+
+def get_pool_stats():
+    return {
+        "checkouts": getattr(pool_stats, "checkouts", 0),
+        "wait_seconds": round(getattr(pool_stats, "wait_seconds", 0), 4),
+        "overflow_checkouts": getattr(pool_stats, "overflow_checkouts", 0),
+        "connects": getattr(pool_stats, "connects", 0),
+        "connect_seconds": round(getattr(pool_stats, "connect_seconds", 0), 4),
+        "checked_out_now": db.engine.pool.checkedout() if isinstance(db.engine.pool, QueuePool) else None
+    }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that counts checkouts, the time spent waiting for a free
+    connection, checkouts past pool_size, and new connections, per thread.
+
+    Connections can't be shared across a fork.  A process that inherits a
+    pool opens its own connection in place of each of its parent's, before
+    pool_pre_ping or anything else can use the parent's socket.
+    """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        # the parent's connections, kept so they're never garbage collected
+        # here: closing them would end the parent's sessions too
+        self._inherited_connections = []
+
+    def _do_get(self):
+        start = time()
+        connect_seconds_before = getattr(pool_stats, "connect_seconds", 0)
+        try:
+            connection_record = QueuePool._do_get(self)
+            if connection_record.connection is not None and connection_record.info.get("pid", os.getpid()) != os.getpid():
+                self._inherited_connections.append(connection_record.connection)
+                # the record opens a new connection when it's checked out
+                connection_record.connection = None
+            return connection_record
+        finally:
+            add_pool_stat("checkouts", 1)
+            # time spent opening a new connection is counted on its own
+            connect_seconds = getattr(pool_stats, "connect_seconds", 0) - connect_seconds_before
+            add_pool_stat("wait_seconds", time() - start - connect_seconds)
+            if self._overflow > 0:
+                add_pool_stat("overflow_checkouts", 1)
+
+    def _create_connection(self):
+        start = time()
+        try:
+            return QueuePool._create_connection(self)
+        finally:
+            add_pool_stat("connects", 1)
+            add_pool_stat("connect_seconds", time() - start)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
     def apply_driver_hacks(self, app, info, options):
-        options['poolclass'] = NullPool
-        return super(NullPoolSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if os.getenv("DATABASE_NULL_POOL", False) == "True":
+            # a connection per checkout, like we used to
+            options['poolclass'] = NullPool
+            for option in ["pool_size", "max_overflow", "pool_timeout", "pool_recycle"]:
+                options.pop(option, None)
+        else:
+            options['poolclass'] = InstrumentedQueuePool
+            # checks each connection with a cheap round trip when it's checked
+            # out, and reconnects if the server went away
+            options['pool_pre_ping'] = True
+        return super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
 
-db = NullPoolSQLAlchemy(app)
+db = PooledSQLAlchemy(app)
+
+
+# which process opened each connection, see InstrumentedQueuePool
+@event.listens_for(Pool, "connect")
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+# count the sql statements each thread runs, so a request can report how many
+# queries it made and N+1 patterns show up in _timing
+query_counts = threading.local()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    query_counts.count = getattr(query_counts, "count", 0) + 1
+
+def reset_query_count():
+    query_counts.count = 0
+
+def get_query_count():
+    return getattr(query_counts, "count", 0)
 
 # do compression.  has to be above flask debug toolbar so it can override this.
 compress_json = os.getenv("COMPRESS_DEBUG", "False")=="True"
@@ -96,25 +213,3 @@ app.config["COMPRESS_DEBUG"] = compress_json
 # if not commit_success:
 #     print u"COMMIT fail making objects"
 
-
-# from http://docs.sqlalchemy.org/en/latest/core/pooling.html
-# This recipe will ensure that a new Connection will succeed even if connections in the pool
-# have gone stale, provided that the database server is actually running.
-# The expense is that of an additional execution performed per checkout
-# @event.listens_for(Pool, "checkout")
-# def ping_connection(dbapi_connection, connection_record, connection_proxy):
-#     cursor = dbapi_connection.cursor()
-#     try:
-#         cursor.execute("SELECT 1")
-#     except:
-#         # optional - dispose the whole pool
-#         # instead of invalidating one at a time
-#         # connection_proxy._pool.dispose()
-#
-#         # raise DisconnectionError - pool will try
-#         # connecting again up to three times before raising.
-#         raise exc.DisconnectionError()
-#     cursor.close()
-
-
-
@@ -0,0 +1,156 @@
+import os
+import json
+import heapq
+import logging
+import threading
+from bisect import bisect_left
+from time import time
+
+
+def normalize_entity_name(name):
+    return u" ".join(name.lower().split())
+
+
+class AutocompleteIndex(object):
+    """
+    Prefix index over the autocomplete entity titles, local to one worker process.
+
+    Built from the artifact build_autocomplete_data.py writes: a json list of
+    {"lower": ..., "value": ..., "aliases": [...]} dicts, most events first.  Lowercased titles
+    are kept sorted, so the titles starting with a prefix are one bisect away;
+    the best ten for every short prefix are worked out up front, since those
+    match the most titles.
+
+    The artifact's mtime is checked every check_seconds, and a rebuilt artifact
+    is loaded in full before it replaces the old index, so requests always see
+    one whole index or the other.  Until an index is loaded, lookups return
+    None and callers should go to the database.
+    """
+
+    def __init__(self, path, check_seconds=30, max_results=10, precomputed_prefix_length=3):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.max_results = max_results
+        self.precomputed_prefix_length = precomputed_prefix_length
+        self._index = None
+        self._loaded_mtime = None
+        self._last_checked = 0
+        self._lock = threading.Lock()
+
+    def reload_if_changed(self):
+        if time() - self._last_checked < self.check_seconds:
+            return
+        # only one thread reloads; the others keep using the index they have
+        if not self._lock.acquire(False):
+            return
+        try:
+            self._last_checked = time()
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return
+            if mtime != self._loaded_mtime:
+                self._index = self._build(self.path)
+                self._loaded_mtime = mtime
+                print u"loaded autocomplete index of {} titles from {}".format(len(self._index["titles"]), self.path)
+        except Exception:
+            logging.exception(u"error loading autocomplete index from {}".format(self.path))
+        finally:
+            self._lock.release()
+
+    def _build(self, path):
+        with open(path) as artifact_file:
+            ordered_autocomplete_dicts = json.load(artifact_file)
+
+        titles = [d["value"] for d in ordered_autocomplete_dicts]
+        lowers = [d["lower"] for d in ordered_autocomplete_dicts]
+
+        # rank is the position in the artifact, so lower is better
+        sorted_ranks = sorted(range(len(lowers)), key=lambda rank: lowers[rank])
+        sorted_lowers = [lowers[rank] for rank in sorted_ranks]
+
+        exact = {}
+        top_by_prefix = {}
+        for (rank, lower) in enumerate(lowers):
+            # the best ranked title wins, like the first row from the database would
+            exact.setdefault(lower, titles[rank])
+            for prefix_length in range(1, min(len(lower), self.precomputed_prefix_length) + 1):
+                top = top_by_prefix.setdefault(lower[0:prefix_length], [])
+                if len(top) < self.max_results:
+                    top.append(titles[rank])
+
+        # other names for the same entity, see entity.entity_aliases.  a title
+        # always beats an alias, then the best ranked entity wins.
+        aliases = {}
+        for (rank, d) in enumerate(ordered_autocomplete_dicts):
+            for alias in d.get("aliases", []):
+                if alias not in exact:
+                    aliases.setdefault(alias, titles[rank])
+
+        return {
+            "titles": titles,
+            "sorted_lowers": sorted_lowers,
+            "sorted_ranks": sorted_ranks,
+            "exact": exact,
+            "aliases": aliases,
+            "top_by_prefix": top_by_prefix
+        }
+
+    def is_loaded(self):
+        self.reload_if_changed()
+        return self._index is not None
+
+    def autocomplete(self, query):
+        """
+        The best max_results titles starting with query, ignoring case, or None
+        if there's no index.
+        """
+        self.reload_if_changed()
+        my_index = self._index
+        if my_index is None:
+            return None
+
+        prefix = query.lower()
+        if len(prefix) <= self.precomputed_prefix_length:
+            return list(my_index["top_by_prefix"].get(prefix, []))
+
+        sorted_lowers = my_index["sorted_lowers"]
+        start = bisect_left(sorted_lowers, prefix)
+        end = bisect_left(sorted_lowers, prefix + u"\uffff", start)
+        ranks = heapq.nsmallest(self.max_results, my_index["sorted_ranks"][start:end])
+        return [my_index["titles"][rank] for rank in ranks]
+
+    def exact_match(self, query):
+        """
+        The title that is query, ignoring case, or None.  Check is_loaded()
+        first; this can't tell no match from no index.
+        """
+        self.reload_if_changed()
+        my_index = self._index
+        if my_index is None:
+            return None
+        return my_index["exact"].get(query.lower(), None)
+
+    def resolve(self, query):
+        """
+        The title query names, by title or by alias, ignoring case and extra
+        spaces, or None.  Like exact_match, check is_loaded() first.
+        """
+        self.reload_if_changed()
+        my_index = self._index
+        if my_index is None:
+            return None
+        key = normalize_entity_name(query)
+        return my_index["exact"].get(key, None) or my_index["aliases"].get(key, None)
+
+
+default_autocomplete_index_path = os.getenv("AUTOCOMPLETE_INDEX_PATH", "autocomplete_index.json")
+
+autocomplete_index = None
+if default_autocomplete_index_path:
+    autocomplete_index = AutocompleteIndex(
+        default_autocomplete_index_path,
+        check_seconds=int(os.getenv("AUTOCOMPLETE_INDEX_CHECK_SECONDS", 30))
+    )
+    # load when the worker starts, not on its first autocomplete request
+    autocomplete_index.reload_if_changed()
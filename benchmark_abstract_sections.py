@@ -0,0 +1,151 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# times splitting abstracts into sections, the old way (regexes compiled on
+# every call, rsplit repeated) against abstract_sections, uncached and cached,
+# and checks they give the same sections.
+#
+# uses synthetic structured and unstructured abstracts unless given a file
+# with one abstract per line, e.g. from
+#   psql $DATABASE_URL -At -c "select abstract_text from medline_citation where abstract_text is not null limit 2000" > abstracts.txt
+#
+# usage:
+# python benchmark_abstract_sections.py --abstracts 2000 --rounds 20
+# python benchmark_abstract_sections.py --corpus abstracts.txt
+
+import argparse
+import random
+import re
+from time import time
+
+from abstract_sections import split_abstract
+from abstract_sections import get_abstract_sections
+from abstract_sections import abstract_sections_cache
+
+headings = [u"BACKGROUND", u"OBJECTIVE", u"METHODS", u"METHODS AND FINDINGS", u"RESULTS",
+            u"CONCLUSIONS", u"CONCLUSION", u"TRIAL REGISTRATION", u"FUNDING", u"ETHICS & DISSEMINATION"]
+words = u"the of patients in and with were a to cancer risk we cells study treatment increased data p".split()
+
+
+def synthetic_abstracts(n):
+    random.seed(0)
+    response = []
+    for i in range(n):
+        sentences = []
+        for j in range(random.randint(3, 12)):
+            sentence = u" ".join(random.choice(words) for k in range(random.randint(5, 25)))
+            sentences.append(sentence.capitalize())
+        kind = random.choice(["structured", "conclusion", "plain"])
+        if kind == "structured":
+            section_headings = random.sample(headings, random.randint(2, 6))
+            chunks = [u"{}: {}.".format(h, s) for (h, s) in zip(section_headings, sentences)]
+            response.append(u" ".join(chunks))
+        elif kind == "conclusion":
+            response.append(u". ".join(sentences[:-1]) + u". CONCLUSION: " + sentences[-1] + u".")
+        else:
+            response.append(u". ".join(sentences) + u".")
+    return response
+
+
+def legacy_split_abstract(abstract_text):
+    # the code that used to be in Pub/PubDoi abstract_structured and abstract_with_annotations_dict
+    all_sections = []
+    working_text = abstract_text
+    if working_text:
+        working_text = working_text.replace("&amp;", " AND ")
+        if re.findall("(^[A-Z' ,&]{4,}): ", working_text):
+            matches = re.findall(ur"([A-Z' ,&]{4,}): (.*?) (?=$|[A-Z' ,&]{4,}: )", working_text)
+            for match in matches:
+                all_sections.append({
+                    "heading": match[0],
+                    "text": match[1]
+                })
+    cursor = 1
+    for section in all_sections:
+        cursor += len(section["heading"])
+        cursor += 2
+        section["original_start"] = cursor
+        cursor += len(section["text"])
+        section["original_end"] = cursor
+        cursor += 1
+        section["section_split_source"] = "structured"
+        section["summary"] = False
+    if all_sections:
+        all_sections[-1]["summary"] = True
+        for heading_word in all_sections[-1]["heading"].split(" "):
+            if heading_word in ["TRIAL", "DATA", "REGISTRATION", "FUNDING"]:
+                all_sections[-1]["summary"] = False
+                all_sections[-2]["summary"] = True
+    if all_sections:
+        return all_sections
+
+    if not abstract_text:
+        return []
+    background_text = ""
+    summary_text = ""
+    if "CONCLUSION:" in abstract_text:
+        background_text = abstract_text.rsplit("CONCLUSION:", 1)[0]
+        summary_text = abstract_text.rsplit("CONCLUSION:", 1)[1]
+    elif "CONCLUSIONS:" in abstract_text:
+        background_text = abstract_text.rsplit("CONCLUSIONS:", 1)[0]
+        summary_text = abstract_text.rsplit("CONCLUSIONS:", 1)[1]
+    else:
+        try:
+            background_text += ". ".join(abstract_text.rsplit(". ", 3)[0:1]) + "."
+            summary_text += ". ".join(abstract_text.rsplit(". ", 3)[1:])
+        except IndexError:
+            background_text += abstract_text[-500:-1]
+            summary_text += abstract_text[-500:-1]
+    background_text = background_text.strip()
+    summary_text = summary_text.strip()
+    return [
+        {"text": background_text, "heading": "BACKGROUND", "section_split_source": "automated", "summary": False, "original_start":1, "original_end":len(background_text)},
+        {"text": summary_text, "heading": "SUMMARY", "section_split_source": "automated", "summary": True, "original_start":len(background_text)+2, "original_end":len(abstract_text)}
+    ]
+
+
+def time_per_abstract(split_function, abstracts, rounds):
+    start = time()
+    for i in range(rounds):
+        for abstract_text in abstracts:
+            try:
+                split_function(abstract_text)
+            except IndexError:
+                # a lone section with a FUNDING/TRIAL/DATA heading; both versions raise
+                pass
+    return (time() - start) / (rounds * len(abstracts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time splitting abstracts into sections.")
+    parser.add_argument('--abstracts', nargs="?", type=int, default=2000, help="how many synthetic abstracts")
+    parser.add_argument('--corpus', nargs="?", type=str, default=None, help="file with one abstract per line")
+    parser.add_argument('--rounds', nargs="?", type=int, default=20, help="times through the abstracts")
+    parsed_args = parser.parse_args()
+
+    if parsed_args.corpus:
+        with open(parsed_args.corpus) as corpus_file:
+            abstracts = [line.decode("utf-8").rstrip("\n") for line in corpus_file]
+    else:
+        abstracts = synthetic_abstracts(parsed_args.abstracts)
+
+    mismatches = 0
+    for abstract_text in abstracts:
+        try:
+            expected = legacy_split_abstract(abstract_text)
+        except IndexError:
+            expected = IndexError
+        try:
+            got = split_abstract(abstract_text)
+        except IndexError:
+            got = IndexError
+        if expected != got:
+            mismatches += 1
+    print u"{} abstracts, {} with different sections".format(len(abstracts), mismatches)
+
+    abstract_sections_cache.max_entries = len(abstracts)
+    for (name, split_function) in [("legacy", legacy_split_abstract),
+                                   ("split_abstract", split_abstract),
+                                   ("get_abstract_sections (cached)", get_abstract_sections)]:
+        per_abstract = time_per_abstract(split_function, abstracts, parsed_args.rounds)
+        print u"{}: {} microseconds per abstract".format(name, round(per_abstract * 1000000, 2))
@@ -0,0 +1,328 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# times building Annotation objects and reading the fields a search response
+# reads from them (suppress, image_url, topic_score, picture_score, dicts), on
+# synthetic dandelion annotations using the uris from entities.tsv, the old
+# way (every rule re-run in a property on each read) against Annotation, and
+# checks they give the same fields and dicts.  exits nonzero on any mismatch.
+#
+# usage:
+# python benchmark_annotations.py --annotations 200 --rounds 200
+
+import argparse
+import random
+import sys
+from time import time
+
+from annotation import Annotation
+from annotation import annotation_file_contents
+from annotation import annotation_blacklist
+from annotation import annotation_requires_exact_match
+from annotation import image_blacklist
+from annotation import spot_requires_exact_match
+
+dbpedia_types = [
+    "http://dbpedia.org/ontology/Location",
+    "http://dbpedia.org/ontology/Species",
+    "http://dbpedia.org/ontology/AnatomicalStructure",
+    "http://dbpedia.org/ontology/Biomolecule",
+    "http://dbpedia.org/ontology/ChemicalSubstance",
+    "http://dbpedia.org/ontology/Food",
+    "http://dbpedia.org/ontology/Disease",
+    "http://dbpedia.org/ontology/Person",
+]
+
+
+class LegacyAnnotation(object):
+    # the Annotation class as it was before its rules were evaluated once at construction
+
+    def __init__(self, dandelion_raw):
+        self.dandelion_raw = dandelion_raw
+        self.is_top_entity = False
+        self.top_entity_score = 0
+        self.annotation_distribution = None
+
+    @property
+    def uri(self):
+        return self.dandelion_raw["uri"]
+
+    @property
+    def start(self):
+        return self.dandelion_raw["start"]
+
+    @property
+    def end(self):
+        return self.dandelion_raw["end"]
+
+    @property
+    def spot(self):
+        return self.dandelion_raw["spot"]
+
+    @property
+    def types(self):
+        return self.dandelion_raw["types"]
+
+    @property
+    def confidence(self):
+        return self.dandelion_raw["confidence"]
+
+    @property
+    def title(self):
+        return self.dandelion_raw["title"]
+
+    @property
+    def in_image_blacklist(self):
+        uri_name_for_matching = self.uri.lower().rsplit("/", 1)[1]
+        if uri_name_for_matching in image_blacklist:
+            return True
+        return False
+
+    @property
+    def suppress(self):
+        uri_name_for_matching = self.uri.lower().rsplit("/", 1)[1]
+        spot_for_matching = self.spot.lower()
+
+        if uri_name_for_matching in annotation_blacklist:
+            return True
+
+        if uri_name_for_matching in annotation_requires_exact_match:
+            if uri_name_for_matching != spot_for_matching:
+                return True
+
+        if self.spot in spot_requires_exact_match:
+            if uri_name_for_matching.replace("_", " ") != spot_for_matching:
+                return True
+
+        if "http://dbpedia.org/ontology/Person" in self.types:
+            return True
+
+        return False
+
+    @property
+    def image_url(self):
+        if self.suppress:
+            return False
+
+        if self.in_image_blacklist:
+            return False
+
+        if annotation_file_contents.get(self.uri, None):
+            if annotation_file_contents[self.uri]["alt_img"]:
+                return annotation_file_contents[self.uri]["alt_img"]
+
+        if "image" in self.dandelion_raw and self.dandelion_raw["image"]:
+            return self.dandelion_raw["image"]["full"]
+        else:
+            return None
+
+    @property
+    def topic_score(self):
+        score = self.top_entity_score
+
+        if self.suppress:
+            return -1000
+
+        if self.in_image_blacklist:
+            return -1000
+
+        if "sex" in self.title.lower():
+            score -= 2
+
+        if "urinart" in self.title.lower() or "urolog" in self.title.lower() or\
+                "genital" in self.spot.lower() or "genital" in self.title.lower():
+            score -= 2
+
+        if "http://dbpedia.org/ontology/Location" in self.types and self.title not in ["Ancient Egypt"]:
+            score += 2
+
+        if "http://dbpedia.org/ontology/Species" in self.types and self.title not in ["Rat", "Mouse"]:
+            score += 2
+
+        if "http://dbpedia.org/ontology/AnatomicalStructure" in self.types:
+            score += 1
+
+        if "http://dbpedia.org/ontology/Biomolecule" in self.types:
+            score += 0.8
+
+        if "http://dbpedia.org/ontology/ChemicalSubstance" in self.types:
+            score += 0.6
+
+        if "http://dbpedia.org/ontology/Food" in self.types:
+            score += 0.8
+
+        if "http://dbpedia.org/ontology/SportsTeam" in self.types:
+            score -= 1
+
+        if "http://dbpedia.org/ontology/TelevisionEpisode" in self.types:
+            score -= 10
+
+        if "http://dbpedia.org/ontology/TelevisionShow" in self.types:
+            score -= 10
+
+        if self.spot.lower() == "activity" and self.title.lower() == "physical exercise":
+            score -= 10
+
+        if self.spot.lower() == "origins" and self.title.lower() == "fibonacci number":
+            score -= 10
+
+        if self.spot.lower() == "ages" and self.title.lower() == "ageing":
+            score -= 10
+
+        if self.confidence <= 0.65:
+            score -= 10
+
+        if self.confidence < 0.7 and self.spot.lower() != self.title.lower():
+            score -= 2
+
+        score += 0.2 * self.confidence
+
+        return score
+
+    @property
+    def picture_score(self):
+        score = self.topic_score
+
+        if annotation_file_contents.get(self.uri, None):
+            if annotation_file_contents[self.uri]["bad_image_reason"]:
+                return -1000
+
+        if not self.image_url:
+            return -1000
+
+        if annotation_file_contents.get(self.uri, None) and annotation_file_contents[self.uri]["weight"]:
+            score *= float(annotation_file_contents[self.uri]["weight"])
+
+        if hasattr(self, "annotation_distribution") and self.annotation_distribution:
+            score += 0.3 * (1 - self.annotation_distribution[self.image_url])
+
+        return score
+
+    def to_dict_metadata(self):
+        if not self.dandelion_raw:
+            return []
+
+        raw_annotation = self.dandelion_raw
+        response = {}
+        keep_keys = [
+            "id",
+            "title",
+            "uri",
+            "abstract",
+            "label"
+        ]
+        for key in raw_annotation.keys():
+            if key in keep_keys:
+                response[key] = raw_annotation[key]
+
+        response["image_url"] = self.image_url
+
+        return response
+
+    def to_dict_simple(self):
+        if not self.dandelion_raw:
+            return []
+
+        raw_annotation = self.dandelion_raw
+        response = {}
+        keep_keys = [
+            "start",
+            "end",
+            "confidence",
+            "title",
+            "spot",
+        ]
+        for key in raw_annotation.keys():
+            if key in keep_keys:
+                response[key] = raw_annotation[key]
+
+        response["image_url"] = self.image_url
+
+        return response
+
+
+def synthetic_dandelion_annotations(n):
+    uris = sorted(annotation_file_contents.keys()) + [u"http://en.wikipedia.org/wiki/Film_editing", u"http://en.wikipedia.org/wiki/Chemotherapy"]
+    random.seed(0)
+    response = []
+    for i in range(n):
+        uri = random.choice(uris)
+        title = uri.rsplit("/", 1)[1].replace("_", " ")
+        response.append({
+            "id": i,
+            "uri": uri,
+            "title": title,
+            "label": title,
+            "spot": random.choice([title.lower(), u"treatment", u"ages"]),
+            "start": i * 10,
+            "end": i * 10 + 8,
+            "confidence": random.random(),
+            "types": random.sample(dbpedia_types, random.randint(0, 3)),
+            "image": random.choice([None, {"full": u"https://example.com/{}.png".format(i)}]),
+            "abstract": u"an abstract"
+        })
+    return response
+
+
+compared_fields = ["uri", "start", "end", "spot", "types", "confidence", "title",
+                   "suppress", "in_image_blacklist", "image_url", "topic_score", "picture_score"]
+
+
+def count_mismatches(raw_annotations):
+    distribution = dict((LegacyAnnotation(raw).image_url, random.random()) for raw in raw_annotations)
+    mismatches = 0
+    for raw in raw_annotations:
+        expected = LegacyAnnotation(raw)
+        got = Annotation(raw)
+        top_entity_score = random.choice([0, random.random()])
+        for my_annotation in [expected, got]:
+            my_annotation.top_entity_score = top_entity_score
+            my_annotation.annotation_distribution = random.choice([None, distribution])
+        # the same distribution for both
+        got.annotation_distribution = expected.annotation_distribution
+        for field in compared_fields:
+            if getattr(expected, field) != getattr(got, field):
+                mismatches += 1
+                print u"MISMATCH: {} is {} vs {} for {}".format(field, getattr(expected, field), getattr(got, field), raw["uri"])
+        if expected.to_dict_simple() != got.to_dict_simple() or expected.to_dict_metadata() != got.to_dict_metadata():
+            mismatches += 1
+            print u"MISMATCH: dicts differ for {}".format(raw["uri"])
+    return mismatches
+
+
+def run_benchmark(annotation_class, raw_annotations, rounds):
+    distribution = {}
+    start = time()
+    for i in range(rounds):
+        annotations = [annotation_class(raw) for raw in raw_annotations]
+        for my_annotation in annotations:
+            my_annotation.top_entity_score = 0.5
+            my_annotation.annotation_distribution = distribution
+        # roughly what one response does with each annotation
+        for my_annotation in annotations:
+            if not my_annotation.suppress:
+                my_annotation.image_url
+                my_annotation.topic_score
+                my_annotation.picture_score
+                my_annotation.picture_score
+                my_annotation.image_url
+                my_annotation.to_dict_simple()
+                my_annotation.to_dict_metadata()
+    return (time() - start) / (rounds * len(raw_annotations))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time Annotation processing.")
+    parser.add_argument('--annotations', nargs="?", type=int, default=200, help="annotations per abstract")
+    parser.add_argument('--rounds', nargs="?", type=int, default=200, help="how many abstracts")
+    parsed_args = parser.parse_args()
+
+    raw_annotations = synthetic_dandelion_annotations(parsed_args.annotations)
+    mismatches = count_mismatches(raw_annotations)
+    print u"{} annotations, {} mismatches".format(len(raw_annotations), mismatches)
+
+    for (name, annotation_class) in [("legacy", LegacyAnnotation), ("Annotation", Annotation)]:
+        per_annotation = run_benchmark(annotation_class, raw_annotations, parsed_args.rounds)
+        print u"{}: {} microseconds per annotation".format(name, round(per_annotation * 1000000, 2))
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,70 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# times the local gazetteer annotator on stored abstracts, and compares what
+# it finds with the annotations dandelion stored for them (not ones the
+# gazetteer wrote itself, which would just match).  needs
+# DATABASE_URL and a gazetteer from build_gazetteer.py.
+#
+# usage:
+# python benchmark_gazetteer.py --limit 1000
+
+import argparse
+import json
+from time import time
+from sqlalchemy import sql
+
+from app import db
+from annotation_list import AnnotationList
+from annotators import GazetteerAnnotator
+
+
+def annotation_keys(dandelion_results):
+    return set([(a.start, a.end, a.uri) for a in AnnotationList(dandelion_results).list()])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the gazetteer annotator against stored dandelion annotations.")
+    parser.add_argument('--limit', nargs="?", type=int, default=1000, help="abstracts to annotate")
+    parser.add_argument('--gazetteer', nargs="?", type=str, default="gazetteer.json", help="gazetteer path")
+    parsed_args = parser.parse_args()
+
+    query_string = u"""
+        select pmid, dandelion_raw_abstract_text
+        from dandelion_by_doi
+        where dandelion_raw_abstract_text is not null
+        and dandelion_raw_abstract_text != 'null'
+        and coalesce(dandelion_raw_abstract_text::jsonb->>'annotator', '') <> 'gazetteer'
+        and pmid is not null
+        limit :limit
+        """
+    dandelion_rows = db.engine.execute(sql.text(query_string), limit=parsed_args.limit).fetchall()
+    query_string = u"select pmid, abstract_text from medline_citation where pmid = any(:pmids) and abstract_text is not null"
+    abstracts_by_pmid = dict((int(row[0]), row[1]) for row in db.engine.execute(
+        sql.text(query_string), pmids=[int(row[0]) for row in dandelion_rows]))
+    rows = [(abstracts_by_pmid[int(pmid)], dandelion_raw) for (pmid, dandelion_raw) in dandelion_rows
+            if int(pmid) in abstracts_by_pmid]
+    abstracts = [row[0] for row in rows]
+
+    my_annotator = GazetteerAnnotator(parsed_args.gazetteer)
+    my_annotator._load()
+
+    start = time()
+    gazetteer_results = my_annotator.annotate_texts(abstracts)
+    seconds = time() - start
+    print u"{} abstracts in {}s, {} abstracts/second".format(
+        len(abstracts), round(seconds, 2), int(len(abstracts) / max(seconds, 0.001)))
+
+    num_both = 0
+    num_gazetteer = 0
+    num_dandelion = 0
+    for (row, my_results) in zip(rows, gazetteer_results):
+        gazetteer_keys = annotation_keys(my_results)
+        dandelion_keys = annotation_keys(json.loads(row[1]))
+        num_both += len(gazetteer_keys & dandelion_keys)
+        num_gazetteer += len(gazetteer_keys)
+        num_dandelion += len(dandelion_keys)
+    print u"of the annotations shown, {} from the gazetteer, {} from dandelion, {} the same".format(
+        num_gazetteer, num_dandelion, num_both)
+    print u"precision against dandelion {}, recall {}".format(
+        round(float(num_both) / max(num_gazetteer, 1), 3), round(float(num_both) / max(num_dandelion, 1), 3))
@@ -0,0 +1,61 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# times loading and serializing a page of pubs for a full search response
+# against a minimum=true one, with the number of sql queries each makes.
+# needs DATABASE_URL.  no live dandelion calls are made in either mode.
+#
+# usage:
+# python benchmark_minimum_mode.py --pagesize 100 --rounds 5
+
+import argparse
+from time import time
+from sqlalchemy import orm
+from sqlalchemy import sql
+
+from app import db
+from app import reset_query_count
+from app import get_query_count
+from pub import PubDoi
+from pub import load_minimal_pubs
+from pub_list import PubList
+
+
+def full_page(dois):
+    my_pubs = db.session.query(PubDoi).filter(PubDoi.doi.in_(dois)).options(orm.undefer_group('full')).all()
+    my_pub_list = PubList(pubs=my_pubs)
+    my_pub_list.set_pubmed_lookups()
+    my_pub_list.set_pictures()
+    return (my_pub_list.to_dict_serp_list(full=True), my_pub_list.to_dict_annotation_metadata())
+
+
+def minimum_page(dois):
+    my_pub_list = PubList(pubs=load_minimal_pubs(dois))
+    return my_pub_list.to_dict_serp_list(full=False)
+
+
+def run_benchmark(page_function, dois, rounds):
+    total_seconds = 0
+    total_queries = 0
+    for i in range(rounds):
+        db.session.expunge_all()
+        reset_query_count()
+        start = time()
+        page_function(dois)
+        total_seconds += time() - start
+        total_queries += get_query_count()
+    return (total_seconds / rounds, total_queries / rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time full against minimum search responses.")
+    parser.add_argument('--pagesize', nargs="?", type=int, default=100, help="pubs per page")
+    parser.add_argument('--rounds', nargs="?", type=int, default=5, help="times to build each page")
+    parsed_args = parser.parse_args()
+
+    query_string = u"select doi from ricks_gtr_sort_results where pmid is not null order by num_events desc limit :pagesize"
+    dois = [row[0] for row in db.engine.execute(sql.text(query_string), pagesize=parsed_args.pagesize)]
+
+    for (name, page_function) in [("full", full_page), ("minimum", minimum_page)]:
+        (seconds, queries) = run_benchmark(page_function, dois, parsed_args.rounds)
+        print u"{}: {} seconds, {} queries for {} pubs".format(name, round(seconds, 3), queries, len(dois))
@@ -27,3 +27,35 @@ CREATE INDEX search_titles_mv_is_oa_num_events_idx ON search_titles_mv (is_oa, n
 vacuum analyze search_titles_mv
 
 
+
+
+create table dandelion_annotation_cache (
+content_hash text primary key,
+created timestamp,
+annotations_compressed bytea)
+
+
+-- stored tsvector for title search, so it isn't recomputed per row on every query.
+-- needs postgres 12+ for generated columns.  search.py queries article_title_tsv directly.
+alter table ricks_gtr_sort_results add column article_title_tsv tsvector
+    generated always as (to_tsvector('english', article_title)) stored;
+create index ricks_gtr_sort_results_article_title_tsv_idx on ricks_gtr_sort_results using gin(article_title_tsv);
+vacuum analyze ricks_gtr_sort_results
+
+
+-- cached_entity_response, already serialized and compressed.  one row per entity
+-- and oa flag; brotli_body is null unless the writer had the brotli module.
+create table cached_entity_response_body (
+entity_title text,
+oa_only boolean,
+collected timestamp,
+json_body bytea,
+gzip_body bytea,
+brotli_body bytea,
+primary key (entity_title, oa_only))
+
+
+-- entity search: the top papers for one entity title by num_events, see
+-- search.entity_candidates_query.  check_search_plans.py checks it's used.
+create index search_title_dandelion_simple_mv_title_num_events_idx on search_title_dandelion_simple_mv (title, num_events);
+vacuum analyze search_title_dandelion_simple_mv
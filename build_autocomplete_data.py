@@ -1,32 +1,69 @@
 #!/usr/local/bin/python
 # -*- coding: utf-8 -*-
 
+import argparse
+import os
+from collections import defaultdict
 from sqlalchemy import sql
 import json
 
 from app import db
+from autocomplete_index import default_autocomplete_index_path
+from entity import entity_aliases
 
+# writes the artifact the web workers build their autocomplete index and
+# query entity aliases from, see autocomplete_index.py.  workers pick up a
+# rebuilt artifact on their own.
+#
 # refresh materialized view first:
 # refresh materialized view concurrently search_autocomplete_dandelion_simple_mv
+#
+# usage:
+# python build_autocomplete_data.py --output autocomplete_index.json
 
-query_string = u"""
-    select entity_title, sum_num_events, num_papers
-    from search_autocomplete_dandelion_simple_mv
-    where num_papers >= 25
-    order by sum_num_events desc
-    """
-# print query_string
-rows = db.engine.execute(sql.text(query_string)).fetchall()
-print "done getting query"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the autocomplete index artifact.")
+    parser.add_argument('--output', nargs="?", type=str, default=default_autocomplete_index_path or "autocomplete_index.json",
+                        help="where to write it; defaults to AUTOCOMPLETE_INDEX_PATH")
+    parser.add_argument('--skip-alternate-labels', action="store_true", help="only singular and plural aliases")
+    parsed_args = parser.parse_args()
 
+    query_string = u"""
+        select entity_title, sum_num_events, num_papers
+        from search_autocomplete_dandelion_simple_mv
+        where num_papers >= 25
+        order by sum_num_events desc
+        """
+    # print query_string
+    rows = db.engine.execute(sql.text(query_string)).fetchall()
+    print "done getting query"
 
-entity_titles = [row[0] for row in rows]
-print "number entities: {}".format(len(entity_titles))
 
-ordered_autocomplete_dicts = [
-    {"lower": e.lower(), "value": e} for e in entity_titles if e
-]
+    entity_titles = [row[0] for row in rows]
+    print "number entities: {}".format(len(entity_titles))
 
-f = open("/Users/hpiwowar/Dropbox/ti/data/gtr_autocomplete.json", "w")
-f.writelines(json.dumps(ordered_autocomplete_dicts, indent=4))
-f.close()
+    # dandelion's alternate labels for these entities, from the title annotations we've stored
+    query_string = u"""
+        select distinct annotation->>'title' as entity_title, alternate_label
+        from dandelion_by_doi,
+            jsonb_array_elements(case when jsonb_typeof(dandelion_raw_article_title->'annotations') = 'array'
+                then dandelion_raw_article_title->'annotations' else '[]'::jsonb end) annotation,
+            jsonb_array_elements_text(case when jsonb_typeof(annotation->'alternateLabels') = 'array'
+                then annotation->'alternateLabels' else '[]'::jsonb end) alternate_label
+        """
+    alternate_labels = defaultdict(list)
+    if not parsed_args.skip_alternate_labels:
+        for row in db.engine.execute(sql.text(query_string)):
+            alternate_labels[row[0]].append(row[1])
+        print "done getting alternate labels for {} entities".format(len(alternate_labels))
+
+    ordered_autocomplete_dicts = [
+        {"lower": e.lower(), "value": e, "aliases": entity_aliases(e, alternate_labels.get(e))} for e in entity_titles if e
+    ]
+
+    # write then rename, so a worker never loads half a file
+    temp_path = parsed_args.output + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(ordered_autocomplete_dicts, f, separators=(",", ":"))
+    os.rename(temp_path, parsed_args.output)
+    print "wrote {}".format(parsed_args.output)
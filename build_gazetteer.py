@@ -0,0 +1,117 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import re
+import json
+from collections import defaultdict
+from sqlalchemy import sql
+
+from app import db
+from annotation import annotation_file_contents
+from entity import stop_words
+
+# writes the gazetteer the local annotator matches against, see
+# annotators.GazetteerAnnotator: every spot dandelion has linked in the
+# titles and abstracts in dandelion_by_doi, with the entity it linked it to
+# most often, plus the titles in entities.tsv.  rows the gazetteer annotated
+# itself (save_annotations.py --annotator gazetteer) are left out, so a rebuild
+# only learns from dandelion.
+#
+# usage:
+# python build_gazetteer.py --output gazetteer.json --min-count 3
+
+stored_annotations_cte = u"""
+    with stored_annotations as (
+        select annotation
+        from dandelion_by_doi,
+            jsonb_array_elements(case when jsonb_typeof(dandelion_raw_article_title->'annotations') = 'array'
+                then dandelion_raw_article_title->'annotations' else '[]'::jsonb end) annotation
+        where coalesce(dandelion_raw_article_title->>'annotator', '') <> 'gazetteer'
+        union all
+        select annotation
+        from dandelion_by_doi,
+            jsonb_array_elements(case when jsonb_typeof(dandelion_raw_abstract_text::jsonb->'annotations') = 'array'
+                then dandelion_raw_abstract_text::jsonb->'annotations' else '[]'::jsonb end) annotation
+        where coalesce(dandelion_raw_abstract_text::jsonb->>'annotator', '') <> 'gazetteer'
+    )
+    """
+
+word_char_pattern = re.compile(ur"\w", re.UNICODE)
+
+
+def usable_spot(spot):
+    # the annotator matches whole words, and short or stop word spots are mostly noise
+    if len(spot) < 3 or spot in stop_words or spot.isdigit():
+        return False
+    return bool(word_char_pattern.match(spot[0]) and word_char_pattern.match(spot[-1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the gazetteer for the local annotator.")
+    parser.add_argument('--output', nargs="?", type=str, default=os.getenv("GAZETTEER_PATH", "gazetteer.json"),
+                        help="where to write it; defaults to GAZETTEER_PATH")
+    parser.add_argument('--min-count', nargs="?", type=int, default=3, help="spots linked fewer times than this are left out")
+    parser.add_argument('--tsv-confidence', nargs="?", type=float, default=0.6,
+                        help="confidence for entities.tsv titles dandelion hasn't linked")
+    parsed_args = parser.parse_args()
+
+    # how often each spot was linked to each entity, and how confidently
+    query_string = stored_annotations_cte + u"""
+        select lower(annotation->>'spot') as spot, annotation->>'uri' as uri,
+            count(*) as n, avg((annotation->>'confidence')::float) as confidence
+        from stored_annotations
+        group by 1, 2
+        having count(*) >= :min_count
+        """
+    rows = db.engine.execute(sql.text(query_string), min_count=parsed_args.min_count).fetchall()
+    print "done getting spots: {} spot and entity pairs".format(len(rows))
+
+    spot_totals = defaultdict(int)
+    best_for_spot = {}
+    for (spot, uri, n, confidence) in rows:
+        if not spot or not uri or not usable_spot(spot):
+            continue
+        spot_totals[spot] += n
+        if spot not in best_for_spot or n > best_for_spot[spot][1]:
+            best_for_spot[spot] = (uri, n, confidence)
+
+    # what dandelion says about each entity, without the parts about one mention
+    query_string = stored_annotations_cte + u"""
+        select distinct on (annotation->>'uri') annotation->>'uri' as uri,
+            annotation - 'start' - 'end' - 'spot' - 'confidence' as entity
+        from stored_annotations
+        where annotation->>'uri' = any(:uris)
+        order by annotation->>'uri'
+        """
+    uris = list(set([uri for (uri, n, confidence) in best_for_spot.values()]))
+    entities = {}
+    for (uri, entity) in db.engine.execute(sql.text(query_string), uris=uris):
+        entities[uri] = entity
+    print "done getting {} entities".format(len(entities))
+
+    spots = []
+    for (spot, (uri, n, confidence)) in best_for_spot.iteritems():
+        if uri in entities:
+            # a spot that means different things in different papers is less certain here
+            spots.append([spot, uri, round(confidence * n / spot_totals[spot], 3)])
+
+    spots_seen = set(best_for_spot.keys())
+    for (uri, file_entry) in annotation_file_contents.iteritems():
+        spot = file_entry["annotation_title"].lower()
+        if spot in spots_seen or not usable_spot(spot):
+            continue
+        if uri not in entities:
+            entities[uri] = {"uri": uri, "title": file_entry["annotation_title"], "types": []}
+        spots.append([spot, uri, parsed_args.tsv_confidence])
+        spots_seen.add(spot)
+
+    print "number spots: {}, number entities: {}".format(len(spots), len(entities))
+
+    # write then rename, so nobody loads half a file
+    temp_path = parsed_args.output + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"spots": sorted(spots), "entities": entities}, f, separators=(",", ":"))
+    os.rename(temp_path, parsed_args.output)
+    print "wrote {}".format(parsed_args.output)
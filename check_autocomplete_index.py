@@ -0,0 +1,57 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# compares the in-memory autocomplete index against the database query it
+# replaces, for one to three letter prefixes and a sample of longer ones,
+# and times both.  needs DATABASE_URL and a built artifact; titles with equal
+# sum_num_events can come back in either order, so those lists are compared
+# as sets.
+#
+# usage:
+# python build_autocomplete_data.py
+# python check_autocomplete_index.py --sample 500
+
+import argparse
+import random
+import string
+from time import time
+
+from autocomplete_index import autocomplete_index
+from search import autocomplete_entity_titles_from_db
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the autocomplete index against the database.")
+    parser.add_argument('--sample', nargs="?", type=int, default=500, help="longer prefixes to check")
+    parsed_args = parser.parse_args()
+
+    if not autocomplete_index or not autocomplete_index.is_loaded():
+        print "no autocomplete index; run build_autocomplete_data.py first"
+        exit(1)
+
+    titles = autocomplete_index._index["titles"]
+    queries = list(string.ascii_lowercase)
+    for title in random.sample(titles, min(100, len(titles))):
+        queries += [title[0:2], title[0:3]]
+    for title in random.sample(titles, min(parsed_args.sample, len(titles))):
+        queries.append(title[0:random.randint(3, max(3, len(title)))])
+
+    num_mismatches = 0
+    index_seconds = 0
+    db_seconds = 0
+    for query in queries:
+        start = time()
+        index_results = autocomplete_index.autocomplete(query)
+        index_seconds += time() - start
+
+        start = time()
+        db_results = autocomplete_entity_titles_from_db(query)
+        db_seconds += time() - start
+
+        if index_results != db_results and set(index_results) != set(db_results):
+            num_mismatches += 1
+            print u"mismatch for {}: index {}, db {}".format(query, index_results, db_results)
+
+    print u"{} queries, {} mismatches".format(len(queries), num_mismatches)
+    print u"index: {}µs per query, db: {}ms per query".format(
+        round(1000000 * index_seconds / len(queries), 1), round(1000 * db_seconds / len(queries), 2))
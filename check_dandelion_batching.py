@@ -0,0 +1,123 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# checks that pub.split_batched_dandelion_results gives each text of a packed
+# request the same annotations it would get sent on its own.  a fake dandelion
+# links every vocabulary spot it finds, so the answer for the joined text and
+# for each text alone can be compared exactly; no database or api calls.
+# exits nonzero on any mismatch.
+#
+# usage:
+# python check_dandelion_batching.py --rounds 500
+
+import argparse
+import random
+import sys
+
+from pub import dandelion_batch_separator
+from pub import pack_dandelion_batches
+from pub import split_batched_dandelion_results
+
+
+# spot -> uri.  the last one can only be found across a separator, so the
+# split has to drop it.
+vocabulary = {
+    u"aspirin": u"http://en.wikipedia.org/wiki/Aspirin",
+    u"stroke": u"http://en.wikipedia.org/wiki/Stroke",
+    u"β-blocker": u"http://en.wikipedia.org/wiki/Beta_blocker",
+    u"Guillain–Barré syndrome": u"http://en.wikipedia.org/wiki/Guillain%E2%80%93Barr%C3%A9_syndrome",
+    u"café au lait": u"http://en.wikipedia.org/wiki/Caf%C3%A9_au_lait_spot",
+    u"trial" + dandelion_batch_separator + u"aspirin": u"http://en.wikipedia.org/wiki/Spanning_spot"
+}
+text_spots = [u"aspirin", u"stroke", u"β-blocker", u"Guillain–Barré syndrome", u"café au lait"]
+filler_words = [u"the", u"of", u"in", u"patients", u"with", u"naïve", u"über", u"trial", u"—", u"10µg", u"and"]
+
+
+def fake_dandelion(text):
+    annotations = []
+    for (spot, uri) in sorted(vocabulary.items()):
+        start = text.find(spot)
+        while start >= 0:
+            annotations.append({
+                "start": start,
+                "end": start + len(spot),
+                "spot": spot,
+                "uri": uri,
+                "title": uri.rsplit(u"/", 1)[-1],
+                "confidence": 0.8
+            })
+            start = text.find(spot, start + 1)
+    annotations.sort(key=lambda a: (a["start"], a["end"]))
+    # scores depend on the whole request, so only the uris are compared
+    uris = sorted(set([a["uri"] for a in annotations]))
+    top_entities = [{"uri": uri, "score": 1.0} for uri in uris]
+    return {"annotations": annotations, "topEntities": top_entities, "lang": "en", "timestamp": "2017-01-01T00:00:00"}
+
+
+def random_text():
+    words = [random.choice(filler_words + text_spots) for i in range(random.randint(1, 30))]
+    text = u" ".join(words)
+    # annotations right at the edges are the ones a bad rebase gets wrong
+    if random.random() < 0.3:
+        text = u"aspirin " + text
+    if random.random() < 0.3:
+        text += u" stroke"
+    if random.random() < 0.2:
+        text += u" trial"
+    if random.random() < 0.2:
+        text = u"aspirin" + text
+    return text
+
+
+def packed_results(texts):
+    # joins the texts the way call_dandelion_batch does
+    segment_starts = []
+    segment_ends = []
+    cursor = 0
+    for text in texts:
+        segment_starts.append(cursor)
+        cursor += len(text)
+        segment_ends.append(cursor)
+        cursor += len(dandelion_batch_separator)
+    joined_text = dandelion_batch_separator.join(texts)
+    return split_batched_dandelion_results(fake_dandelion(joined_text), segment_starts, segment_ends)
+
+
+def mismatch(text, alone, packed):
+    if [a for a in packed["annotations"] if text[a["start"]:a["end"]] != a["spot"]]:
+        return u"spot not at its start and end"
+    if alone["annotations"] != packed["annotations"]:
+        return u"annotations differ"
+    if [e["uri"] for e in alone["topEntities"]] != [e["uri"] for e in packed["topEntities"]]:
+        return u"topEntities differ"
+    if alone["lang"] != packed["lang"] or alone["timestamp"] != packed["timestamp"]:
+        return u"other fields differ"
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check packed dandelion requests split back into per-text results.")
+    parser.add_argument('--rounds', nargs="?", type=int, default=500, help="how many batches")
+    parser.add_argument('--texts', nargs="?", type=int, default=12, help="texts per round")
+    parser.add_argument('--max-chars', nargs="?", type=int, default=400, help="batch size, small so rounds pack into several")
+    parsed_args = parser.parse_args()
+
+    mismatches = 0
+    num_batches = 0
+    num_annotations = 0
+    for round_number in range(parsed_args.rounds):
+        texts = [random.choice([None, u""]) if random.random() < 0.2 else random_text() for i in range(parsed_args.texts)]
+        for batch in pack_dandelion_batches(texts, parsed_args.max_chars):
+            num_batches += 1
+            batch_texts = [texts[i] for i in batch]
+            for (text, packed) in zip(batch_texts, packed_results(batch_texts)):
+                alone = fake_dandelion(text)
+                num_annotations += len(alone["annotations"])
+                problem = mismatch(text, alone, packed)
+                if problem:
+                    mismatches += 1
+                    print u"MISMATCH: {} for {!r}\n  alone:  {}\n  packed: {}".format(problem, text, alone, packed)
+
+    print u"{} batches, {} annotations, {} mismatches".format(num_batches, num_annotations, mismatches)
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,57 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# builds search results for pages of pubs the way /search does (without live
+# dandelion calls) and exits nonzero if the number of sql queries grows with
+# the number of pubs, or goes over --max-queries.  catches N+1 lazy loads
+# like the one pubmed_lookup used to do for every result.
+#
+# usage:
+# python check_query_counts.py --max-queries 8
+
+import argparse
+import sys
+from sqlalchemy import orm
+from sqlalchemy import sql
+
+from app import db
+from app import reset_query_count
+from app import get_query_count
+from pub import PubDoi
+from pub_list import PubList
+
+
+def queries_for_page(dois):
+    db.session.expunge_all()
+    reset_query_count()
+    my_pubs = db.session.query(PubDoi).filter(PubDoi.doi.in_(dois)).options(orm.undefer_group('full')).all()
+    my_pub_list = PubList(pubs=my_pubs)
+    my_pub_list.set_pubmed_lookups()
+    my_pub_list.set_pictures()
+    my_pub_list.to_dict_serp_list(full=True)
+    my_pub_list.to_dict_annotation_metadata()
+    return get_query_count()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check search result building doesn't do a query per pub.")
+    parser.add_argument('--max-queries', nargs="?", type=int, default=8, help="most queries allowed for a page")
+    parsed_args = parser.parse_args()
+
+    query_string = u"select doi from ricks_gtr_sort_results where pmid is not null limit 100"
+    dois = [row[0] for row in db.engine.execute(sql.text(query_string))]
+    if len(dois) < 100:
+        print u"need at least 100 pubs with pmids, found {}".format(len(dois))
+        sys.exit(1)
+
+    small_page_queries = queries_for_page(dois[0:10])
+    large_page_queries = queries_for_page(dois)
+    print u"queries for 10 pubs: {}, for 100 pubs: {}".format(small_page_queries, large_page_queries)
+
+    if large_page_queries > small_page_queries:
+        print u"FAIL: queries grow with the number of pubs"
+        sys.exit(1)
+    if large_page_queries > parsed_args.max_queries:
+        print u"FAIL: more than {} queries".format(parsed_args.max_queries)
+        sys.exit(1)
+    print u"ok"
@@ -0,0 +1,71 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# checks that search.adjusted_scores (the batch, numpy one) gives exactly the same
+# scores as search.adjusted_score on randomly generated candidate rows, and
+# prints how long each takes.  exits nonzero on any mismatch.
+#
+# usage:
+# python check_scoring_parity.py --rows 120 --rounds 200
+
+import argparse
+import decimal
+import random
+import sys
+from time import time
+
+from pub import pub_type_data
+from search import adjusted_score
+from search import adjusted_scores
+
+
+def random_pub_types():
+    labels = [name for (name, label, val) in pub_type_data] + ["Journal Article", "English Abstract", "Research Support, N.I.H."]
+    my_labels = random.sample(labels, random.randint(0, 4))
+    # the column is comma-joined text; lists are here to exercise the label lookups too
+    return random.choice([None, "", u",".join(my_labels), my_labels])
+
+
+def random_row(query_entities):
+    article_title = random.choice([None, u"", u"Effects of aspirin", u"Aspirin (ASA) and stroke", u"Frog (FROGS) populations"])
+    return {
+        "score": random.choice([None, 0, random.random(), random.random() * 5]),
+        "abstract_length": random.choice([None, decimal.Decimal(0), decimal.Decimal(5), decimal.Decimal(random.randint(10, 3000))]),
+        "num_events": random.choice([None, decimal.Decimal(0), decimal.Decimal(random.randint(1, 500))]),
+        "num_news_events": random.choice([None, decimal.Decimal(0), decimal.Decimal(random.randint(1, 50))]),
+        "pub_types": random_pub_types(),
+        "article_title": article_title,
+        "query_entities": query_entities
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check adjusted_scores matches adjusted_score.")
+    parser.add_argument('--rows', nargs="?", type=int, default=120, help="candidates per search")
+    parser.add_argument('--rounds', nargs="?", type=int, default=200, help="how many searches")
+    parsed_args = parser.parse_args()
+
+    mismatches = 0
+    scalar_elapsed = 0
+    batch_elapsed = 0
+    for round_number in range(parsed_args.rounds):
+        query_entities = random.choice([None, [], [u"asa"], [u"frogs", u"asa"]])
+        rows = [random_row(query_entities) for i in range(parsed_args.rows)]
+
+        start = time()
+        scalar_scores = [adjusted_score(row) for row in rows]
+        scalar_elapsed += time() - start
+
+        start = time()
+        batch_scores = adjusted_scores(rows)
+        batch_elapsed += time() - start
+
+        for (row, scalar_score, batch_score) in zip(rows, scalar_scores, batch_scores):
+            if scalar_score != batch_score:
+                mismatches += 1
+                print u"MISMATCH: {} vs {} for {}".format(scalar_score, batch_score, row)
+
+    print u"{} rounds of {} rows: scalar {}s, batch {}s, {} mismatches".format(
+        parsed_args.rounds, parsed_args.rows, round(scalar_elapsed, 4), round(batch_elapsed, 4), mismatches)
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,129 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+# runs EXPLAIN on the search queries and exits nonzero if they've stopped using
+# their indexes, for example because the sql no longer matches the indexed column.
+# point DATABASE_URL at a local postgres; --setup-fixture creates a small
+# ricks_gtr_sort_results and search_title_dandelion_simple_mv there with the
+# same columns and indexes as bq.sql.
+#
+# usage:
+# DATABASE_URL=postgres://localhost/gtr_fixture python check_search_plans.py --setup-fixture
+
+import argparse
+import json
+import sys
+from sqlalchemy import sql
+
+from app import db
+from search import doi_candidates_query
+from search import entity_candidates_query
+from search import title_candidates_query
+
+
+fixture_sql = u"""
+    create table if not exists ricks_gtr_sort_results (
+        doi text primary key,
+        pmid text,
+        article_title text,
+        journal_title text,
+        is_oa boolean,
+        abstract_length numeric,
+        num_events numeric,
+        num_news_events numeric,
+        pub_types text,
+        genre text,
+        published_date timestamp,
+        article_title_tsv tsvector generated always as (to_tsvector('english', article_title)) stored
+    );
+    create index if not exists ricks_gtr_sort_results_article_title_tsv_idx on ricks_gtr_sort_results using gin(article_title_tsv);
+    insert into ricks_gtr_sort_results (doi, pmid, article_title, is_oa, abstract_length, num_events)
+        select '10.1234/fixture.' || i, i::text, 'fixture title ' || i || case when i % 10 = 0 then ' aspirin' else '' end, i % 2 = 0, 500, i % 50
+        from generate_series(1, 5000) i
+    on conflict do nothing;
+    analyze ricks_gtr_sort_results;
+
+    create table if not exists search_title_dandelion_simple_mv (
+        doi text,
+        title text,
+        num_events numeric,
+        is_oa boolean
+    );
+    create index if not exists search_title_dandelion_simple_mv_title_num_events_idx on search_title_dandelion_simple_mv (title, num_events);
+    insert into search_title_dandelion_simple_mv (doi, title, num_events, is_oa)
+        select '10.1234/fixture.' || i, case when i % 10 = 0 then 'Aspirin' else 'Fixture entity ' || (i % 100) end, i % 50, i % 2 = 0
+        from generate_series(1, 5000) i
+        where not exists (select 1 from search_title_dandelion_simple_mv);
+    analyze search_title_dandelion_simple_mv;
+    """
+
+# (description, query, params, index it should use)
+plans_to_check = [
+    (u"title search",
+     title_candidates_query(" "),
+     {"query": u"(aspirin)"},
+     "ricks_gtr_sort_results_article_title_tsv_idx"),
+    (u"title search, oa only",
+     title_candidates_query(u" and is_oa=True "),
+     {"query": u"(aspirin)"},
+     "ricks_gtr_sort_results_article_title_tsv_idx"),
+    (u"doi lookup",
+     doi_candidates_query(),
+     {"query": u"(10.1234/fixture.1)", "doi": u"10.1234/fixture.1"},
+     "ricks_gtr_sort_results_pkey"),
+    (u"entity search",
+     entity_candidates_query(" "),
+     {"query": u"(aspirin)", "query_entity": u"Aspirin"},
+     "search_title_dandelion_simple_mv_title_num_events_idx"),
+    (u"entity search, oa only",
+     entity_candidates_query(u" and is_oa=True "),
+     {"query": u"(aspirin)", "query_entity": u"Aspirin"},
+     "search_title_dandelion_simple_mv_title_num_events_idx"),
+]
+
+
+def index_names_in_plan(plan_node):
+    response = set()
+    if "Index Name" in plan_node:
+        response.add(plan_node["Index Name"])
+    for child_node in plan_node.get("Plans", []):
+        response |= index_names_in_plan(child_node)
+    return response
+
+
+def check_plans():
+    failures = []
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    try:
+        # the fixture is small enough that a seq scan would win on cost alone;
+        # what we want to know is whether the planner *can* use the index
+        connection.execute("set local enable_seqscan = off")
+        for (description, query_string, params, expected_index) in plans_to_check:
+            explain_rows = connection.execute(sql.text(u"explain (format json) " + query_string), **params).fetchall()
+            plan = explain_rows[0][0]
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            used_indexes = index_names_in_plan(plan[0]["Plan"])
+            if expected_index in used_indexes:
+                print u"ok: {} uses {}".format(description, expected_index)
+            else:
+                print u"FAIL: {} doesn't use {}, uses {}".format(description, expected_index, sorted(used_indexes))
+                failures.append(description)
+    finally:
+        transaction.rollback()
+        connection.close()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the search queries still use their indexes.")
+    parser.add_argument('--setup-fixture', action="store_true", help="create and fill small ricks_gtr_sort_results and search_title_dandelion_simple_mv tables first")
+    parsed_args = parser.parse_args()
+
+    if parsed_args.setup_fixture:
+        db.engine.execute(sql.text(fixture_sql).execution_options(autocommit=True))
+
+    failures = check_plans()
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,137 @@
+import os
+import random
+import logging
+import threading
+from time import time
+from time import sleep
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+
+from util import TooManyRequestsException
+
+
+dandelion_url = u"https://api.dandelion.eu/datatxt/nex/v1/"
+
+
+def units_left(r):
+    try:
+        return float(r.headers.get("X-DL-units-left", None))
+    except (TypeError, ValueError):
+        return float("inf")
+
+
+class DandelionClient(object):
+    """
+    One per process.  Keeps a pooled, keep-alive http session and a thread pool
+    sized to how many calls we're willing to have open to dandelion at once,
+    instead of making a new ThreadPool and a new connection for every request.
+    """
+
+    def __init__(self, max_concurrency=20, request_timeout=5.0, max_retries=3, deadline_seconds=10.0):
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.deadline_seconds = deadline_seconds
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self._thread_pool = None
+        # from the most recent response's X-DL-units-left, so batch jobs can slow down before running out
+        self.last_units_left = float("inf")
+
+    def _setup(self):
+        # sessions and thread pools don't survive a fork, so make them in the process that uses them
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+            self._session.mount("https://", adapter)
+            self._thread_pool = ThreadPool(self.max_concurrency)
+            self._pid = os.getpid()
+
+    def annotate(self, params, deadline=None):
+        """
+        Posts to the dandelion nex endpoint and returns the parsed json, or None.
+
+        Retries with exponential backoff on 429s, 5xxs and connection errors,
+        but never past the deadline (a time() value).  Raises
+        TooManyRequestsException when we're out of units or the key is bad.
+        """
+        self._setup()
+        if deadline is None:
+            deadline = time() + self.deadline_seconds
+
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time()
+            if remaining <= 0:
+                print u"dandelion deadline passed, giving up"
+                return None
+
+            r = None
+            try:
+                r = self._session.post(dandelion_url, data=params, timeout=min(self.request_timeout, remaining))
+            except requests.exceptions.RequestException as e:
+                print u"dandelion request error on attempt {}: {}".format(attempt, e)
+
+            if r is not None:
+                self.last_units_left = units_left(r)
+                if self.last_units_left <= 0 or r.status_code == 401:
+                    print u"TooManyRequestsException"
+                    raise TooManyRequestsException
+
+                if r.status_code != 429 and r.status_code < 500:
+                    try:
+                        return r.json()
+                    except ValueError:
+                        return None
+
+            backoff = (0.25 * 2 ** attempt) + random.uniform(0, 0.1)
+            if r is not None and r.headers.get("Retry-After", "").isdigit():
+                backoff = max(backoff, int(r.headers["Retry-After"]))
+            if time() + backoff >= deadline:
+                return None
+            sleep(backoff)
+
+        return None
+
+    def run_with_deadline(self, calls, deadline_seconds=None):
+        """
+        Runs (function, args) tuples on the shared pool, at most max_concurrency at a time.
+
+        Returns (results, rate_limit_exceeded).  results are in the same order as calls,
+        with None for anything that raised or didn't finish before the deadline,
+        so callers get whatever annotations arrived in time.
+        """
+        self._setup()
+        if deadline_seconds is None:
+            deadline_seconds = self.deadline_seconds
+        deadline = time() + deadline_seconds
+
+        async_results = [self._thread_pool.apply_async(function, args) for (function, args) in calls]
+
+        results = []
+        rate_limit_exceeded = False
+        for async_result in async_results:
+            try:
+                results.append(async_result.get(timeout=max(deadline - time(), 0)))
+            except TimeoutError:
+                results.append(None)
+            except TooManyRequestsException:
+                rate_limit_exceeded = True
+                results.append(None)
+            except Exception:
+                logging.exception("dandelion call error")
+                results.append(None)
+
+        return (results, rate_limit_exceeded)
+
+
+dandelion_client = DandelionClient(
+    max_concurrency=int(os.getenv("DANDELION_MAX_CONCURRENCY", 20)),
+    request_timeout=float(os.getenv("DANDELION_REQUEST_TIMEOUT", 5)),
+    max_retries=int(os.getenv("DANDELION_MAX_RETRIES", 3)),
+    deadline_seconds=float(os.getenv("DANDELION_DEADLINE", 10))
+)
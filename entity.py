@@ -10,7 +10,10 @@ import inflect
 
 from pub import call_dandelion
 from annotation_list import AnnotationList
-from search import autocomplete_entity_titles
+from search import matching_entity_title
+from autocomplete_index import autocomplete_index
+from autocomplete_index import normalize_entity_name
+from response_cache import ResponseCache
 
 inflect_engine = inflect.engine()
 
@@ -153,26 +156,75 @@ just
 don
 should
 now""".split("\n")
+stop_words = frozenset(stop_words)
 
 # removed
 # of  #quality of life is good
 
 
+# queries that aren't an entity name get sent to dandelion, which gives the
+# same answer every time, so keep the answers around
+remote_query_entities_cache = ResponseCache(
+    max_entries=int(os.getenv("QUERY_ENTITIES_CACHE_SIZE", 5000)),
+    ttl_seconds=int(os.getenv("QUERY_ENTITIES_CACHE_TTL", 24*60*60))
+)
+
+
+def entity_aliases(entity_title, alternate_labels=None):
+    """
+    Other names a query might use for entity_title: its singular or plural,
+    and the alternate labels dandelion gives it.  Normalized like
+    autocomplete_index.normalize_entity_name, without the title itself.
+    """
+    title_normalized = normalize_entity_name(entity_title)
+    aliases = set()
+
+    singular = inflect_engine.singular_noun(title_normalized)
+    if singular:
+        aliases.add(singular)
+    else:
+        aliases.add(inflect_engine.plural_noun(title_normalized))
+
+    for label in (alternate_labels or []):
+        label_normalized = normalize_entity_name(label)
+        # short labels are mostly abbreviations that mean something else too
+        if len(label_normalized) >= 3:
+            aliases.add(label_normalized)
+
+    aliases.discard(title_normalized)
+    return sorted([a for a in aliases if a])
+
+
 def get_entities_from_query(query):
+    if autocomplete_index and autocomplete_index.is_loaded():
+        entity_title = autocomplete_index.resolve(query)
+        if not entity_title:
+            query_singular = inflect_engine.singular_noun(query)
+            if query_singular:
+                entity_title = autocomplete_index.resolve(query_singular)
+        if entity_title:
+            return [entity_title]
+
+    else:
+        query_lower = query.lower()
+
+        matching_title = matching_entity_title(query)
+        if matching_title:
+            return [matching_title]
 
-    query_lower = query.lower()
+        query_singular = inflect_engine.singular_noun(query)
+        if query_singular and (query_singular != query_lower):
+            matching_title = matching_entity_title(query_singular)
+            if matching_title:
+                return [matching_title]
 
-    for a in autocomplete_entity_titles(query):
-        if a.lower() == query_lower:
-            return [a]
+    (annotation_titles, was_hit) = remote_query_entities_cache.get_or_compute(
+        normalize_entity_name(query),
+        lambda: get_entities_from_query_remote(query))
+    return list(annotation_titles or [])
 
-    query_singular = inflect_engine.singular_noun(query)
-    if query_singular and (query_singular != query_lower):
-        query_singular_lower = query_singular.lower()
-        for a in autocomplete_entity_titles(query_singular):
-            if a.lower() == query_singular_lower:
-                return [a]
 
+def get_entities_from_query_remote(query):
     api_key = os.getenv("DANDELION_API_KEY_QUERY_PARSING")
 
     # from https://stackoverflow.com/a/5486509/596939
@@ -183,6 +235,9 @@ def get_entities_from_query(query):
     query_no_stopwords = u" ".join(query_no_stopwords_list)
 
     dandelion_results = call_dandelion(query_no_stopwords, api_key=api_key, label_top_entities=False)
+    if not dandelion_results or "annotations" not in dandelion_results:
+        # no answer, eg a timeout.  None isn't cached, so the next search asks again.
+        return None
     my_annotation_list = AnnotationList(dandelion_results)
     annotation_titles = [anno.title for anno in my_annotation_list.list()]
-    return annotation_titles
\ No newline at end of file
+    return annotation_titles
@@ -1,13 +1,140 @@
+import os
+import atexit
+import logging
+import threading
+import Queue
 import shortuuid
 import datetime
+from time import time
+from sqlalchemy import sql
 
 from app import db
-from util import safe_commit
+
+
+class QueryLogWriter(object):
+    """
+    Writes query_history rows from a background thread, so logging a search
+    never waits on the database.
+
+    log() only puts the row on a bounded queue.  The flusher thread writes
+    whatever has queued up with one multi-row insert, once batch_size rows are
+    waiting or flush_seconds after the first one arrived.  If the database
+    falls behind and the queue fills up, new rows are dropped and counted
+    rather than slowing searches down.  What's still queued is written when
+    the process exits.
+
+    Threads don't survive a fork, so each process starts its own flusher the
+    first time it logs.
+    """
+
+    def __init__(self, max_queue_size=10000, batch_size=200, flush_seconds=2.0):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._pending = []
+        self.logged = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def _setup(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(maxsize=self.max_queue_size)
+            self._pending = []
+            flusher = threading.Thread(target=self._run)
+            flusher.daemon = True
+            flusher.start()
+            if self._pid is None:
+                atexit.register(self.flush)
+            self._pid = os.getpid()
+
+    def log(self, query, ip):
+        if self._pid != os.getpid():
+            self._setup()
+        row = {
+            "id": shortuuid.uuid()[0:20],
+            "query": query,
+            "ip": ip,
+            "created": datetime.datetime.utcnow().isoformat()
+        }
+        try:
+            self._queue.put_nowait(row)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        my_queue = self._queue
+        while True:
+            first_row = my_queue.get()
+            with self._write_lock:
+                self._pending.append(first_row)
+            flush_at = time() + self.flush_seconds
+            while len(self._pending) < self.batch_size:
+                try:
+                    row = my_queue.get(timeout=max(flush_at - time(), 0))
+                except Queue.Empty:
+                    break
+                with self._write_lock:
+                    self._pending.append(row)
+            with self._write_lock:
+                (rows, self._pending) = (self._pending, [])
+                self._write(rows)
+
+    def _write(self, rows):
+        # call with _write_lock held
+        if not rows:
+            return
+        values = []
+        params = {}
+        for (i, row) in enumerate(rows):
+            values.append(u"(:id_{i}, :query_{i}, :ip_{i}, :created_{i})".format(i=i))
+            for (key, value) in row.iteritems():
+                params[u"{}_{}".format(key, i)] = value
+        query_string = u"insert into query_history (id, query, ip, created) values {}".format(u", ".join(values))
+        try:
+            db.engine.execute(sql.text(query_string), **params)
+            self.logged += len(rows)
+        except Exception:
+            self.failed += len(rows)
+            logging.exception(u"error writing {} query_history rows".format(len(rows)))
+
+    def flush(self):
+        # writes the batch the flusher is collecting and everything still queued
+        if self._pid != os.getpid():
+            return
+        with self._write_lock:
+            (rows, self._pending) = (self._pending, [])
+            while True:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for i in range(0, len(rows), self.batch_size):
+                self._write(rows[i:i + self.batch_size])
+
+    def stats(self):
+        return {
+            "logged": self.logged,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": self._queue.qsize() if self._queue else 0
+        }
+
+
+query_log_writer = QueryLogWriter(
+    max_queue_size=int(os.getenv("QUERY_LOG_QUEUE_SIZE", 10000)),
+    batch_size=int(os.getenv("QUERY_LOG_BATCH_SIZE", 200)),
+    flush_seconds=float(os.getenv("QUERY_LOG_FLUSH_SECONDS", 2))
+)
+
 
 def log_query(query, ip):
-    my_log = QueryHistory(query=query, ip=ip)
-    db.session.add(my_log)
-    safe_commit(db)
+    query_log_writer.log(query, ip)
 
 class QueryHistory(db.Model):
     __tablename__ = "query_history"
@@ -20,4 +147,3 @@ class QueryHistory(db.Model):
         self.id = shortuuid.uuid()[0:20]
         self.created = datetime.datetime.utcnow().isoformat()
         super(QueryHistory, self).__init__(**kwargs)
-
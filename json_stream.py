@@ -0,0 +1,119 @@
+import zlib
+from flask import Response
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+
+# coalesce the tiny pieces iterencode yields into chunks about this big, and
+# flush the gzip stream after each one so the client gets bytes right away
+stream_chunk_size = 16 * 1024
+
+
+class ApiJSONEncoder(FlaskJSONEncoder):
+    """
+    Uses our to_dict() where there is one, then flask's rules for dates etc,
+    so bodies match what jsonify would send, then falls back to __dict__.
+    """
+
+    def default(self, obj):
+        try:
+            return obj.to_dict()
+        except AttributeError:
+            pass
+        try:
+            return FlaskJSONEncoder.default(self, obj)
+        except TypeError:
+            return obj.__dict__
+
+
+compact_encoder = ApiJSONEncoder(sort_keys=True, separators=(",", ":"))
+
+
+def json_bytes(thing):
+    body = compact_encoder.encode(thing)
+    if isinstance(body, unicode):
+        body = body.encode("utf-8")
+    return body
+
+
+def iter_json(thing):
+    """
+    Compact, sorted-key json for thing, in chunks of about stream_chunk_size,
+    without ever holding the whole string.  Joined, it's json_bytes(thing).
+    """
+    buffered = []
+    buffered_size = 0
+    for piece in compact_encoder.iterencode(thing):
+        if isinstance(piece, unicode):
+            piece = piece.encode("utf-8")
+        buffered.append(piece)
+        buffered_size += len(piece)
+        if buffered_size >= stream_chunk_size:
+            yield "".join(buffered)
+            buffered = []
+            buffered_size = 0
+    if buffered:
+        yield "".join(buffered)
+
+
+def iter_gzip(chunks, level=6):
+    # wbits 16+MAX_WBITS makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def gzip_json_bytes(thing):
+    return "".join(iter_gzip(iter_json(thing)))
+
+
+def gunzip_bytes(body):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+
+def streaming_json_resp(thing, accept_gzip, on_gzip_complete=None, on_complete=None):
+    """
+    Streams thing as json, gzipped if the client accepts it.  Flask-Compress
+    leaves responses that already have a Content-Encoding alone.
+
+    on_gzip_complete, if given, is called with the whole gzipped body once it
+    has all been sent, e.g. to put it in the shared cache.  on_complete, if
+    given, is called with no arguments at the same point, for work that
+    shouldn't hold up the response but doesn't want the body sent.  Both run
+    outside the request context, after the view has returned.
+    """
+    def generate_then_complete():
+        for chunk in generate():
+            yield chunk
+        if on_complete:
+            on_complete()
+
+    def generate():
+        if not accept_gzip and not on_gzip_complete:
+            for chunk in iter_json(thing):
+                yield chunk
+            return
+
+        if accept_gzip:
+            gzipped_chunks = []
+            for gzipped_chunk in iter_gzip(iter_json(thing)):
+                if on_gzip_complete:
+                    gzipped_chunks.append(gzipped_chunk)
+                yield gzipped_chunk
+        else:
+            # the cache keeps gzip, so compress alongside what we send
+            json_chunks = []
+            for chunk in iter_json(thing):
+                json_chunks.append(chunk)
+                yield chunk
+            gzipped_chunks = list(iter_gzip(json_chunks))
+        if on_gzip_complete:
+            on_gzip_complete("".join(gzipped_chunks))
+
+    resp = Response(generate_then_complete(), mimetype="application/json")
+    if accept_gzip:
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.headers["Vary"] = "Accept-Encoding"
+    return resp
@@ -9,13 +9,16 @@ import shortuuid
 import hashlib
 import requests
 import random
-import json
-from urllib import quote_plus
+import bisect
 from collections import defaultdict
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy import sql
 from sqlalchemy import func
 from sqlalchemy.orm import deferred
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm import noload
+from sqlalchemy.orm import undefer_group
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.orm import column_property
 from collections import OrderedDict
@@ -23,6 +26,14 @@ from collections import defaultdict
 
 from app import db
 from annotation_list import AnnotationList
+from annotation_list import parse_annotation_json
+from abstract_sections import get_abstract_sections
+from abstract_sections import structured_sections
+from annotation_cache import annotation_cache_key
+from annotation_cache import get_cached_annotations
+from annotation_cache import get_cached_annotations_many
+from annotation_cache import save_cached_annotations
+from dandelion_client import dandelion_client
 from util import get_sql_answer
 from util import run_sql
 from util import TooManyRequestsException
@@ -65,36 +76,166 @@ pub_type_data = [
 pub_type_lookup = dict(zip([name for (name, label, val) in pub_type_data], pub_type_data))
 
 
-def call_dandelion(query_text_raw, api_key=None, label_top_entities=True):
+dandelion_include = "image,abstract,types,categories,alternate_labels,lod"
+
+def dandelion_params(query_text_raw, api_key=None, top_entities=8):
+    if not api_key:
+        api_key = os.getenv("DANDELION_API_KEY")
+
+    # for right now assume everything is english, we get better results that way
+    params = {
+        "text": query_text_raw.encode("utf-8"),
+        "lang": "en",
+        "min_confidence": 0.5,
+        "country": -1,
+        "social": "False",
+        "include": dandelion_include,
+        "token": api_key
+    }
+    if top_entities:
+        params["top_entities"] = top_entities
+    return params
+
+
+def call_dandelion(query_text_raw, api_key=None, label_top_entities=True, deadline=None):
     # print "CALLING DANDELION"
     if not query_text_raw:
         return None
 
-    if not api_key:
-        api_key = os.getenv("DANDELION_API_KEY")
+    top_entities = 8 if label_top_entities else 0
 
-    query_text = quote_plus(query_text_raw.encode('utf-8'), safe=':/'.encode('utf-8'))
+    cache_key = annotation_cache_key(query_text_raw, "en", dandelion_include, top_entities)
+    cached_results = get_cached_annotations(cache_key)
+    if cached_results is not None:
+        return cached_results
 
-    # for right now assume everything is english, we get better results that way
-    language = "en"
-
-    url_template = u"https://api.dandelion.eu/datatxt/nex/v1/?min_confidence=0.5&text={query}&lang={language}&country=-1&social=False&include=image,abstract,types,categories,alternate_labels,lod&token={api_key}"
-    if label_top_entities:
-        url_template += u"&top_entities=8"
-    url = url_template.format(query=query_text, language=language, api_key=api_key)
-    r = requests.get(url)
-    if r.headers.get("X-DL-units-left", None) == 0 or r.status_code == 401:
-        print u"TooManyRequestsException"
-        raise TooManyRequestsException
-
-    try:
-        response_data = r.json()
-    except ValueError:
-        response_data = None
+    # raises TooManyRequestsException when we're out of units
+    response_data = dandelion_client.annotate(dandelion_params(query_text_raw, api_key, top_entities), deadline=deadline)
 
+    save_cached_annotations(cache_key, response_data)
     return response_data
 
 
+# dandelion charges per request and per 1000 characters, and most titles are way
+# under that, so short texts get packed into one request and the answer split back up.
+# the blank line keeps sentences from running together; annotations that still
+# manage to span a separator are dropped.
+dandelion_batch_separator = "\n\n"
+dandelion_batch_max_chars = 4000
+
+def pack_dandelion_batches(texts, max_chars=dandelion_batch_max_chars):
+    """
+    Groups the indexes of non-empty texts into batches whose joined length
+    stays under max_chars.  A text longer than max_chars gets a batch to itself.
+    """
+    batches = []
+    current_batch = []
+    current_length = 0
+    for (index, text) in enumerate(texts):
+        if not text:
+            continue
+        added_length = len(text) + (len(dandelion_batch_separator) if current_batch else 0)
+        if current_batch and current_length + added_length > max_chars:
+            batches.append(current_batch)
+            current_batch = []
+            current_length = 0
+            added_length = len(text)
+        current_batch.append(index)
+        current_length += added_length
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+def split_batched_dandelion_results(dandelion_results, segment_starts, segment_ends):
+    """
+    Splits the response for joined texts back into one dandelion-shaped
+    response per text, with start and end relative to that text.
+    """
+    split_results = []
+    for segment_start in segment_starts:
+        my_results = dict((k, v) for (k, v) in dandelion_results.iteritems() if k not in ["annotations", "topEntities"])
+        my_results["annotations"] = []
+        split_results.append(my_results)
+
+    for annotation in dandelion_results.get("annotations", []):
+        segment_index = bisect.bisect_right(segment_starts, annotation["start"]) - 1
+        if segment_index < 0 or annotation["end"] > segment_ends[segment_index]:
+            continue
+        my_annotation = dict(annotation)
+        my_annotation["start"] -= segment_starts[segment_index]
+        my_annotation["end"] -= segment_starts[segment_index]
+        split_results[segment_index]["annotations"].append(my_annotation)
+
+    if "topEntities" in dandelion_results:
+        for my_results in split_results:
+            my_uris = set([a["uri"] for a in my_results["annotations"]])
+            my_results["topEntities"] = [e for e in dandelion_results["topEntities"] if e["uri"] in my_uris]
+
+    return split_results
+
+
+def call_dandelion_batch(query_texts, api_key=None, label_top_entities=True, deadline=None):
+    """
+    Like call_dandelion, but for a list of texts that fit in one batch (see
+    pack_dandelion_batches).  Returns one result per text, None for empty ones.
+    Texts already in the annotation cache aren't sent.
+    """
+    top_entities = 8 if label_top_entities else 0
+    response = [None] * len(query_texts)
+
+    # one cache lookup for the whole batch; these run on the dandelion pool,
+    # so a query per text would tie up that many database connections
+    cache_keys = {}
+    for (index, query_text) in enumerate(query_texts):
+        if query_text:
+            cache_keys[index] = annotation_cache_key(query_text, "en", dandelion_include, top_entities)
+    cached = get_cached_annotations_many(cache_keys.values())
+
+    uncached_indexes = []
+    for (index, cache_key) in sorted(cache_keys.items()):
+        response[index] = cached.get(cache_key, None)
+        if response[index] is None:
+            uncached_indexes.append(index)
+
+    if not uncached_indexes:
+        return response
+
+    if len(uncached_indexes) == 1:
+        # already know it isn't cached, so skip call_dandelion's lookup
+        index = uncached_indexes[0]
+        # raises TooManyRequestsException when we're out of units
+        response[index] = dandelion_client.annotate(
+            dandelion_params(query_texts[index], api_key, top_entities), deadline=deadline)
+        save_cached_annotations(cache_keys[index], response[index])
+        return response
+
+    segment_starts = []
+    segment_ends = []
+    cursor = 0
+    for index in uncached_indexes:
+        segment_starts.append(cursor)
+        cursor += len(query_texts[index])
+        segment_ends.append(cursor)
+        cursor += len(dandelion_batch_separator)
+    joined_text = dandelion_batch_separator.join([query_texts[index] for index in uncached_indexes])
+
+    # more texts means more entities worth ranking
+    params = dandelion_params(joined_text, api_key, top_entities * len(uncached_indexes))
+
+    # raises TooManyRequestsException when we're out of units
+    dandelion_results = dandelion_client.annotate(params, deadline=deadline)
+    if not dandelion_results or "annotations" not in dandelion_results:
+        return response
+
+    split_results = split_batched_dandelion_results(dandelion_results, segment_starts, segment_ends)
+    for (index, my_results) in zip(uncached_indexes, split_results):
+        response[index] = my_results
+        save_cached_annotations(cache_keys[index], my_results)
+
+    return response
+
+
 class Author(db.Model):
     __tablename__ = "medline_author"
     pmid = db.Column(db.Numeric, db.ForeignKey('medline_citation.pmid'), primary_key=True)
@@ -277,20 +418,26 @@ class Pub(db.Model):
     def dandelion_abstract_annotation_list(self):
         if hasattr(self, "fresh_dandelion_abstract_annotation_list"):
             return self.fresh_dandelion_abstract_annotation_list
-        if self.dandelion_has_been_collected:
-            if self.dandelion_lookup.dandelion_raw_abstract_text:
-                dandelion_results = json.loads(self.dandelion_lookup.dandelion_raw_abstract_text)
-                return AnnotationList(dandelion_results)
-        return None
+        # parse once per pub and share it, so annotation_distribution set by
+        # set_pictures is still there when the annotations are read again
+        if not hasattr(self, "cached_dandelion_abstract_annotation_list"):
+            self.cached_dandelion_abstract_annotation_list = None
+            if self.dandelion_has_been_collected:
+                if self.dandelion_lookup.dandelion_raw_abstract_text:
+                    dandelion_results = parse_annotation_json(self.dandelion_lookup.dandelion_raw_abstract_text)
+                    self.cached_dandelion_abstract_annotation_list = AnnotationList(dandelion_results)
+        return self.cached_dandelion_abstract_annotation_list
 
     @property
     def dandelion_title_annotation_list(self):
         if hasattr(self, "fresh_dandelion_article_annotation_list"):
             return self.fresh_dandelion_article_annotation_list
-        if self.dandelion_has_been_collected:
-            dandelion_results = self.dandelion_lookup.dandelion_raw_article_title
-            return AnnotationList(dandelion_results)
-        return None
+        if not hasattr(self, "cached_dandelion_title_annotation_list"):
+            self.cached_dandelion_title_annotation_list = None
+            if self.dandelion_has_been_collected:
+                dandelion_results = self.dandelion_lookup.dandelion_raw_article_title
+                self.cached_dandelion_title_annotation_list = AnnotationList(dandelion_results)
+        return self.cached_dandelion_title_annotation_list
 
     def call_dandelion_on_abstract(self):
         if not self.dandelion_has_been_collected:
@@ -328,46 +475,28 @@ class Pub(db.Model):
             my_annotation.annotation_distribution = annotation_distribution
 
 
-    def abstract_with_annotations_dict(self, full=True):
-        sections = []
-        if self.abstract_structured:
-            sections = self.abstract_structured
-        elif self.abstract_text:
-            background_text = ""
-            summary_text = ""
-            if "CONCLUSION:" in self.abstract_text:
-                background_text = self.abstract_text.rsplit("CONCLUSION:", 1)[0]
-                summary_text = self.abstract_text.rsplit("CONCLUSION:", 1)[1]
-            elif "CONCLUSIONS:" in self.abstract_text:
-                background_text = self.abstract_text.rsplit("CONCLUSIONS:", 1)[0]
-                summary_text = self.abstract_text.rsplit("CONCLUSIONS:", 1)[1]
-            else:
-                try:
-                    background_text += ". ".join(self.abstract_text.rsplit(". ", 3)[0:1]) + "."
-                    summary_text += ". ".join(self.abstract_text.rsplit(". ", 3)[1:])
-                except IndexError:
-                    background_text += self.abstract_text[-500:-1]
-                    summary_text += self.abstract_text[-500:-1]
-
-            background_text = background_text.strip()
-            summary_text = summary_text.strip()
+    @property
+    def abstract_sections(self):
+        # split once per pub; copies, because the caller adds annotations to them
+        if not hasattr(self, "cached_abstract_sections"):
+            self.cached_abstract_sections = get_abstract_sections(self.abstract_text)
+        return [dict(section) for section in self.cached_abstract_sections]
 
-            sections = [
-                {"text": background_text, "heading": "BACKGROUND", "section_split_source": "automated", "summary": False, "original_start":1, "original_end":len(background_text)},
-                {"text": summary_text, "heading": "SUMMARY", "section_split_source": "automated", "summary": True, "original_start":len(background_text)+2, "original_end":len(self.abstract_text)}
-            ]
+    def abstract_with_annotations_dict(self, full=True):
+        sections = self.abstract_sections
 
         if full:
-            for section in sections:
+            annotations_by_section = [[] for section in sections]
+            if self.dandelion_abstract_annotation_list:
+                section_ranges = [(section["original_start"], section["original_end"]) for section in sections]
+                annotations_by_section = self.dandelion_abstract_annotation_list.in_ranges(section_ranges, min_confidence=0.65)
+            for (section, section_annotations) in zip(sections, annotations_by_section):
                 section["annotations"] = []
-                if self.dandelion_abstract_annotation_list:
-                    for anno in self.dandelion_abstract_annotation_list.list():
-                        if anno.confidence >= 0.65:
-                            if anno.start >= section["original_start"] and anno.end <= section["original_end"]:
-                                my_anno_dict = anno.to_dict_simple()
-                                my_anno_dict["start"] -= section["original_start"] - 1
-                                my_anno_dict["end"] -= section["original_start"] - 1
-                                section["annotations"] += [my_anno_dict]
+                for anno in section_annotations:
+                    my_anno_dict = anno.to_dict_simple()
+                    my_anno_dict["start"] -= section["original_start"] - 1
+                    my_anno_dict["end"] -= section["original_start"] - 1
+                    section["annotations"] += [my_anno_dict]
 
         if not full:
             sections = [s for s in sections if s["summary"]==True]
@@ -422,42 +551,7 @@ class Pub(db.Model):
 
     @property
     def abstract_structured(self):
-        all_sections = []
-
-        working_text = self.abstract_text
-        if working_text:
-
-            # if &amp; in heading, need to replace with uppercase it won't match as heading
-            working_text = working_text.replace("&amp;", " AND ")  # exactly the same length, so won't affect offsets
-            if re.findall("(^[A-Z' ,&]{4,}): ", working_text):
-                matches = re.findall(ur"([A-Z' ,&]{4,}): (.*?) (?=$|[A-Z' ,&]{4,}: )", working_text)
-                for match in matches:
-                    all_sections.append({
-                        "heading": match[0],
-                        "text": match[1]
-                    })
-
-        cursor = 1
-        for section in all_sections:
-            cursor += len(section["heading"])
-            cursor += 2
-            # don't include heading in what can be annotated
-            section["original_start"] = cursor
-            cursor += len(section["text"])
-            section["original_end"] = cursor
-            cursor += 1
-            section["section_split_source"] = "structured"
-            section["summary"] = False
-
-        if all_sections:
-            all_sections[-1]["summary"] = True
-
-            # check it doesn't talk about funding or data.  if so, use previous heading instead.
-            for heading_word in all_sections[-1]["heading"].split(" "):
-                if heading_word in ["TRIAL", "DATA", "REGISTRATION", "FUNDING"]:
-                    all_sections[-1]["summary"] = False
-                    all_sections[-2]["summary"] = True
-        return all_sections
+        return structured_sections(self.abstract_text)
 
 
     @property
@@ -644,14 +738,6 @@ class PubDoi(db.Model):
                 response = self.dandelion_title_annotation_list.to_dict_simple()
         return response
 
-    @property
-    def dandelion_title_annotation_list(self):
-        if hasattr(self, "fresh_dandelion_article_annotation_list"):
-            return self.fresh_dandelion_article_annotation_list
-        if self.dandelion_has_been_collected:
-            dandelion_results = self.dandelion_lookup.dandelion_raw_article_title
-            return AnnotationList(dandelion_results)
-        return None
 
     def call_dandelion_on_abstract(self):
         if not self.dandelion_has_been_collected:
@@ -679,46 +765,28 @@ class PubDoi(db.Model):
             return articles
         return []
 
-    def abstract_with_annotations_dict(self, full=True):
-        sections = []
-        if self.abstract_structured:
-            sections = self.abstract_structured
-        elif self.abstract_text:
-            background_text = ""
-            summary_text = ""
-            if "CONCLUSION:" in self.abstract_text:
-                background_text = self.abstract_text.rsplit("CONCLUSION:", 1)[0]
-                summary_text = self.abstract_text.rsplit("CONCLUSION:", 1)[1]
-            elif "CONCLUSIONS:" in self.abstract_text:
-                background_text = self.abstract_text.rsplit("CONCLUSIONS:", 1)[0]
-                summary_text = self.abstract_text.rsplit("CONCLUSIONS:", 1)[1]
-            else:
-                try:
-                    background_text += ". ".join(self.abstract_text.rsplit(". ", 3)[0:1]) + "."
-                    summary_text += ". ".join(self.abstract_text.rsplit(". ", 3)[1:])
-                except IndexError:
-                    background_text += self.abstract_text[-500:-1]
-                    summary_text += self.abstract_text[-500:-1]
-
-            background_text = background_text.strip()
-            summary_text = summary_text.strip()
+    @property
+    def abstract_sections(self):
+        # split once per pub; copies, because the caller adds annotations to them
+        if not hasattr(self, "cached_abstract_sections"):
+            self.cached_abstract_sections = get_abstract_sections(self.abstract_text)
+        return [dict(section) for section in self.cached_abstract_sections]
 
-            sections = [
-                {"text": background_text, "heading": "BACKGROUND", "section_split_source": "automated", "summary": False, "original_start":1, "original_end":len(background_text)},
-                {"text": summary_text, "heading": "SUMMARY", "section_split_source": "automated", "summary": True, "original_start":len(background_text)+2, "original_end":len(self.abstract_text)}
-            ]
+    def abstract_with_annotations_dict(self, full=True):
+        sections = self.abstract_sections
 
         if full:
-            for section in sections:
+            annotations_by_section = [[] for section in sections]
+            if self.dandelion_abstract_annotation_list:
+                section_ranges = [(section["original_start"], section["original_end"]) for section in sections]
+                annotations_by_section = self.dandelion_abstract_annotation_list.in_ranges(section_ranges, min_confidence=0.65)
+            for (section, section_annotations) in zip(sections, annotations_by_section):
                 section["annotations"] = []
-                if self.dandelion_abstract_annotation_list:
-                    for anno in self.dandelion_abstract_annotation_list.list():
-                        if anno.confidence >= 0.65:
-                            if anno.start >= section["original_start"] and anno.end <= section["original_end"]:
-                                my_anno_dict = anno.to_dict_simple()
-                                my_anno_dict["start"] -= section["original_start"] - 1
-                                my_anno_dict["end"] -= section["original_start"] - 1
-                                section["annotations"] += [my_anno_dict]
+                for anno in section_annotations:
+                    my_anno_dict = anno.to_dict_simple()
+                    my_anno_dict["start"] -= section["original_start"] - 1
+                    my_anno_dict["end"] -= section["original_start"] - 1
+                    section["annotations"] += [my_anno_dict]
 
         if not full:
             sections = [s for s in sections if s["summary"]==True]
@@ -727,61 +795,32 @@ class PubDoi(db.Model):
 
     @property
     def abstract_structured(self):
-        all_sections = []
-
-        working_text = self.abstract_text
-        if working_text:
-
-            # if &amp; in heading, need to replace with uppercase it won't match as heading
-            working_text = working_text.replace("&amp;", " AND ")  # exactly the same length, so won't affect offsets
-            if re.findall("(^[A-Z' ,&]{4,}): ", working_text):
-                matches = re.findall(ur"([A-Z' ,&]{4,}): (.*?) (?=$|[A-Z' ,&]{4,}: )", working_text)
-                for match in matches:
-                    all_sections.append({
-                        "heading": match[0],
-                        "text": match[1]
-                    })
-
-        cursor = 1
-        for section in all_sections:
-            cursor += len(section["heading"])
-            cursor += 2
-            # don't include heading in what can be annotated
-            section["original_start"] = cursor
-            cursor += len(section["text"])
-            section["original_end"] = cursor
-            cursor += 1
-            section["section_split_source"] = "structured"
-            section["summary"] = False
-
-        if all_sections:
-            all_sections[-1]["summary"] = True
-
-            # check it doesn't talk about funding or data.  if so, use previous heading instead.
-            for heading_word in all_sections[-1]["heading"].split(" "):
-                if heading_word in ["TRIAL", "DATA", "REGISTRATION", "FUNDING"]:
-                    all_sections[-1]["summary"] = False
-                    all_sections[-2]["summary"] = True
-        return all_sections
+        return structured_sections(self.abstract_text)
 
     @property
     def dandelion_abstract_annotation_list(self):
         if hasattr(self, "fresh_dandelion_abstract_annotation_list"):
             return self.fresh_dandelion_abstract_annotation_list
-        if self.dandelion_has_been_collected:
-            if self.dandelion_lookup.dandelion_raw_abstract_text:
-                dandelion_results = json.loads(self.dandelion_lookup.dandelion_raw_abstract_text)
-                return AnnotationList(dandelion_results)
-        return None
+        # parse once per pub and share it, so annotation_distribution set by
+        # set_pictures is still there when the annotations are read again
+        if not hasattr(self, "cached_dandelion_abstract_annotation_list"):
+            self.cached_dandelion_abstract_annotation_list = None
+            if self.dandelion_has_been_collected:
+                if self.dandelion_lookup.dandelion_raw_abstract_text:
+                    dandelion_results = parse_annotation_json(self.dandelion_lookup.dandelion_raw_abstract_text)
+                    self.cached_dandelion_abstract_annotation_list = AnnotationList(dandelion_results)
+        return self.cached_dandelion_abstract_annotation_list
 
     @property
     def dandelion_title_annotation_list(self):
         if hasattr(self, "fresh_dandelion_article_annotation_list"):
             return self.fresh_dandelion_article_annotation_list
-        if self.dandelion_has_been_collected:
-            dandelion_results = self.dandelion_lookup.dandelion_raw_article_title
-            return AnnotationList(dandelion_results)
-        return None
+        if not hasattr(self, "cached_dandelion_title_annotation_list"):
+            self.cached_dandelion_title_annotation_list = None
+            if self.dandelion_has_been_collected:
+                dandelion_results = self.dandelion_lookup.dandelion_raw_article_title
+                self.cached_dandelion_title_annotation_list = AnnotationList(dandelion_results)
+        return self.cached_dandelion_title_annotation_list
 
 
 
@@ -818,3 +857,53 @@ class PubDoi(db.Model):
         return response
 
 
+
+
+def load_pubmed_lookups(pubs, with_authors=True):
+    """
+    Sets pubmed_lookup on all these PubDois from one query, with the authors
+    joined in, instead of one query per pub for the citation and another for
+    its authors.  Pubs that already have theirs are left alone.
+
+    with_authors=False loads just the abstract text, for minimum responses.
+    """
+    pubs_by_pmid = defaultdict(list)
+    for my_pub in pubs:
+        if hasattr(my_pub, "cached_pubmed_lookup"):
+            continue
+        my_pub.cached_pubmed_lookup = None
+        try:
+            pubs_by_pmid[int(my_pub.pmid)].append(my_pub)
+        except (TypeError, ValueError):
+            pass
+
+    if not pubs_by_pmid:
+        return
+
+    if with_authors:
+        load_options = [joinedload(Pub.authors)]
+    else:
+        load_options = [load_only("abstract_text"), noload(Pub.authors)]
+    citations = db.session.query(Pub).options(*load_options).filter(Pub.pmid.in_(pubs_by_pmid.keys())).all()
+    for my_citation in citations:
+        for my_pub in pubs_by_pmid.get(int(my_citation.pmid), []):
+            my_pub.cached_pubmed_lookup = my_citation
+
+
+def load_minimal_pubs(dois):
+    """
+    PubDois for a minimum=true response: the sort table columns, the unpaywall
+    columns the serp shows joined into the same query, and abstract text from
+    one more query.  Dandelion and news are never loaded, so there are no
+    annotations to parse, no pictures and no topics.
+    """
+    if not dois:
+        return []
+    my_pubs = db.session.query(PubDoi).filter(PubDoi.doi.in_(dois)).options(
+        undefer_group("full"),
+        joinedload(PubDoi.unpaywall_lookup).load_only("oa_url", "best_host_type", "best_version"),
+        noload(PubDoi.dandelion_lookup),
+        noload(PubDoi.news)
+    ).all()
+    load_pubmed_lookups(my_pubs, with_authors=False)
+    return my_pubs
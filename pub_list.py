@@ -1,27 +1,34 @@
-from multiprocessing.pool import ThreadPool
 from time import time as timer
-import requests
 from collections import Counter
 from collections import defaultdict
 
 from annotation_list import AnnotationList
+from dandelion_client import dandelion_client
+from pub import call_dandelion_batch
+from pub import pack_dandelion_batches
+from pub import load_pubmed_lookups
 from annotation import build_evidence_level_annotations
-
-# approach from https://stackoverflow.com/a/21130146/596939
-def multi_run_wrapper(args):
-   return farm_out_call(*args)
-
-def farm_out_call(my_pub, method_name):
-    my_method = getattr(my_pub, method_name)
-    response = my_method()
-    return response
+from annotators import annotator
 
 class PubList(object):
 
     def __init__(self, pubs):
         self.pubs = pubs
 
-    def set_dandelions(self):
+    @property
+    def pubs(self):
+        return self._pubs
+
+    @pubs.setter
+    def pubs(self, pubs):
+        self._pubs = pubs
+        self._sorted_pubs = None
+
+    def set_pubmed_lookups(self):
+        # abstracts and authors for every pub in one query, not one or two per pub
+        load_pubmed_lookups([p for p in self.pubs if hasattr(p, "pubmed_lookup_list")])
+
+    def set_dandelions(self, deadline_seconds=None):
         if not self.pubs:
             return []
 
@@ -29,30 +36,51 @@ class PubList(object):
 
         my_pubs = self.pubs
 
-        try:
-            my_thread_pool = ThreadPool(50)
-            run_tuples = []
-
-            for my_pub in my_pubs:
-                for run_dandelion_on in ["call_dandelion_on_article_title",
-                                         "call_dandelion_on_abstract"]:
-                    run_tuples += [(my_pub, run_dandelion_on)]
-
-            results = my_thread_pool.imap_unordered(multi_run_wrapper, run_tuples)
-
-            my_thread_pool.close()
-            my_thread_pool.join()
-            my_thread_pool.terminate()
-        except AttributeError:
-            # has a threading error when i run it locally
-            for my_pub in my_pubs:
-                for run_dandelion_on in ["call_dandelion_on_article_title",
-                                         "call_dandelion_on_abstract"]:
-                    my_method = getattr(my_pub, run_dandelion_on)
-                    my_method()
-
-
-        print("elapsed time spent calling dandelion: %s" % (timer() - start,))
+        # only the pubs we haven't stored dandelion results for yet
+        run_tuples = []
+        for my_pub in my_pubs:
+            if not my_pub.dandelion_has_been_collected:
+                for (text_attribute, annotation_list_attribute) in [
+                        ("article_title", "fresh_dandelion_article_annotation_list"),
+                        ("abstract_text", "fresh_dandelion_abstract_annotation_list")]:
+                    my_text = getattr(my_pub, text_attribute)
+                    if my_text:
+                        run_tuples += [(my_pub, annotation_list_attribute, my_text)]
+
+        texts = [my_text for (my_pub, annotation_list_attribute, my_text) in run_tuples]
+
+        if annotator.is_local:
+            # no network, so no batching or deadline to worry about
+            for ((my_pub, annotation_list_attribute, my_text), annotator_results) in zip(run_tuples, annotator.annotate_texts(texts)):
+                if annotator_results is not None:
+                    setattr(my_pub, annotation_list_attribute, AnnotationList(annotator_results))
+            print("elapsed time spent annotating {} texts with the {} annotator: {}".format(
+                len(texts), annotator.name, timer() - start))
+            self.pubs = my_pubs
+            return my_pubs
+
+        # pack the texts into as few dandelion requests as we can, then run those
+        # on the shared dandelion pool.  anything that doesn't come back before the
+        # deadline is left unannotated rather than holding up the search.
+        if deadline_seconds is None:
+            deadline_seconds = dandelion_client.deadline_seconds
+        deadline = start + deadline_seconds
+        batches = pack_dandelion_batches(texts)
+        calls = [(call_dandelion_batch, ([texts[i] for i in batch], None, True, deadline)) for batch in batches]
+        (results, rate_limit_exceeded) = dandelion_client.run_with_deadline(calls, deadline_seconds)
+        if rate_limit_exceeded:
+            print u"TooManyRequestsException in set_dandelions, using the annotations we have"
+
+        for (batch, batch_results) in zip(batches, results):
+            if batch_results is None:
+                continue
+            for (index, dandelion_results) in zip(batch, batch_results):
+                (my_pub, annotation_list_attribute, my_text) = run_tuples[index]
+                if dandelion_results is not None:
+                    setattr(my_pub, annotation_list_attribute, AnnotationList(dandelion_results))
+
+        print("elapsed time spent calling dandelion on {} texts in {} requests: {}".format(
+            len(texts), len(batches), timer() - start))
         self.pubs = my_pubs
         return my_pubs
 
@@ -90,8 +118,10 @@ class PubList(object):
 
     @property
     def sorted_pubs(self):
-        sorted_pubs = sorted(self.pubs, key=lambda x: x.score, reverse=True)
-        return sorted_pubs
+        # scores are set before the list is made, so sort once and reuse it
+        if self._sorted_pubs is None:
+            self._sorted_pubs = sorted(self.pubs, key=lambda x: x.score, reverse=True)
+        return self._sorted_pubs
 
     def to_dict_serp_list(self, full=True):
 
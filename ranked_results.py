@@ -0,0 +1,34 @@
+import heapq
+
+
+class RankedResults(object):
+    """
+    Search candidates ranked by score, for pulling out one page at a time.
+
+    Only does the work a page needs: heapq.nlargest picks the top pagesize*page
+    (same order and tie-breaking as a full reverse sort), and scores are looked
+    up by doi in a dict instead of scanning the candidates.
+    """
+
+    def __init__(self, candidates, score_key="adjusted_score", id_key="doi"):
+        self.candidates = candidates
+        self.score_key = score_key
+        self.id_key = id_key
+
+        # if a doi shows up twice, the higher score is the one a sort would have found first
+        self.score_by_id = {}
+        for candidate in candidates:
+            my_id = candidate[id_key]
+            if my_id not in self.score_by_id or candidate[score_key] > self.score_by_id[my_id]:
+                self.score_by_id[my_id] = candidate[score_key]
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def page(self, page, pagesize):
+        """page starts at 1"""
+        top_candidates = heapq.nlargest(pagesize * page, self.candidates, key=lambda k: k[self.score_key])
+        return top_candidates[(pagesize * (page-1)):]
+
+    def score(self, my_id):
+        return self.score_by_id.get(my_id, None)
@@ -0,0 +1,108 @@
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache with a per-entry TTL, local to one worker process.
+
+    get_or_compute() makes sure only one thread computes a given key at a time;
+    other threads asking for the same key wait for that result instead of
+    doing the work again.
+    """
+
+    def __init__(self, max_entries=500, ttl_seconds=60*60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._in_flight = {}  # key -> threading.Event
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def get(self, key):
+        with self._lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+        (expires_at, value) = entry
+        if expires_at < time():
+            del self._entries[key]
+            return None
+        # move to the end, so it's the most recently used
+        del self._entries[key]
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value):
+        if value is None:
+            return
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+            self._entries[key] = (time() + self.ttl_seconds, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute_function):
+        """
+        Returns (value, was_hit).  compute_function is only called on a miss,
+        and only by one thread per key.
+        """
+        while True:
+            with self._lock:
+                value = self._get_locked(key)
+                if value is not None:
+                    self.hits += 1
+                    return (value, True)
+
+                in_flight_event = self._in_flight.get(key, None)
+                if in_flight_event is None:
+                    in_flight_event = threading.Event()
+                    self._in_flight[key] = in_flight_event
+                    self.misses += 1
+                    break
+                self.waits += 1
+
+            # someone else is computing it.  wait for them, then look again.
+            # if they failed we go around and compute it ourselves.
+            in_flight_event.wait()
+
+        try:
+            value = compute_function()
+            self.set(key, value)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight_event.set()
+
+        return (value, False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "waits": self.waits,
+            "size": len(self._entries)
+        }
+
+
+search_response_cache = ResponseCache(
+    max_entries=int(os.getenv("SEARCH_RESPONSE_CACHE_SIZE", 500)),
+    ttl_seconds=int(os.getenv("SEARCH_RESPONSE_CACHE_TTL", 60*60))
+)
+
+
+def search_response_cache_key(query, page, pagesize, oa_only, return_full_api_response, no_live_calls):
+    normalized_query = u" ".join(query.lower().split())
+    return (normalized_query, page, pagesize, bool(oa_only), bool(return_full_api_response), bool(no_live_calls))
@@ -1,149 +1,320 @@
-from multiprocessing.pool import ThreadPool
-import requests
 import argparse
 import os
+import logging
+import threading
+import Queue
 from time import time
 from time import sleep
 import datetime
-from sqlalchemy.dialects.postgresql import JSONB
+from multiprocessing.pool import ThreadPool
 from sqlalchemy import sql
-from sqlalchemy import orm
 import json
 
 from app import db
-from pub import call_dandelion
-from pub import PubDoi
-from pub import Dandelion
-from util import elapsed
-from util import safe_commit
+from annotators import annotator
+from annotators import get_annotator
+from dandelion_client import dandelion_client
 from util import TooManyRequestsException
 
 
-def call_dandelion_on_article(my_queue_save_obj):
-    dandelion_results = None
-    error = None
-    rate_limit_exceeded = False
-    batch_api_key = os.getenv("DANDELION_API_KEYS_FOR_BATCH")
+# backfills dandelion_by_doi for popular papers as a pipeline:
+#   producer:  pages through the papers without annotations, most events first,
+#              with keyset pagination and not exists
+#   annotator: calls dandelion on a few chunks of papers at once, backing off
+#              when we're low on api units, or uses a local annotator instead
+#   writer:    upserts the results in batches with insert ... on conflict
+# each stage reports how many papers it handled and how fast.
+#
+# usage:
+# python save_annotations.py --concurrency 4 --chunk-size 10 --write-batch-size 100
+
 
-    if not my_queue_save_obj:
-        error = "no my_queue_save_obj"
-        print "x",
-
-    if not hasattr(my_queue_save_obj, "my_pub") or not my_queue_save_obj.my_pub:
-        # print u"no pub for {}, returning".format(my_queue_save_obj.pmid)
-        error = "no pub object"
-        print "n",
-    else:
-        print "y",
-
-    if not error and not rate_limit_exceeded:
-        try:
-            if not rate_limit_exceeded and my_queue_save_obj.my_pub:
-                my_text = my_queue_save_obj.my_pub.article_title
-                dandelion_results = call_dandelion(my_text, batch_api_key)
-                my_queue_save_obj.dandelion_raw_article_title = dandelion_results
-
-            if not rate_limit_exceeded and my_queue_save_obj.my_pub:
-                my_text = my_queue_save_obj.my_pub.abstract_text
-                dandelion_results = call_dandelion(my_text, batch_api_key)
-                my_queue_save_obj.dandelion_raw_abstract_text = json.dumps(dandelion_results) # this one is a string for some reason
-
-        except TooManyRequestsException:
-            print "!",
-            error = u"TooManyRequestsException"
-            rate_limit_exceeded = True
-
-    my_queue_save_obj.dandelion_collected = datetime.datetime.utcnow()
+def call_dandelion_on_articles(articles, my_annotator=annotator):
+    """
+    Annotates the title and abstract of each article dict, in place.  Returns
+    (error, rate_limit_exceeded, failed_articles).  On a rate limit nothing is
+    annotated, so the articles can be retried.  An article whose title or
+    abstract got no answer (a deadline, retries running out, a connection
+    error) is left unannotated and returned in failed_articles, so it isn't
+    written and the next pass tries it again.
+    """
+    batch_api_key = os.getenv("DANDELION_API_KEYS_FOR_BATCH")
+    my_texts = [a["article_title"] for a in articles] + [a["abstract_text"] for a in articles]
     try:
-        db.session.merge(my_queue_save_obj)
-        safe_commit(db)
-    except Exception, e:
-        print e
-    print ".",
-    return (dandelion_results, error, rate_limit_exceeded)
+        results = my_annotator.annotate_texts(my_texts, batch_api_key)
+    except TooManyRequestsException:
+        print "!",
+        return (u"TooManyRequestsException", True, [])
 
+    failed_articles = []
+    for (i, article) in enumerate(articles):
+        title_results = results[i]
+        abstract_results = results[len(articles) + i]
+        if (article["article_title"] and title_results is None) or (article["abstract_text"] and abstract_results is None):
+            failed_articles.append(article)
+            continue
+        article["dandelion_raw_article_title"] = title_results
+        article["dandelion_raw_abstract_text"] = json.dumps(abstract_results) # this one is a string for some reason
+        article["dandelion_collected"] = datetime.datetime.utcnow()
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run stuff.")
+    error = None
+    if failed_articles:
+        error = u"no annotations for {} of {} papers".format(len(failed_articles), len(articles))
+    return (error, False, failed_articles)
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, count, seconds):
+        with self._lock:
+            self.count += count
+            self.busy_seconds += seconds
+
+    def report(self, run_seconds):
+        per_minute = round(60 * self.count / max(run_seconds, 0.001), 1)
+        return u"{}: {} ({}/min, busy {}s)".format(self.name, self.count, per_minute, round(self.busy_seconds, 1))
+
+
+class AnnotationBackfill(object):
+
+    def __init__(self, page_size=200, chunk_size=10, concurrency=4, write_batch_size=100,
+                 min_num_events=5, units_reserve=1000, idle_sleep_seconds=5*60, my_annotator=annotator):
+        self.page_size = page_size
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.write_batch_size = write_batch_size
+        self.min_num_events = min_num_events
+        self.units_reserve = units_reserve
+        self.idle_sleep_seconds = idle_sleep_seconds
+        self.annotator = my_annotator
+
+        # bounded, so the producer can't get far ahead of dandelion
+        self.chunks_to_annotate = Queue.Queue(maxsize=concurrency * 2)
+        self.articles_to_write = Queue.Queue(maxsize=write_batch_size * 4)
+        self.stats = {
+            "produce": StageStats("produced"),
+            "annotate": StageStats("annotated"),
+            "fail": StageStats("failed, left for the next pass"),
+            "write": StageStats("written")
+        }
+        self.start_time = time()
+
+    # producer
+
+    def fetch_page(self, after):
+        # keyset pagination on (num_events, doi), most events first, so newly
+        # popular papers get annotated before the long tail
+        keyset_clause = u""
+        if after:
+            keyset_clause = u"and (sort_results.num_events, sort_results.doi) < (:after_num_events, :after_doi)"
+        query_string = u"""
+            select sort_results.doi, sort_results.pmid, sort_results.num_events, sort_results.article_title
+            from ricks_gtr_sort_results sort_results
+            where sort_results.num_events >= :min_num_events
+            and sort_results.doi is not null
+            and not exists (select 1 from dandelion_by_doi where dandelion_by_doi.doi = sort_results.doi)
+            {keyset_clause}
+            order by sort_results.num_events desc, sort_results.doi desc
+            limit :page_size
+            """.format(keyset_clause=keyset_clause)
+        params = {"min_num_events": self.min_num_events, "page_size": self.page_size}
+        if after:
+            (params["after_num_events"], params["after_doi"]) = after
+        rows = db.engine.execute(sql.text(query_string), **params).fetchall()
+
+        abstracts = {}
+        pmids = []
+        for row in rows:
+            try:
+                pmids.append(int(row["pmid"]))
+            except (TypeError, ValueError):
+                pass
+        if pmids:
+            abstract_rows = db.engine.execute(
+                sql.text(u"select pmid, abstract_text from medline_citation where pmid = any(:pmids)"),
+                pmids=pmids).fetchall()
+            abstracts = dict((int(r[0]), r[1]) for r in abstract_rows)
+
+        articles = []
+        for row in rows:
+            try:
+                pmid = int(row["pmid"])
+            except (TypeError, ValueError):
+                # dandelion_by_doi.pmid is numeric
+                pmid = None
+            articles.append({
+                "doi": row["doi"],
+                "pmid": pmid,
+                "num_events": row["num_events"],
+                "article_title": row["article_title"],
+                "abstract_text": abstracts.get(pmid, None) or ""
+            })
+        return articles
+
+    def produce(self):
+        after = None
+        written_before_pass = 0
+        while True:
+            start = time()
+            articles = self.fetch_page(after)
+            self.stats["produce"].add(len(articles), time() - start)
 
-    # just for updating lots
-    # parser.add_argument('file_name', type=str, help="filename to import")
-    # parser.add_argument('campaign', type=str, help="name of campaign")
-    # parser.add_argument('--limit', "-l", nargs="?", type=int, help="how many lines to import")
-    # parser.add_argument('--just_add_twitter', nargs="?", type=bool, default=False, help="just add twitter")
-    parsed = parser.parse_args()
+            if not articles:
+                # let everything in flight get written, so the next pass doesn't see it again
+                self.chunks_to_annotate.join()
+                self.articles_to_write.join()
+                # papers that failed are still there; go straight back for them
+                # unless this pass got nothing written at all
+                if after is None or self.stats["write"].count == written_before_pass:
+                    print u"no papers we can annotate right now, sleeping {}s".format(self.idle_sleep_seconds)
+                    sleep(self.idle_sleep_seconds)
+                after = None
+                written_before_pass = self.stats["write"].count
+                continue
 
-    start = time()
+            after = (articles[-1]["num_events"], articles[-1]["doi"])
+            for i in range(0, len(articles), self.chunk_size):
+                self.chunks_to_annotate.put(articles[i:i + self.chunk_size])
 
-    if __name__ == '__main__':
+    # annotator
+
+    def wait_for_units(self):
+        if self.annotator.is_local:
+            return
+        while dandelion_client.last_units_left < self.units_reserve:
+            print u"only {} dandelion units left, waiting".format(dandelion_client.last_units_left)
+            sleep(60)
+            # the next call will tell us whether they've been topped up
+            dandelion_client.last_units_left = float("inf")
+
+    def annotate_chunk(self, articles):
         while True:
-            query = u"""select ricks_gtr_sort_results.doi, pmid, num_events from ricks_gtr_sort_results 
-                where ricks_gtr_sort_results.doi not in (select doi from dandelion_by_doi) 
-                and num_events is not null 
-                and num_events >= 5
-                and doi is not null
-                limit 25 
-                """
-            rows = db.engine.execute(sql.text(query)).fetchall()
-            lookup = {}
-            if rows:
-                dois = [row[0] for row in rows]
-                for row in rows:
-                    lookup[row[0]] = {"doi": row[0], "num_events": int(row[2]), "used": False}
-            else:
-                print "no rows without dandelions, so sleeping"
-                sleep(60*60)
-
-            # print pmids
-            my_pubs = db.session.query(PubDoi).filter(PubDoi.doi.in_(dois)).options(orm.noload('*')).all()
-            my_dandelions = []
-            for my_pub in my_pubs:
-                my_dandelion = Dandelion()
-                my_dandelion.doi = lookup[my_pub.doi]["doi"]
-                my_dandelion.num_events = lookup[my_pub.doi]["num_events"]
-                lookup[my_pub.doi]["used"] = True
-                my_dandelion.my_pub = my_pub
-                db.session.add(my_dandelion)
-                my_dandelions.append(my_dandelion)
-            for (doi, my_dict) in lookup.iteritems():
-                if not my_dict["used"]:
-                    print "#",
-                    my_dandelion = Dandelion()
-                    my_dandelion.doi = my_dict["doi"]
-                    my_dandelion.num_events = my_dict["num_events"]
-                    db.session.add(my_dandelion)
-                    # but don't append it; it doesn't need to get run
-
-            safe_commit(db)
-
-            print "now calling dandelion"
-
-            use_multithreaded = False
-            if use_multithreaded:
-                my_thread_pool = ThreadPool(50)
-                results = my_thread_pool.imap_unordered(call_dandelion_on_article, my_dandelions)
-                my_thread_pool.close()
-                my_thread_pool.join()
-                my_thread_pool.terminate()
-
-            else:
-                results = []
-                for my_dandelion in my_dandelions:
-                    results.append(call_dandelion_on_article(my_dandelion))
+            self.wait_for_units()
+            start = time()
+            (error, rate_limit_exceeded, failed_articles) = call_dandelion_on_articles(articles, self.annotator)
+            if not rate_limit_exceeded:
+                break
+            print u"rate limit exceeded, sleeping for a few minutes before retrying"
+            sleep(60*5)
+        if error:
+            print error
+        # papers that got no annotations aren't written, so the next pass sees them again
+        failed_dois = set([article["doi"] for article in failed_articles])
+        annotated_articles = [article for article in articles if article["doi"] not in failed_dois]
+        self.stats["annotate"].add(len(annotated_articles), time() - start)
+        self.stats["fail"].add(len(failed_articles), 0)
+        for article in annotated_articles:
+            self.articles_to_write.put(article)
+
+    def annotate(self):
+        my_thread_pool = ThreadPool(self.concurrency)
+        in_flight = threading.BoundedSemaphore(self.concurrency)
 
+        def run_chunk(articles):
+            # runs on a pool thread; a failed chunk isn't written, so the
+            # producer will see it again on its next pass
             try:
-                for (my_result, my_error, rate_limit_exceeded) in results:
-                    if rate_limit_exceeded:
-                        print "sleeping for a few minutes because rate_limit_exceeded", my_error
-                        sleep(60*5)
-            except Exception as e:
-                print e
-                print "sleeping for a minute"
-                sleep(60)
+                self.annotate_chunk(articles)
+            except Exception:
+                logging.exception(u"error annotating {} papers".format(len(articles)))
+            finally:
+                in_flight.release()
+                self.chunks_to_annotate.task_done()
+
+        while True:
+            articles = self.chunks_to_annotate.get()
+            in_flight.acquire()
+            my_thread_pool.apply_async(run_chunk, (articles, ))
 
-            # print results
+    # writer
 
-            db.session.remove()
-            # print "finished update in {}sec".format(elapsed(start))
-            print "*",
+    def write_batch(self, articles):
+        # postgres won't let one insert ... on conflict touch a row twice
+        articles = dict((article["doi"], article) for article in articles).values()
+        values = []
+        params = {}
+        for (i, article) in enumerate(articles):
+            values.append(u"(:doi_{i}, :pmid_{i}, :num_events_{i}, :collected_{i}, cast(:title_{i} as jsonb), :abstract_{i})".format(i=i))
+            params.update({
+                "doi_{}".format(i): article["doi"],
+                "pmid_{}".format(i): article["pmid"],
+                "num_events_{}".format(i): article["num_events"],
+                "collected_{}".format(i): article["dandelion_collected"],
+                "title_{}".format(i): json.dumps(article["dandelion_raw_article_title"]),
+                "abstract_{}".format(i): article["dandelion_raw_abstract_text"]
+            })
+        query_string = u"""
+            insert into dandelion_by_doi (doi, pmid, num_events, dandelion_collected, dandelion_raw_article_title, dandelion_raw_abstract_text)
+            values {values}
+            on conflict (doi) do update set
+                pmid=excluded.pmid,
+                num_events=excluded.num_events,
+                dandelion_collected=excluded.dandelion_collected,
+                dandelion_raw_article_title=excluded.dandelion_raw_article_title,
+                dandelion_raw_abstract_text=excluded.dandelion_raw_abstract_text
+            """.format(values=u",\n".join(values))
+        db.engine.execute(sql.text(query_string), **params)
+
+    def write(self):
+        batch = []
+        while True:
+            try:
+                # flush a partial batch if nothing has come in for a few seconds
+                batch.append(self.articles_to_write.get(timeout=5))
+            except Queue.Empty:
+                pass
+            if batch and (len(batch) >= self.write_batch_size or self.articles_to_write.empty()):
+                start = time()
+                try:
+                    self.write_batch(batch)
+                    self.stats["write"].add(len(batch), time() - start)
+                except Exception:
+                    logging.exception(u"error writing {} annotations".format(len(batch)))
+                for article in batch:
+                    self.articles_to_write.task_done()
+                batch = []
+
+    def report(self):
+        while True:
+            sleep(60)
+            run_seconds = time() - self.start_time
+            print u"after {}s: {}; {} chunks waiting for dandelion, {} papers waiting to be written".format(
+                int(run_seconds),
+                u", ".join(self.stats[stage].report(run_seconds) for stage in ["produce", "annotate", "fail", "write"]),
+                self.chunks_to_annotate.qsize(),
+                self.articles_to_write.qsize())
+
+    def run(self):
+        for stage in [self.annotate, self.write, self.report]:
+            my_thread = threading.Thread(target=stage)
+            my_thread.daemon = True
+            my_thread.start()
+        self.produce()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill dandelion annotations for popular papers.")
+    parser.add_argument('--page-size', nargs="?", type=int, default=200, help="papers per producer query")
+    parser.add_argument('--chunk-size', nargs="?", type=int, default=10, help="papers per dandelion task")
+    parser.add_argument('--concurrency', nargs="?", type=int, default=4, help="dandelion tasks at once")
+    parser.add_argument('--write-batch-size', nargs="?", type=int, default=100, help="rows per upsert")
+    parser.add_argument('--min-num-events', nargs="?", type=int, default=5, help="only papers with at least this many events")
+    parser.add_argument('--units-reserve', nargs="?", type=int, default=int(os.getenv("DANDELION_UNITS_RESERVE", 1000)),
+                        help="pause when dandelion says fewer units than this are left")
+    parser.add_argument('--annotator', nargs="?", type=str, default=os.getenv("ANNOTATOR", "dandelion"),
+                        help="dandelion, or gazetteer to annotate locally; see annotators.py")
+    parsed_args = parser.parse_args()
 
+    my_backfill = AnnotationBackfill(page_size=parsed_args.page_size,
+                                     chunk_size=parsed_args.chunk_size,
+                                     concurrency=parsed_args.concurrency,
+                                     write_batch_size=parsed_args.write_batch_size,
+                                     min_num_events=parsed_args.min_num_events,
+                                     units_reserve=parsed_args.units_reserve,
+                                     my_annotator=get_annotator(parsed_args.annotator))
+    my_backfill.run()
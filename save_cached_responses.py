@@ -1,122 +1,180 @@
 from multiprocessing.pool import ThreadPool
-import requests
 import argparse
 import os
+import json
+import logging
 from time import time
-from time import sleep
 import datetime
-from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy import sql
-from sqlalchemy import orm
-from sqlalchemy import or_
-import json
-from sqlalchemy.orm.attributes import flag_modified
 
 from app import db
-from pub import call_dandelion
-from pub import Pub
-from pub import Dandelion
 from util import elapsed
-from util import safe_commit
-from util import TooManyRequestsException
-from entity import stop_words
-from search import CachedEntityResponse
-from views import get_search_query
-
-def cache_api_response(my_saved_object):
-    entity_term  = my_saved_object.entity_title
-    entity_term = entity_term.replace(u" ", u"_")
-
-    url = u"https://gtr-api.herokuapp.com/search/{}?automated=true&nocache=true".format(entity_term)
-    r = requests.get(url)
-    print r
-    print url
-    my_saved_object.api_response = r.json()
-    flag_modified(my_saved_object, "api_response")  # required, to force sqlalchemy to update because jsonb
-
-    url = u"https://gtr-api.herokuapp.com/search/{}?oa=true&automated=true&nocache=true".format(entity_term)
-    r = requests.get(url)
-    print r
-    print url
-    my_saved_object.api_response_oa_only = r.json()
-    flag_modified(my_saved_object, "api_response_oa_only")  # required, to force sqlalchemy to update because jsonb
-
-    my_saved_object.collected = datetime.datetime.utcnow()
-    db.session.merge(my_saved_object)
-    safe_commit(db)
-    print ".",
-
-    return
+from search import entity_search_both_oa
+from search import fulltext_search_title
+from search import save_cached_api_responses
+from views import render_search_response
+
+
+# warms cached_entity_response (and cached_entity_response_body) for the
+# autocomplete entities, by running the search pipeline in this process
+# rather than calling the api over http.  most popular and least recently
+# refreshed first.  progress is checkpointed, so a restarted run picks up the
+# same refresh where it left off instead of starting a new one.
+#
+# usage:
+# python save_cached_responses.py --threads 8 --batch-size 50
+# python save_cached_responses.py --before 2019-01-01
+# python save_cached_responses.py --entity "Gluten-free diet"
+
+default_checkpoint_path = os.getenv("CACHE_WARMER_CHECKPOINT", "cache_warmer_checkpoint.json")
+
+
+def render_entity_responses(entity_title):
+    """
+    The page 1 responses /search/<entity_title> and /search/<entity_title>?oa=true
+    would send, from one candidate fetch.  Returns (api_response, api_response_oa_only).
+    """
+    query_entities = [entity_title]
+    candidates_by_oa = entity_search_both_oa(query_entities)
+
+    responses = []
+    for oa_only in [False, True]:
+        (pubs_to_sort, num_candidates) = candidates_by_oa[oa_only]
+        if num_candidates < 25:
+            # the api would go on to a title search for this one
+            (pubs_to_sort, num_candidates, time_for_dois, time_for_pubs) = fulltext_search_title(
+                entity_title, query_entities, oa_only)
+        response = render_search_response(pubs_to_sort, num_candidates, page=1, pagesize=10, oa_only=oa_only,
+                                          return_full_api_response=True, no_live_calls=False,
+                                          query_entities=query_entities)
+        responses.append(response)
+    return tuple(responses)
+
+
+def warm_entity(entity_title):
+    # runs on a pool thread; returns (entity_title, responses or None, seconds)
+    start_time = time()
+    try:
+        responses = render_entity_responses(entity_title)
+    except Exception:
+        logging.exception(u"error warming {}".format(entity_title))
+        responses = None
+    finally:
+        # the scoped session is per thread; don't let loaded pubs pile up in it
+        db.session.remove()
+    return (entity_title, responses, elapsed(start_time, 2))
+
+
+def entities_to_warm(refresh_before, batch_size, skip_titles):
+    # never cached first, then most events, then stalest
+    query_string = u"""
+        select entities.entity_title
+        from search_autocomplete_dandelion_simple_mv entities
+        left join cached_entity_response cached on cached.entity_title = entities.entity_title
+        where entities.num_papers >= 25
+        and (cached.collected is null or cached.collected < :refresh_before)
+        and not (entities.entity_title = any(:skip_titles))
+        order by cached.collected is not null, entities.sum_num_events desc, cached.collected asc
+        limit :batch_size
+        """
+    rows = db.engine.execute(sql.text(query_string),
+                             refresh_before=refresh_before,
+                             skip_titles=list(skip_titles),
+                             batch_size=batch_size).fetchall()
+    return [row[0] for row in rows]
+
+
+def load_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (IOError, ValueError):
+        return None
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    # write then rename, so a killed run never leaves half a file
+    temp_path = checkpoint_path + ".tmp"
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(temp_path, checkpoint_path)
+
+
+def run(refresh_before, batch_size, num_threads, checkpoint_path, single_entity_title=None):
+    # whole seconds, so the checkpointed value round-trips exactly
+    refresh_before = refresh_before.replace(microsecond=0)
+    checkpoint = load_checkpoint(checkpoint_path)
+    if single_entity_title:
+        checkpoint = None
+    elif checkpoint and checkpoint["refresh_before"] == refresh_before.isoformat():
+        print u"resuming refresh of entities cached before {}: {} done, {} failed so far".format(
+            checkpoint["refresh_before"], checkpoint["num_done"], len(checkpoint["failed"]))
+    else:
+        checkpoint = {"refresh_before": refresh_before.isoformat(), "num_done": 0, "failed": []}
+
+    my_thread_pool = ThreadPool(num_threads)
+    start_time = time()
+    num_done = 0
+
+    while True:
+        if single_entity_title:
+            entity_titles = [single_entity_title]
+        else:
+            entity_titles = entities_to_warm(refresh_before, batch_size, checkpoint["failed"])
+        if not entity_titles:
+            print u"nothing to do"
+            if checkpoint and os.path.exists(checkpoint_path):
+                # this refresh is finished, so the next run starts a new one
+                os.remove(checkpoint_path)
+            break
+
+        batch_start_time = time()
+        results = my_thread_pool.map(warm_entity, entity_titles)
+
+        collected = datetime.datetime.utcnow()
+        entries = []
+        for (entity_title, responses, seconds) in results:
+            if responses:
+                entries.append((entity_title, collected, responses[0], responses[1]))
+            elif checkpoint:
+                checkpoint["failed"].append(entity_title)
+        write_start_time = time()
+        save_cached_api_responses(entries)
+        write_elapsed = elapsed(write_start_time, 2)
+
+        num_done += len(entries)
+        render_seconds = [seconds for (entity_title, responses, seconds) in results]
+        print u"warmed {} of {} entities in {}s (slowest {}s, write {}s); {} total, {} entities/minute".format(
+            len(entries), len(entity_titles), elapsed(batch_start_time, 2), max(render_seconds), write_elapsed,
+            num_done, round(60 * num_done / (time() - start_time), 1))
+
+        if single_entity_title:
+            break
+        checkpoint["num_done"] += len(entries)
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    my_thread_pool.close()
+    my_thread_pool.join()
+    print u"done: {} entities in {}s".format(num_done, elapsed(start_time, 1))
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run stuff.")
-    parser.add_argument('--before', nargs="?", type=str, help="date before to dirty cache")
+    parser = argparse.ArgumentParser(description="Warm the cached entity responses.")
+    parser.add_argument('--before', nargs="?", type=str, help="refresh entities cached before this date; default is now")
     parser.add_argument('--entity', nargs="?", type=str, help="entity to refresh")
+    parser.add_argument('--batch-size', nargs="?", type=int, default=50, help="entities per batch, and per bulk write")
+    parser.add_argument('--threads', nargs="?", type=int, default=8, help="entities rendered at once")
+    parser.add_argument('--checkpoint', nargs="?", type=str, default=default_checkpoint_path, help="checkpoint file")
     parsed_args = parser.parse_args()
-    parsed_vars = vars(parsed_args)
-
-    start = time()
-
-    before_date = datetime.datetime.utcnow()
-
-    if __name__ == '__main__':
-        something_to_do = True
-        while something_to_do:
-            # query = u"""select * from search_autocomplete_dandelion_mv
-            #     where entity_title not in (select entity_title from cached_entity_response)
-            #     order by sum_num_events desc
-            #     limit 25
-            #     """
-            # rows = db.engine.execute(sql.text(query)).fetchall()
-            # query = u"""select * from cached_entity_response
-            #     where created < :collected :: timestamp
-            #     order by created desc
-            #     limit 25
-            #     """
-            # rows = db.engine.execute(sql.text(query), collected=collected).fetchall()
-            # entity_titles = [row[0] for row in rows]
-            # for entity_title in entity_titles:
-            #     my_saved_object = CachedEntityResponse.get(entity_title)
-            #     if not my_saved_object:
-            #         print u"object not found, creating"
-            #         my_saved_object = CachedEntityResponse(entity_title=entity_title)
-            #         db.session.add(my_saved_object)
-            #     my_saved_objects.append(my_saved_object)
-
-
-            before_date = parsed_vars.get("before", None)
-            debug = parsed_vars.get("debug", None)
-            single_entity_title = parsed_vars.get("entity", None)
-            # single_entity_title =  'Gluten-free diet'
-
-            my_saved_objects = []
-            if single_entity_title:
-                my_saved_objects = CachedEntityResponse.query.filter(CachedEntityResponse.entity_title.ilike(single_entity_title)).\
-                    order_by(CachedEntityResponse.collected.asc()).limit(25).all()
-                something_to_do = False  # only do this once
-
-            elif before_date:
-                my_saved_objects = CachedEntityResponse.query.\
-                    filter(or_(CachedEntityResponse.collected==None, CachedEntityResponse.collected < before_date)).\
-                    order_by(CachedEntityResponse.collected.asc()).limit(25).all()
-
-            if my_saved_objects:
-                use_threads = not debug  # useful to turn off pooling to help debugging
-                if use_threads:
-                    my_thread_pool = ThreadPool(20)
-                    results = my_thread_pool.imap_unordered(cache_api_response, my_saved_objects)
-                    my_thread_pool.close()
-                    my_thread_pool.join()
-                    my_thread_pool.terminate()
-                else:
-                    for my_saved_object in my_saved_objects:
-                        cache_api_response(my_saved_object)
-            else:
-                print "nothing to do"
-                something_to_do = False
-
-            db.session.remove()
-            # print "finished update in {}sec".format(elapsed(start))
-            print "*",
 
+    if parsed_args.before:
+        refresh_before = datetime.datetime.strptime(parsed_args.before[0:10], "%Y-%m-%d")
+    else:
+        # resume the checkpointed refresh if there is one, otherwise refresh everything
+        checkpoint = load_checkpoint(parsed_args.checkpoint)
+        if checkpoint:
+            refresh_before = datetime.datetime.strptime(checkpoint["refresh_before"][0:19], "%Y-%m-%dT%H:%M:%S")
+        else:
+            refresh_before = datetime.datetime.utcnow()
+
+    run(refresh_before, parsed_args.batch_size, parsed_args.threads, parsed_args.checkpoint, parsed_args.entity)
@@ -2,10 +2,12 @@ from sqlalchemy import sql
 from sqlalchemy import orm
 from sqlalchemy.dialects.postgresql import JSONB
 from time import time
+import os
 import requests
 import re
 import math
 import decimal
+import numpy
 
 from app import db
 from pub import Pub
@@ -13,6 +15,14 @@ from pub import pub_type_lookup
 from util import elapsed
 from util import is_doi
 from util import clean_doi
+from json_stream import json_bytes
+from json_stream import iter_gzip
+from autocomplete_index import autocomplete_index
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 
@@ -63,6 +73,83 @@ def adjusted_score(my_dict):
     return score
 
 
+# for adjusted_scores.  pub types get integer codes in increasing order of evidence
+# level, so the highest code a pub has is also its highest level.  code 0 is "none".
+pub_type_labels_by_level = sorted(pub_type_lookup.keys(), key=lambda k: pub_type_lookup[k][2])
+pub_type_codes = dict((label, code + 1) for (code, label) in enumerate(pub_type_labels_by_level))
+pub_type_code_levels = numpy.array([-10] + [pub_type_lookup[label][2] for label in pub_type_labels_by_level], dtype=numpy.float64)
+decimal_tenth = decimal.Decimal('0.1')
+pub_type_single_characters = [label for label in pub_type_lookup if len(label) == 1]
+pub_type_news_codes = set([pub_type_codes[label] for label in pub_type_lookup if pub_type_lookup[label][1] == "news and interest"])
+
+
+def adjusted_scores(my_dicts):
+    """
+    adjusted_score for all the candidates at once, same results.
+
+    The per-row work is just pulling each field into a column (keeping the exact
+    truthiness and Decimal handling adjusted_score has), then the arithmetic runs
+    over the columns in the same order adjusted_score does it, so the floats match.
+    """
+    num_rows = len(my_dicts)
+    if not num_rows:
+        return []
+
+    # plain lists while walking the rows, assigning into numpy arrays one item at a time is slow
+    raw_scores = [0] * num_rows
+    short_abstract = [False] * num_rows
+    no_events = [False] * num_rows
+    has_news = [False] * num_rows
+    news_plus_tenth = [1] * num_rows
+    max_pub_type_codes = [0] * num_rows
+    has_news_pub_type = [False] * num_rows
+    english_abstract = [False] * num_rows
+    acronym_matches = [0] * num_rows
+
+    for (i, my_dict) in enumerate(my_dicts):
+        raw_scores[i] = my_dict.get("score") or 0
+        short_abstract[i] = my_dict["abstract_length"] < 10
+        no_events[i] = not my_dict["num_events"]
+        if my_dict["num_news_events"]:
+            has_news[i] = True
+            news_plus_tenth[i] = float(decimal_tenth + my_dict.get("num_news_events", 0))
+
+        if my_dict["pub_types"]:
+            if isinstance(my_dict["pub_types"], basestring) and not pub_type_single_characters:
+                # adjusted_score iterates this text a character at a time, which can't match a label
+                codes = []
+            else:
+                codes = [pub_type_codes[pubmed_label] for pubmed_label in my_dict["pub_types"] if pubmed_label in pub_type_codes]
+            if codes:
+                max_pub_type_codes[i] = max(codes)
+                has_news_pub_type[i] = not pub_type_news_codes.isdisjoint(codes)
+            english_abstract[i] = "English Abstract" in my_dict["pub_types"]
+
+        if my_dict["query_entities"]:
+            article_title = my_dict.get("article_title") or ""
+            for query_entity in my_dict["query_entities"]:
+                if u"({})".format(query_entity.upper()) in article_title:
+                    acronym_matches[i] += 1
+
+    raw_scores = numpy.array(raw_scores, dtype=numpy.float64)
+    news_plus_tenth = numpy.array(news_plus_tenth, dtype=numpy.float64)
+    acronym_matches = numpy.array(acronym_matches, dtype=numpy.float64)
+    max_pub_type_codes = numpy.array(max_pub_type_codes, dtype=numpy.int64)
+    max_levels = pub_type_code_levels[max_pub_type_codes]
+
+    scores = numpy.log10(.1 + raw_scores) * 5
+    scores -= numpy.where(short_abstract, 10.0, 0.0)
+    scores -= numpy.where(no_events, 5.0, 0.0)
+    scores += numpy.where(has_news, numpy.log10(news_plus_tenth) * 4, 0.0)
+    scores += numpy.where(max_levels > 1, max_levels * 1.0, 0.0)
+    scores += numpy.where(has_news_pub_type, 2.0, 0.0)
+    scores += numpy.where(english_abstract, -5.0, 0.0)
+    # multiplying by 0.25 n times is exact, so one power is the same as the loop
+    scores *= numpy.power(0.25, acronym_matches)
+
+    return scores.tolist()
+
+
 class CachedEntityResponse(db.Model):
     __tablename__ = "cached_entity_response"
     entity_title = db.Column(db.Text, primary_key=True)
@@ -78,25 +165,339 @@ def get_cached_api_response(entity_title, oa_only):
     return response
 
 
-def fulltext_search_title(original_query, query_entities, oa_only, full=True):
+# the same cached responses, already serialized and compressed, so a hit is
+# sent as stored bytes instead of jsonb -> dict -> json -> gzip every time
+class CachedEntityResponseBody(db.Model):
+    __tablename__ = "cached_entity_response_body"
+    entity_title = db.Column(db.Text, primary_key=True)
+    oa_only = db.Column(db.Boolean, primary_key=True)
+    collected = db.Column(db.DateTime)
+    json_body = db.Column(db.LargeBinary)
+    gzip_body = db.Column(db.LargeBinary)
+    brotli_body = db.Column(db.LargeBinary)
+
+
+def cached_response_body_bytes(api_response, collected):
+    """
+    (json, gzip, brotli) bytes for a cached api response.  _cached_on goes in
+    the body since it's fixed; _timing is left out and sent as a header.
+    brotli is None if the brotli module isn't installed.
+    """
+    body = dict(api_response)
+    body.pop("_timing", None)
+    body["_cached_on"] = collected.isoformat()
+    json_body = json_bytes(body)
+    gzip_body = "".join(iter_gzip([json_body], level=9))
+    brotli_body = None
+    if brotli:
+        brotli_body = brotli.compress(json_body)
+    return (json_body, gzip_body, brotli_body)
+
+
+def save_cached_api_response_body(entity_title, oa_only, api_response, collected):
+    save_cached_api_response_bodies([(entity_title, oa_only, api_response, collected)])
+
+
+def save_cached_api_response_bodies(entries):
+    # entries are (entity_title, oa_only, api_response, collected); one multi-row upsert
+    values = []
+    params = {}
+    for (i, (entity_title, oa_only, api_response, collected)) in enumerate(entries):
+        if not api_response:
+            continue
+        (json_body, gzip_body, brotli_body) = cached_response_body_bytes(api_response, collected)
+        values.append(u"(:entity_title_{i}, :oa_only_{i}, :collected_{i}, :json_body_{i}, :gzip_body_{i}, :brotli_body_{i})".format(i=i))
+        params.update({
+            "entity_title_{}".format(i): entity_title,
+            "oa_only_{}".format(i): bool(oa_only),
+            "collected_{}".format(i): collected,
+            "json_body_{}".format(i): json_body,
+            "gzip_body_{}".format(i): gzip_body,
+            "brotli_body_{}".format(i): brotli_body
+        })
+    if not values:
+        return
+
+    query_string = u"""
+        insert into cached_entity_response_body (entity_title, oa_only, collected, json_body, gzip_body, brotli_body)
+        values {values}
+        on conflict (entity_title, oa_only) do update set
+            collected=excluded.collected,
+            json_body=excluded.json_body,
+            gzip_body=excluded.gzip_body,
+            brotli_body=excluded.brotli_body
+        """.format(values=u",\n".join(values))
+    db.engine.execute(sql.text(query_string), **params)
+
+
+def save_cached_api_responses(entries):
+    """
+    Bulk version of what save_cached_responses used to do row by row with the
+    orm: entries are (entity_title, collected, api_response, api_response_oa_only).
+    Upserts cached_entity_response in one statement, then the body rows in another.
+    """
+    if not entries:
+        return
+    values = []
+    params = {}
+    for (i, (entity_title, collected, api_response, api_response_oa_only)) in enumerate(entries):
+        values.append(u"(:entity_title_{i}, :collected_{i}, cast(:api_response_{i} as jsonb), cast(:api_response_oa_only_{i} as jsonb))".format(i=i))
+        params.update({
+            "entity_title_{}".format(i): entity_title,
+            "collected_{}".format(i): collected,
+            "api_response_{}".format(i): json_bytes(api_response) if api_response else None,
+            "api_response_oa_only_{}".format(i): json_bytes(api_response_oa_only) if api_response_oa_only else None
+        })
+
+    query_string = u"""
+        insert into cached_entity_response (entity_title, collected, api_response, api_response_oa_only)
+        values {values}
+        on conflict (entity_title) do update set
+            collected=excluded.collected,
+            api_response=excluded.api_response,
+            api_response_oa_only=excluded.api_response_oa_only
+        """.format(values=u",\n".join(values))
+    db.engine.execute(sql.text(query_string), **params)
+
+    body_entries = []
+    for (entity_title, collected, api_response, api_response_oa_only) in entries:
+        body_entries += [(entity_title, False, api_response, collected),
+                         (entity_title, True, api_response_oa_only, collected)]
+    save_cached_api_response_bodies(body_entries)
+
+
+def get_cached_api_response_body(entity_title, oa_only, encodings):
+    """
+    Returns (body, content_encoding, collected) for the first of encodings
+    ("br", "gzip" or None for plain json) that's stored, or None if nothing is.
+    Only those columns are read.
+    """
+    columns = {"br": "brotli_body", "gzip": "gzip_body", None: "json_body"}
+    query_string = u"""
+        select collected, {columns}
+        from cached_entity_response_body
+        where entity_title=:entity_title and oa_only=:oa_only
+        """.format(columns=u", ".join(columns[encoding] for encoding in encodings))
+    row = db.engine.execute(sql.text(query_string), entity_title=entity_title, oa_only=bool(oa_only)).first()
+    if not row:
+        return None
+    for (encoding, body) in zip(encodings, row[1:]):
+        if body is not None:
+            return (str(body), encoding, row[0])
+    return None
+
+
+# everything adjusted_score needs, so the candidates come back ready to sort
+sort_data_columns = u"""
+    sort_results.pmid,
+    sort_results.doi,
+    sort_results.article_title,
+    sort_results.journal_title,
+    sort_results.pub_types,
+    sort_results.abstract_length,
+    sort_results.is_oa,
+    sort_results.num_events,
+    sort_results.num_news_events,
+    (ts_rank_cd(sort_results.article_title_tsv, to_tsquery(:query), 1) + 0.05*COALESCE(sort_results.num_events,0.0)) AS rank
+    """
+
+
+# article_title_tsv is a stored to_tsvector('english', article_title) with a gin
+# index on it, see bq.sql.  check_search_plans.py makes sure these keep using it.
+
+def doi_candidates_query():
+    return u"""
+        select {sort_data_columns}
+        from ricks_gtr_sort_results sort_results
+        where sort_results.doi = :doi
+        """.format(sort_data_columns=sort_data_columns)
+
+
+def title_candidates_query(oa_clause):
+    return u"""
+        select {sort_data_columns}
+        FROM ricks_gtr_sort_results sort_results
+        WHERE
+        sort_results.article_title_tsv @@ to_tsquery(:query)
+        and sort_results.doi is not null
+        {oa_clause}
+        order by rank desc
+        limit 120
+        """.format(sort_data_columns=sort_data_columns, oa_clause=oa_clause)
+
+
+def sql_adjusted_score(query_entities):
+    """
+    adjusted_score as a sql expression over the candidates cte, for ranking on the
+    database side.  returns (expression, bind params).
+
+    pub_types is the comma-joined text column, and adjusted_score iterates over it
+    as given, so like there only the "English Abstract" check can apply.
+    """
+    expression = u"""(
+        log(0.1 + COALESCE(candidates.rank, 0)) * 5
+        - case when COALESCE(candidates.abstract_length, 0) < 10 then 10 else 0 end
+        - case when COALESCE(candidates.num_events, 0) = 0 then 5 else 0 end
+        + case when COALESCE(candidates.num_news_events, 0) != 0 then log(0.1 + candidates.num_news_events) * 4 else 0 end
+        - case when position('English Abstract' in COALESCE(candidates.pub_types, '')) > 0 then 5 else 0 end
+        )"""
+    params = {}
+    for (i, query_entity) in enumerate(query_entities or []):
+        param_name = u"acronym_{}".format(i)
+        params[param_name] = u"({})".format(query_entity.upper())
+        expression += u" * case when position(:{} in COALESCE(candidates.article_title, '')) > 0 then 0.25 else 1 end".format(param_name)
+    return (expression, params)
+
+
+def fetch_sort_data(candidates_query, query_params, query_entities, prescore_limit=None):
+    """
+    Runs a candidates query that selects sort_data_columns, in one round trip.
+
+    With prescore_limit, the candidates are also ranked by sql_adjusted_score on
+    the database side and only the top prescore_limit rows are sent back.
+    Returns (rows, number of candidates).
+    """
+    if not prescore_limit:
+        rows = db.engine.execute(sql.text(candidates_query), **query_params).fetchall()
+        return (rows, len(rows))
+
+    (score_expression, score_params) = sql_adjusted_score(query_entities)
+    query_string = u"""
+        with candidates as ({candidates_query})
+        select candidates.*, count(*) over () as num_candidates
+        from candidates
+        order by {score_expression} desc
+        limit :prescore_limit
+        """.format(candidates_query=candidates_query, score_expression=score_expression)
+    params = dict(query_params)
+    params.update(score_params)
+    params["prescore_limit"] = prescore_limit
+    rows = db.engine.execute(sql.text(query_string), **params).fetchall()
+    num_candidates = 0
+    if rows:
+        num_candidates = rows[0]["num_candidates"]
+    return (rows, num_candidates)
+
+
+def entity_query_params(query_entity):
+    # returns (entity title to match, tsquery for ranking) for a single-entity search
+    query_entity = query_entity.replace("(", " ")
+    query_entity = query_entity.replace(")", " ")
+    query_entity = query_entity.replace("&", " ")
+
+    original_query_escaped = query_entity.replace("'", "''")
+    original_query_with_ands = ' & '.join(original_query_escaped.split(" "))
+    query_to_use = u"({})".format(original_query_with_ands)
+    return (query_entity, query_to_use)
+
+
+def entity_candidates_query(oa_clause):
+    # the sort data comes along in the same query, joined in
+    return u"""
+        select {sort_data_columns}
+        from (
+            select doi
+            from search_title_dandelion_simple_mv
+            where title=:query_entity
+            and num_events >= 3
+            {oa_clause}
+            order by num_events desc
+            limit 120
+        ) entity_hits
+        join ricks_gtr_sort_results sort_results on sort_results.doi = entity_hits.doi
+        """.format(sort_data_columns=sort_data_columns, oa_clause=oa_clause)
+
+
+def entity_candidates_both_oa_query():
+    """
+    The candidates entity_candidates_query would find with and without the oa
+    clause, in one scan: each hit is ranked among all hits and among the oa
+    ones, and kept if it's in the top 120 of either.
+    """
+    return u"""
+        select {sort_data_columns}, entity_hits.rank_all, entity_hits.rank_oa
+        from (
+            select doi,
+                row_number() over (order by num_events desc) as rank_all,
+                case when is_oa then row_number() over (partition by is_oa order by num_events desc) end as rank_oa
+            from search_title_dandelion_simple_mv
+            where title=:query_entity
+            and num_events >= 3
+        ) entity_hits
+        join ricks_gtr_sort_results sort_results on sort_results.doi = entity_hits.doi
+        where entity_hits.rank_all <= 120 or entity_hits.rank_oa <= 120
+        """.format(sort_data_columns=sort_data_columns)
+
+
+def sort_data_dicts(rows, query_to_use, query_entities):
+    # candidate rows as the dicts adjusted_score and RankedResults take, scored
+    my_dicts = []
+    for row in rows:
+        my_dict = {
+            "pmid": row["pmid"],
+            "doi": row["doi"],
+            "article_title": row["article_title"],
+            "journal_title": row["journal_title"],
+            "pub_types": row["pub_types"],
+            "abstract_length": row["abstract_length"],
+            "is_oa": row["is_oa"],
+            "num_events": row["num_events"],
+            "num_news_events": row["num_news_events"],
+            "score": row["rank"],
+            "query": query_to_use,
+            "query_entities": query_entities
+             }
+        my_dicts.append(my_dict)
+
+    for (my_dict, score) in zip(my_dicts, adjusted_scores(my_dicts)):
+        my_dict["adjusted_score"] = score
+    return my_dicts
+
+
+def entity_search_both_oa(query_entities):
+    """
+    For the cache warmer: what fulltext_search_title returns for a single
+    entity with oa_only False and True, from one candidate query.  Returns
+    {oa_only: (pub dicts, number of candidates)}.  Either can have fewer than
+    25 candidates, in which case fulltext_search_title would have gone on to a
+    title search, so callers should run it for that variant.
+    """
+    (query_entity, query_to_use) = entity_query_params(query_entities[0])
+    rows = db.engine.execute(sql.text(entity_candidates_both_oa_query()),
+                             query=query_to_use,
+                             query_entity=query_entity).fetchall()
+    rows_all = [row for row in rows if row["rank_all"] <= 120]
+    rows_oa = [row for row in rows if row["rank_oa"] is not None and row["rank_oa"] <= 120]
+    return {
+        False: (sort_data_dicts(rows_all, query_to_use, query_entities), len(rows_all)),
+        True: (sort_data_dicts(rows_oa, query_to_use, query_entities), len(rows_oa))
+    }
+
+
+def fulltext_search_title(original_query, query_entities, oa_only, prescore_limit=None):
 
     start_time = time()
     original_query_escaped = original_query.replace("'", "''")
     original_query_with_ands = ' & '.join(original_query_escaped.split(" "))
     query_to_use = u"({})".format(original_query_with_ands)
 
-
     if oa_only:
         oa_clause = u" and is_oa=True "
     else:
         oa_clause = " "
 
-    dois = []
+    if not os.getenv("SEARCH_PRESCORE_IN_SQL", False) == "True":
+        prescore_limit = None
+
     rows = []
+    num_candidates = 0
     search_done = False
 
     if is_doi(original_query):
-        dois = [clean_doi(original_query)]
+        (rows, num_candidates) = fetch_sort_data(doi_candidates_query(),
+                                                 {"query": query_to_use, "doi": clean_doi(original_query)},
+                                                 query_entities,
+                                                 prescore_limit)
         search_done = True
 
     # if "from_" in original_query and "to_" in original_query:
@@ -116,41 +517,24 @@ def fulltext_search_title(original_query, query_entities, oa_only, full=True):
     #     print "done getting query getting pmids"
 
     if not search_done and query_entities and len(query_entities)==1:
-        query_entity = query_entities[0]
-        query_entity = query_entity.replace("(", " ")
-        query_entity = query_entity.replace(")", " ")
-        query_entity = query_entity.replace("&", " ")
+        (query_entity, query_to_use) = entity_query_params(query_entities[0])
 
         print u"have query_entities"
 
-        query_string = u"""
-            select doi 
-            from search_title_dandelion_simple_mv
-            where title=:query_entity 
-            and num_events >= 3
-            {oa_clause}
-            order by num_events desc 
-            limit 120""".format(oa_clause=oa_clause)
-
-        rows = db.engine.execute(sql.text(query_string), query_entity=query_entity).fetchall()
-        print "done getting query getting dois"
-        original_query_escaped = query_entity.replace("'", "''")
-        original_query_with_ands = ' & '.join(original_query_escaped.split(" "))
-        query_to_use = u"({})".format(original_query_with_ands)
-
-
-    if rows:
-        dois = [row[0] for row in rows]
-        print "len dois", len(dois)
+        (rows, num_candidates) = fetch_sort_data(entity_candidates_query(oa_clause),
+                                                 {"query": query_to_use, "query_entity": query_entity},
+                                                 query_entities,
+                                                 prescore_limit)
+        print "done getting query getting dois and sort data"
+        print "len dois", num_candidates
 
-    if not search_done and len(dois) < 25:
+    if not search_done and num_candidates < 25:
         print "len(dois) < 25, in fulltext_search_title"
 
     # if True: # debug
     #     print "doing full text search anyway"
 
         # need to do the full search
-        print "len(dois) < 25, in fulltext_search_title"
         original_query_escaped = original_query.replace("'", "''")
         original_query_escaped = original_query_escaped.replace("&", "")
         original_query_escaped = original_query_escaped.replace("(", " ")
@@ -179,99 +563,49 @@ def fulltext_search_title(original_query, query_entities, oa_only, full=True):
 
         print u"starting query for {}".format(query_to_use)
 
-        query_string = u"""
-            select
-            doi,
-            (ts_rank_cd(to_tsvector('english', article_title), to_tsquery(:query), 1) + 0.05*COALESCE(num_events,0.0)) AS rank
-            FROM ricks_gtr_sort_results
-            WHERE  
-            to_tsvector('english', article_title) @@  to_tsquery(:query)
-            and doi is not null 
-            {oa_clause}
-            order by rank desc
-            limit 120;
-            """.format(oa_clause=oa_clause)
-
-
-        # print query_string
-
-
-        rows = db.engine.execute(sql.text(query_string), query=query_to_use).fetchall()
+        (rows, num_candidates) = fetch_sort_data(title_candidates_query(oa_clause),
+                                                 {"query": query_to_use},
+                                                 query_entities,
+                                                 prescore_limit)
         print "done getting query of sort data"
 
-        # print rows
-        dois = [row[0] for row in rows]
-
     time_for_dois = elapsed(start_time, 3)
-    print u"done query for dois and sort data: got {} dois".format(len(dois))
+    print u"done query for dois and sort data: got {} dois".format(num_candidates)
 
     time_for_pubs_start_time = time()
 
-    my_pubs_filtered = []
-    if dois:
-        if full:
-            query_string = u"""
-                select pmid,
-                    doi,
-                    article_title,
-                    journal_title,
-                    pub_types,
-                    abstract_length,
-                    is_oa,
-                    num_events,
-                    num_news_events,
-                    (ts_rank_cd(to_tsvector('english', article_title), to_tsquery(:query), 1) + 0.05*COALESCE(num_events,0.0)) AS rank
-                    from ricks_gtr_sort_results
-                    where doi in ({dois_string})
-                """.format(dois_string=u",".join([u"'{}'".format(str(d)) for d in dois]))
-            # print query_string
-            rows = db.engine.execute(sql.text(query_string), query=query_to_use, dois=dois).fetchall()
-            print "done getting sort data"
-            # print rows
-
-            # print rows
-            my_pubs_filtered = []
-            for row in rows:
-                my_dict = {
-                    "pmid": row[0],
-                    "doi": row[1],
-                    "article_title": row[2],
-                    "journal_title": row[3],
-                    "pub_types": row[4],
-                    "abstract_length": row[5],
-                    "is_oa": row[6],
-                    "num_events": row[7],
-                    "num_news_events": row[8],
-                    "score": row[9],
-                    "query": query_to_use,
-                    "query_entities": query_entities
-                     }
-                my_dict["adjusted_score"] = adjusted_score(my_dict)
-                my_pubs_filtered.append(my_dict)
-
-            # my_pubs = db.session.query(Pub).filter(Pub.pmid.in_(pmids)).options(orm.undefer_group('full')).all()
-            # my_pubs = db.session.query(Pub).filter(Pub.pmid.in_(pmids)).\
-            #     options(orm.raiseload(Pub.authors)).\
-            #     options(orm.raiseload(Pub.dandelion_lookup)).\
-            #     options(orm.raiseload(Pub.doi_lookup)).\
-            #     all()
-        else:
-            my_pubs = db.session.query(Pub).filter(Pub.doi.in_(dois)).\
-                options(orm.raiseload(Pub.authors)).\
-                options(orm.raiseload(Pub.dandelion_lookup)).\
-                options(orm.raiseload(Pub.doi_lookup)).\
-                all()
-            my_pubs_filtered = [p for p in my_pubs if not p.suppress]
+    my_pubs_filtered = sort_data_dicts(rows, query_to_use, query_entities)
 
     print "done query for my_pubs"
 
-
     time_for_pubs = elapsed(time_for_pubs_start_time, 3)
 
-    return (my_pubs_filtered, time_for_dois, time_for_pubs)
+    return (my_pubs_filtered, num_candidates, time_for_dois, time_for_pubs)
 
 
 def autocomplete_entity_titles(original_query):
+    if autocomplete_index:
+        entity_titles = autocomplete_index.autocomplete(original_query)
+        if entity_titles is not None:
+            return entity_titles
+    return autocomplete_entity_titles_from_db(original_query)
+
+
+def matching_entity_title(query):
+    """
+    The autocomplete entity whose title is query, ignoring case, or None.
+    """
+    if autocomplete_index and autocomplete_index.is_loaded():
+        return autocomplete_index.exact_match(query)
+
+    query_lower = query.lower()
+    for a in autocomplete_entity_titles_from_db(query):
+        if a.lower() == query_lower:
+            return a
+    return None
+
+
+def autocomplete_entity_titles_from_db(original_query):
 
     query_string = u"""
         select entity_title, sum_num_events, num_papers
@@ -0,0 +1,124 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from time import time
+
+
+class SharedResponseCache(object):
+    """
+    Response cache shared by all the gunicorn workers on a dyno.
+
+    Stores already-serialized response bodies in a local sqlite file in WAL mode,
+    so readers in one worker don't block a writer in another and the pages are
+    read through mmap.  Survives worker restarts from --reload, needs no outside
+    service.  Entries have a TTL, and the least recently used ones are evicted
+    once the total body size goes over max_bytes.
+
+    Any sqlite error is logged and treated as a miss; the cache should never
+    break a request.
+    """
+
+    def __init__(self, path, max_bytes=256*1024*1024, ttl_seconds=60*60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._sets_since_eviction = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # sqlite connections can't be shared across threads or forks
+        my_connection = getattr(self._local, "connection", None)
+        if my_connection is not None and self._local.pid == os.getpid():
+            return my_connection
+
+        my_connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+        my_connection.text_factory = str
+        my_connection.execute("PRAGMA journal_mode=WAL")
+        my_connection.execute("PRAGMA synchronous=NORMAL")
+        my_connection.execute("PRAGMA mmap_size={}".format(self.max_bytes))
+        my_connection.execute("""
+            create table if not exists response_cache (
+                key text primary key,
+                body blob,
+                expires real,
+                accessed real,
+                size integer)""")
+        my_connection.execute("create index if not exists response_cache_accessed_idx on response_cache (accessed)")
+        self._local.connection = my_connection
+        self._local.pid = os.getpid()
+        return my_connection
+
+    def get(self, key):
+        now = time()
+        try:
+            my_connection = self._connection()
+            row = my_connection.execute(
+                "select body, expires, accessed from response_cache where key=?", (key, )).fetchone()
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+            # don't write on every read, just often enough to keep eviction order useful
+            if now - row[2] > 60:
+                my_connection.execute("update response_cache set accessed=? where key=?", (now, key))
+        except sqlite3.Error:
+            logging.exception("shared cache get error")
+            return None
+        self.hits += 1
+        return str(row[0])
+
+    def set(self, key, body):
+        if body is None:
+            return
+        now = time()
+        try:
+            my_connection = self._connection()
+            my_connection.execute(
+                "insert or replace into response_cache (key, body, expires, accessed, size) values (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(body), now + self.ttl_seconds, now, len(body)))
+            self._sets_since_eviction += 1
+            if self._sets_since_eviction >= 50:
+                self._sets_since_eviction = 0
+                self.evict()
+        except sqlite3.Error:
+            logging.exception("shared cache set error")
+
+    def evict(self):
+        my_connection = self._connection()
+        my_connection.execute("delete from response_cache where expires < ?", (time(), ))
+        total_size = my_connection.execute("select coalesce(sum(size), 0) from response_cache").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+
+        # drop least recently used until we're back to 80% of the limit, so we don't evict on every set
+        bytes_to_free = total_size - int(self.max_bytes * 0.8)
+        rows = my_connection.execute("select key, size from response_cache order by accessed asc").fetchall()
+        keys_to_delete = []
+        for (key, size) in rows:
+            if bytes_to_free <= 0:
+                break
+            keys_to_delete.append((key, ))
+            bytes_to_free -= size
+        my_connection.executemany("delete from response_cache where key=?", keys_to_delete)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+def shared_cache_key(endpoint, params):
+    return u"{}|{}".format(endpoint, json.dumps(list(params)))
+
+
+shared_response_cache = None
+if os.getenv("SHARED_RESPONSE_CACHE_PATH", "shared_response_cache.sqlite"):
+    shared_response_cache = SharedResponseCache(
+        os.getenv("SHARED_RESPONSE_CACHE_PATH", "shared_response_cache.sqlite"),
+        max_bytes=int(os.getenv("SHARED_RESPONSE_CACHE_MAX_MB", 256)) * 1024 * 1024,
+        ttl_seconds=int(os.getenv("SHARED_RESPONSE_CACHE_TTL", 60*60))
+    )
@@ -16,17 +16,35 @@ from time import time
 
 from app import app
 from app import db
+from app import reset_query_count
+from app import get_query_count
+from app import reset_pool_stats
+from app import get_pool_stats
 from pub import Pub
 from pub import PubDoi
 from pub import UnpaywallLookup
+from pub import load_minimal_pubs
 from pub_list import PubList
+from ranked_results import RankedResults
 from search import fulltext_search_title
 from annotation import annotation_file_contents
 from search import autocomplete_entity_titles
 from search import get_cached_api_response
+from search import get_cached_api_response_body
 from entity import get_entities_from_query
 from notifications import notification_signup
 from history import log_query
+from annotation_cache import annotation_cache_stats
+from annotation_list import reset_annotation_parse_counts
+from annotation_list import get_annotation_parse_counts
+from response_cache import search_response_cache
+from response_cache import search_response_cache_key
+from shared_cache import shared_response_cache
+from shared_cache import shared_cache_key
+from json_stream import ApiJSONEncoder
+from json_stream import streaming_json_resp
+from json_stream import gunzip_bytes
+from json_stream import gzip_json_bytes
 from util import elapsed
 from util import clean_doi
 from util import get_sql_answers
@@ -36,19 +54,8 @@ from util import clean_doi
 
 # try it at https://api.paperbuzz.org/v0/doi/10.1371/journal.pone.0000308
 
-def json_dumper(obj):
-    """
-    if the obj has a to_dict() function we've implemented, uses it to get dict.
-    from http://stackoverflow.com/a/28174796
-    """
-    try:
-        return obj.to_dict()
-    except AttributeError:
-        return obj.__dict__
-
-
 def json_resp(thing):
-    json_str = json.dumps(thing, sort_keys=True, default=json_dumper, indent=4)
+    json_str = json.dumps(thing, sort_keys=True, cls=ApiJSONEncoder, indent=4)
 
     if request.path.endswith(".json") and (os.getenv("FLASK_DEBUG", False) == "True"):
         print u"rendering output through debug_api.html template"
@@ -62,6 +69,53 @@ def json_resp(thing):
     return resp
 
 
+def accepted_encodings():
+    # best first, ending with None for uncompressed
+    accept_encoding = request.headers.get("Accept-Encoding", "").lower()
+    offered = [e.split(";")[0].strip() for e in accept_encoding.split(",")]
+    return [e for e in ["br", "gzip"] if e in offered] + [None]
+
+
+def accepts_gzip():
+    return "gzip" in accepted_encodings()
+
+
+def api_resp(thing, on_gzip_complete=None, on_complete=None):
+    # pretty-printed and through the debug template when debugging, otherwise
+    # compact json streamed out as it's encoded
+    if os.getenv("FLASK_DEBUG", False) == "True":
+        return json_resp(thing)
+    return streaming_json_resp(thing, accepts_gzip(), on_gzip_complete, on_complete)
+
+
+def shared_cache_resp(gzipped_body, start_time):
+    # body is already serialized and gzipped, so send it as-is and put the timing in headers
+    if accepts_gzip():
+        resp = make_response(gzipped_body, 200)
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.headers["Vary"] = "Accept-Encoding"
+    else:
+        resp = make_response(gunzip_bytes(gzipped_body), 200)
+    resp.mimetype = "application/json"
+    resp.headers["X-Cache"] = "shared"
+    resp.headers["X-Timing-Total"] = str(elapsed(start_time, 4))
+    return resp
+
+
+def cached_entity_resp(cached_body, start_time):
+    # stored bytes from cached_entity_response_body, sent without decoding
+    (body, content_encoding, collected) = cached_body
+    resp = make_response(body, 200)
+    resp.mimetype = "application/json"
+    if content_encoding:
+        resp.headers["Content-Encoding"] = content_encoding
+        resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["X-Cache"] = "entity"
+    resp.headers["X-Cached-On"] = collected.isoformat()
+    resp.headers["X-Timing-Total"] = str(elapsed(start_time, 4))
+    return resp
+
+
 def abort_json(status_code, msg):
     body_dict = {
         "HTTP_status_code": status_code,
@@ -110,9 +164,17 @@ def index_endpoint():
 
 @app.route("/paper/doi/<path:my_doi>", methods=["GET"])
 def get_pub_by_doi(my_doi):
+    start_time = time()
     my_clean_doi = clean_doi(my_doi)
     # print my_clean_doi
 
+    shared_key = None
+    if shared_response_cache and "nocache" not in request.args:
+        shared_key = shared_cache_key("doi.json.gz", [my_clean_doi])
+        cached_body = shared_response_cache.get(shared_key)
+        if cached_body:
+            return shared_cache_resp(cached_body, start_time)
+
     query = db.session.query(PubDoi).filter(PubDoi.doi==my_clean_doi).options(orm.undefer_group('full'))
     # print query
     my_pub = query.first()
@@ -121,12 +183,16 @@ def get_pub_by_doi(my_doi):
         abort_json(404, u"'{}' is an invalid doi.  See https://doi.org/{}".format(my_clean_doi, my_clean_doi))
 
     my_pub_list = PubList(pubs=[my_pub])
+    my_pub_list.set_pubmed_lookups()
     my_pub_list.set_dandelions()
     my_pub_list.set_pictures()
-    results = my_pub_list.to_dict_serp_list()
-    return jsonify({"results": my_pub_list.to_dict_serp_list(),
-                    "annotations": my_pub_list.to_dict_annotation_metadata(),
-                    })
+    response = {"results": my_pub_list.to_dict_serp_list(),
+                "annotations": my_pub_list.to_dict_annotation_metadata(),
+                }
+    on_gzip_complete = None
+    if shared_key:
+        on_gzip_complete = lambda body: shared_response_cache.set(shared_key, body)
+    return api_resp(response, on_gzip_complete)
 
 
 @app.route("/search/<path:query>", methods=["GET"])
@@ -149,10 +215,6 @@ def get_search_query(query):
     if request.args.get("minimum", ""):
         return_full_api_response = False
 
-    query_entities = get_entities_from_query(query)
-    print "query_entities", query_entities
-    getting_entity_lookup_elapsed = elapsed(start_time, 3)
-
     # page starts at 1 not 0
     page = 1
     try:
@@ -175,9 +237,68 @@ def get_search_query(query):
     except:
         oa_only = False
 
+    # single-entity queries may have a precomputed response, sent as stored bytes
+    query_entities = None
+    if not nocache and page == 1:
+        query_entities = get_entities_from_query(query)
+        if query_entities and len(query_entities) == 1:
+            cached_body = get_cached_api_response_body(query_entities[0], oa_only, accepted_encodings())
+            if cached_body:
+                print u"finished query for {}: sent cached entity response".format(query)
+                return cached_entity_resp(cached_body, start_time)
+
+    cache_key = search_response_cache_key(query, page, pagesize, oa_only, return_full_api_response, no_live_calls)
+    shared_key = shared_cache_key("search.json.gz", cache_key)
+
+    def compute_search_response():
+        return build_search_response(query, page, pagesize, oa_only, return_full_api_response, no_live_calls, nocache, start_time, query_entities)
+
+    # nocache defaults to true for the cached_entity_response table, so only skip
+    # the in-process and shared caches when the caller explicitly asks for it
+    on_complete = None
+    if "nocache" in request.args:
+        response = build_search_response(query, page, pagesize, oa_only, return_full_api_response, no_live_calls, nocache, start_time, query_entities)
+        response_cache_hit = False
+    else:
+        # this worker's cache first, then the one shared by all workers on the dyno
+        if shared_response_cache and search_response_cache.get(cache_key) is None:
+            cached_body = shared_response_cache.get(shared_key)
+            if cached_body:
+                return shared_cache_resp(cached_body, start_time)
+        (response, response_cache_hit) = search_response_cache.get_or_compute(cache_key, compute_search_response)
+        if shared_response_cache and not response_cache_hit:
+            # the body we send has this request's _timing in it, so once it's
+            # sent, gzip one without it for the other workers
+            shared_body = dict((k, v) for (k, v) in response.iteritems() if k != "_timing")
+            on_complete = lambda: shared_response_cache.set(shared_key, gzip_json_bytes(shared_body))
+
+    # cached responses are shared between requests, so don't change them in place
+    response = dict(response)
+    if response_cache_hit:
+        response["_timing"] = {"9 total": elapsed(start_time, 3)}
+    else:
+        response["_timing"] = dict(response.get("_timing", {}))
+    response["_timing"]["0 response_cache_hit"] = response_cache_hit
+    response["_timing"]["0 response_cache_stats"] = search_response_cache.stats()
+
+    print u"finished query for {}: took {} seconds".format(query, elapsed(start_time))
+    return api_resp(response, on_complete=on_complete)
+
+
+def build_search_response(query, page, pagesize, oa_only, return_full_api_response, no_live_calls, nocache, start_time, query_entities=None):
+
+    reset_annotation_parse_counts()
+    reset_query_count()
+    reset_pool_stats()
+    if query_entities is None:
+        query_entities = get_entities_from_query(query)
+    print "query_entities", query_entities
+    getting_entity_lookup_elapsed = elapsed(start_time, 3)
+
     if nocache:
         print u"skipping cache"
     else:
+        # entities that don't have a cached_entity_response_body row yet
         if query_entities and len(query_entities)==1 and page==1:
             cached_response = get_cached_api_response(query_entities[0], oa_only)
             if cached_response and cached_response[0]:
@@ -186,40 +307,59 @@ def get_search_query(query):
                 api_response["_cached_on"] = collected_date.isoformat()
                 api_response["_timing"] = {"total": total_time}
                 print "got response!!!"
-                return jsonify(api_response)
+                return api_response
+
+    (pubs_to_sort, num_candidates, time_to_pmids_elapsed, time_for_pubs_elapsed) = fulltext_search_title(
+        query, query_entities, oa_only, prescore_limit=pagesize * page)
 
-    (pubs_to_sort, time_to_pmids_elapsed, time_for_pubs_elapsed) = fulltext_search_title(query, query_entities, oa_only, full=return_full_api_response)
+    response = render_search_response(pubs_to_sort, num_candidates, page, pagesize, oa_only,
+                                      return_full_api_response, no_live_calls, query_entities)
 
+    response["_timing"].update({"9 total": elapsed(start_time, 3),
+                                "1 getting_entity_lookup_elapsed": getting_entity_lookup_elapsed,
+                                "2 identify_pmids_for_top_100": time_to_pmids_elapsed,
+                                "3 loading_top_100_data_for_sorting": time_for_pubs_elapsed,
+                                })
+    return response
+
+
+def render_search_response(pubs_to_sort, num_candidates, page, pagesize, oa_only, return_full_api_response, no_live_calls, query_entities):
+    """
+    The api response for scored candidates from fulltext_search_title: picks
+    the page, loads those pubs, annotates and serializes them.  Also used by
+    the cache warmer in save_cached_responses.py.
+    """
     initializing_publist_start_time = time()
-    # sorted_pubs = sorted(pubs_to_sort, key=lambda k: k.adjusted_score, reverse=True)
-    # selected_pubs = sorted_pubs[(pagesize * (page-1)):(pagesize * page)]
-    # selected_pmids = [p.pmid for p in selected_pubs]
 
-    sorted_pubs = sorted(pubs_to_sort, key=lambda k: k["adjusted_score"], reverse=True)
-    sorted_pubs = [p for p in sorted_pubs]
-    selected_pubs = sorted_pubs[(pagesize * (page-1)):(pagesize * page)]
+    ranked_pubs = RankedResults(pubs_to_sort)
+    selected_pubs = ranked_pubs.page(page, pagesize)
 
     selected_dois = [p["doi"] for p in selected_pubs]
     print selected_dois
 
     selected_pubs_full = []
-    if selected_dois:
+    if not return_full_api_response:
+        # minimum responses skip annotations, so only load the columns they show
+        selected_pubs_full += load_minimal_pubs(selected_dois)
+    elif selected_dois:
         selected_pubs_full += db.session.query(PubDoi).filter(PubDoi.doi.in_(selected_dois)).options(orm.undefer_group('full')).all()
 
     selected_pubs_full = [p for p in selected_pubs_full if not p.suppress]  # get rid of retracted ones
     for my_pub in selected_pubs_full:
-        my_pub.adjusted_score = [p["adjusted_score"] for p in sorted_pubs
-                                 if p["doi"]==my_pub.display_doi][0]
+        my_pub.adjusted_score = ranked_pubs.score(my_pub.display_doi)
 
     my_pub_list = PubList(pubs=selected_pubs_full)
+    if return_full_api_response:
+        my_pub_list.set_pubmed_lookups()
     initializing_publist_elapsed = elapsed(initializing_publist_start_time, 3)
 
     set_dandelions_start_time = time()
-    if not no_live_calls:
+    if return_full_api_response and not no_live_calls:
         my_pub_list.set_dandelions()
     set_dandelions_elapsed = elapsed(set_dandelions_start_time)
     set_pictures_start_time = time()
-    my_pub_list.set_pictures()
+    if return_full_api_response:
+        my_pub_list.set_pictures()
     set_pictures_elapsed = elapsed(set_pictures_start_time)
 
     to_dict_start_time = time()
@@ -229,27 +369,25 @@ def get_search_query(query):
     response = {"results": results,
                     "page": page,
                     "oa_only": oa_only,
-                    "total_num_pubs": min(100, len(pubs_to_sort)),
+                    "total_num_pubs": min(100, num_candidates),
                     "query_entities": query_entities
                     }
     if return_full_api_response:
         response["annotations"] = my_pub_list.to_dict_annotation_metadata()
 
     to_dict_elapsed = elapsed(to_dict_start_time, 3)
-    total_time = elapsed(start_time, 3)
 
-    response["_timing"] = {"9 total": total_time,
-                           "1 getting_entity_lookup_elapsed": getting_entity_lookup_elapsed,
-                           "2 identify_pmids_for_top_100": time_to_pmids_elapsed,
-                           "3 loading_top_100_data_for_sorting": time_for_pubs_elapsed,
-                           "4 loading_final_10_full_pubs": initializing_publist_elapsed,
+    response["_timing"] = {"4 loading_final_10_full_pubs": initializing_publist_elapsed,
                            "5 set_dandelions_elapsed": set_dandelions_elapsed,
+                           "5 annotation_cache_stats": dict(annotation_cache_stats),
                            "6 set_pictures_elapsed": set_pictures_elapsed,
                            "7 to_dict_elapsed": to_dict_elapsed,
+                           "7 annotation_parse_counts": get_annotation_parse_counts(),
+                           "8 num_queries": get_query_count(),
+                           "8 pool_stats": get_pool_stats(),
                         }
 
-    print u"finished query for {}: took {} seconds".format(query, elapsed(start_time))
-    return jsonify(response)
+    return response
 
 
 @app.route("/autocomplete/<query>", methods=["GET"])